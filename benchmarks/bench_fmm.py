@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Accuracy and speed of the raytracing engines of Grid2D
+
+Copyright 2017 Bernard Giroux
+email: Bernard.Giroux@ete.inrs.ca
+
+This file is part of BhTomoPy.
+
+BhTomoPy is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+Usage (from the top directory of BhTomoPy):
+    python -m benchmarks.bench_fmm
+"""
+
+import numpy as np
+
+from grid import Grid2D
+from benchmarks.bench_raytrace import best_time
+
+
+def crosshole(nx=20, nz=30, ntx=15, dx=0.5):
+    """
+    Crosshole geometry: sources in the left border, receivers in the right one
+
+    Returns grx, grz, Tx, Rx
+    """
+    grx = dx * np.arange(nx + 1)
+    grz = dx * np.arange(nz + 1)
+    zt = np.linspace(grz[0] + dx, grz[-1] - dx, ntx)
+    Tx = np.array([[grx[0] + 0.5 * dx, 0.0, z] for z in zt for _ in zt])
+    Rx = np.array([[grx[-1] - 0.5 * dx, 0.0, z] for _ in zt for z in zt])
+    return grx, grz, Tx, Rx
+
+
+def layered(grx, grz, velocities=(0.10, 0.12, 0.09)):
+    """
+    Slowness of horizontal layers of equal thickness (column-major order)
+    """
+    zc = 0.5 * (grz[1:] + grz[:-1])
+    layer = np.minimum((len(velocities) * (zc - grz[0]) / (grz[-1] - grz[0])).astype(int),
+                       len(velocities) - 1)
+    s = 1.0 / np.array(velocities)[layer]
+    return np.tile(s, grx.size - 1)
+
+
+def run(g, method, ns, s, Tx, Rx):
+    g.setRaytracingMethod(method)
+    g.nsnx = g.nsnz = ns
+    g.cgrid = None
+
+    def fct():
+        return g.raytrace(s, Tx, Rx)
+
+    t = best_time(fct, repeat=2)
+    return t, fct()
+
+
+def bench_engines(cases=(('spm', 5), ('spm', 10), ('fmm', 1), ('fmm', 3), ('fmm', 5)), refine=4):
+    """
+    Compare traveltimes and L computed with the shortest path and the fast
+    marching engines
+
+    In the homogeneous model, the reference is the straight ray traveltime.
+    In the layered model, the reference is computed with the fast marching
+    engine on a grid refined by a factor refine.
+
+    Returns a dict with keys 'homogeneous' and 'layered', each holding a
+    list of tuples
+        (method, ns, time, max tt error, mean tt error, max |L*s - tt|)
+    """
+    grx, grz, Tx, Rx = crosshole()
+    g = Grid2D(grx, grz)
+    dist = np.sqrt(np.sum((Tx - Rx)**2, axis=1))
+
+    s_h = 10.0 * np.ones((g.getNumberOfCells(),))
+    s_l = layered(grx, grz)
+
+    gref = Grid2D(np.linspace(grx[0], grx[-1], refine * (grx.size - 1) + 1),
+                  np.linspace(grz[0], grz[-1], refine * (grz.size - 1) + 1))
+    _, ref = run(gref, 'fmm', 3, layered(gref.grx, gref.grz), Tx, Rx)
+
+    out = {'homogeneous': [], 'layered': []}
+    for method, ns in cases:
+        for key, s, tt_ref in (('homogeneous', s_h, 10.0 * dist), ('layered', s_l, ref.tt)):
+            t, res = run(g, method, ns, s, Tx, Rx)
+            err = np.abs(res.tt - tt_ref) / tt_ref
+            out[key].append((method, ns, t, err.max(), err.mean(),
+                             np.abs(res.L * s - res.tt).max() / res.tt.max()))
+    return out
+
+
+if __name__ == '__main__':
+
+    results = bench_engines()
+
+    for key in ('homogeneous', 'layered'):
+        print('\n' + key.capitalize() + ' model (relative errors)')
+        print('{0:>6s} {1:>4s} {2:>10s} {3:>12s} {4:>12s} {5:>12s}'.format('method', 'ns', 'time (s)',
+                                                                         'max err', 'mean err', 'L*s - tt'))
+        for method, ns, t, emax, emean, el in results[key]:
+            print('{0:>6s} {1:4d} {2:10.3f} {3:12.2e} {4:12.2e} {5:12.2e}'.format(method, ns, t,
+                                                                                emax, emean, el))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark of the geostatistical inversion
+
+Copyright 2017 Bernard Giroux
+email: Bernard.Giroux@ete.inrs.ca
+
+This file is part of BhTomoPy.
+
+BhTomoPy is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+The peak resident set size (RSS) of inversion.invGeostat is compared to
+that of the previous implementation (function legacy_invGeostat), which
+converted L to a dense array to compute row sums, built the identity matrix
+of the data and solved Cd with a general solver.  Each run is done in a
+separate process, the peak RSS of which is read with getrusage.
+
+The covariance matrix of the model is also applied by FFT (version fft,
+parameter fftCovar of InvLSQRParams) on grids where storing it dominates
+the memory used (function bench_fft), and the data-space system is solved
+by conjugate gradients (version cg, parameter dataCG) for increasing
+numbers of data (function bench_cg).
+
+Usage (from the top directory of BhTomoPy):
+    python -m benchmarks.bench_inversion
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import covar
+from grid import Grid2D
+import inversion
+
+
+def problem(ndata, nx, nz):
+    """
+    Straight-ray crosshole survey with about ndata rays on a nx by nz grid
+
+    Returns params, data, idata, grid, cm
+    """
+    grx = np.linspace(0.0, 10.0, nx + 1)
+    grz = np.linspace(0.0, 15.0, nz + 1)
+    n = int(round(np.sqrt(ndata)))
+    z = np.linspace(0.1, 14.9, n)
+    Tx = np.array([[0.05, 0.0, a] for a in z for _ in z])
+    Rx = np.array([[9.95, 0.0, b] for _ in z for b in z])
+    g = Grid2D(grx, grz, 1)
+    g.Tx = Tx
+    g.Rx = Rx
+
+    rng = np.random.default_rng(0)
+    dist = np.sqrt(np.sum((Tx - Rx)**2, axis=1))
+    tt = dist * (10.0 + 0.1 * rng.standard_normal(dist.shape))
+    data = np.column_stack((Tx, Rx, tt, 0.1 * np.ones(tt.shape), np.arange(tt.size)))
+    idata = np.ones(tt.shape, dtype=bool)
+
+    cm = covar.CovarianceModel('2D')
+    cm.covar = [covar.CovarianceSpherical(np.array([4.0, 4.0]), np.array([0.0]), 0.01)]
+    cm.nugget_data = 1.e-2
+    params = inversion.InvLSQRParams()
+    params.saveInvData = 0
+    return params, data, idata, g, cm
+
+
+def legacy_invGeostat(params, data, idata, grid, cm):
+    """
+    First iteration of invGeostat as it was done before sparse row sums and
+    the Cholesky factorization of Cd (L.A replaced by L.toarray())
+    """
+    L = grid.getForwardStraightRays(idata)
+    xc = grid.getCellCenter()
+    Cm = cm.compute(xc, xc)
+
+    # as in invGeostat, l_moy is the mean of the initial model (0) at the first iteration
+    tomo_s = 0
+    l_moy = np.mean(tomo_s)
+    mta = np.sum(L.toarray() * l_moy, axis=1)
+    dt = data[:, 6] - mta
+    Cd = L * Cm * L.T + cm.nugget_data * np.eye(np.size(L.toarray()[:, 0]))
+    Cdm = L * Cm
+    Gamma = np.linalg.solve(Cd, dt).reshape(-1, 1).T
+    m = Gamma.dot(Cdm).T
+    return np.ravel(m + l_moy)
+
+
+def run(version, ndata, nx, nz):
+    """
+    Run one version in the current process
+
+    Returns a dict holding the RSS (MB) after the problem is set up, the
+    peak RSS, the time and the mean of the slowness model
+    """
+    params, data, idata, g, cm = problem(ndata, nx, nz)
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    t = time.perf_counter()
+    if version == 'legacy':
+        s = legacy_invGeostat(params, data, idata, g, cm)
+    else:
+        params.fftCovar = 1 if version in ('fft', 'cg') else 0
+        params.dataCG = 1 if version == 'cg' else 0
+        params.numItStraight = 0
+        params.numItCurved = 0
+        # first iteration only
+        tomo = inversion.invGeostat(params, data, idata, g, cm, np.zeros(1))
+        s = tomo.s
+    t = time.perf_counter() - t
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return {'version': version, 'ndata': data.shape[0], 'ncell': g.getNumberOfCells(),
+            'setup_mb': rss0, 'peak_mb': rss, 'time': t, 'mean_s': float(np.mean(s))}
+
+
+def bench_memory(sizes=((2500, 20, 30), (4900, 20, 30), (8100, 20, 30)), versions=('legacy', 'sparse')):
+    """
+    Peak RSS of the versions, each run in a new process
+
+    The grids are small so that the (ncell x ncell) covariance matrix of the
+    model, computed in the same way by the legacy and sparse versions, does
+    not dominate
+
+    Returns a list of dicts (see function run)
+    """
+    out = []
+    for ndata, nx, nz in sizes:
+        for version in versions:
+            p = subprocess.run([sys.executable, '-m', 'benchmarks.bench_inversion', '--child', version,
+                                str(ndata), str(nx), str(nz)],
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               stdout=subprocess.PIPE, check=True, universal_newlines=True)
+            out.append(json.loads(p.stdout.strip().splitlines()[-1]))
+    return out
+
+
+def bench_fft(sizes=((900, 40, 60), (900, 60, 90), (900, 80, 120))):
+    """
+    Peak RSS with Cm stored and applied by FFT, on larger grids
+    """
+    return bench_memory(sizes, ('sparse', 'fft'))
+
+
+def bench_cg(sizes=((900, 40, 60), (3600, 40, 60), (8100, 40, 60))):
+    """
+    Peak RSS and time, Cd being factorized (version fft) or the system
+    solved by conjugate gradients (version cg)
+    """
+    return bench_memory(sizes, ('fft', 'cg'))
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        print(json.dumps(run(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))))
+        sys.exit(0)
+
+    results = bench_memory() + bench_fft() + bench_cg()
+    print('{0:>8s} {1:>7s} {2:>7s} {3:>10s} {4:>10s} {5:>9s} {6:>10s}'.format('version', 'ndata', 'ncell',
+                                                                         'setup (MB)', 'peak (MB)',
+                                                                         'time (s)', 'mean s'))
+    for r in results:
+        print('{0:>8s} {1:7d} {2:7d} {3:10.1f} {4:10.1f} {5:9.2f} {6:10.5f}'.format(r['version'], r['ndata'],
+                                                                               r['ncell'], r['setup_mb'],
+                                                                               r['peak_mb'], r['time'],
+                                                                               r['mean_s']))
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the raytracing code
+
+Copyright 2017 Bernard Giroux
+email: Bernard.Giroux@ete.inrs.ca
+
+This file is part of BhTomoPy.
+
+BhTomoPy is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+Usage (from the top directory of BhTomoPy):
+    python -m benchmarks.bench_raytrace
+"""
+
+import time
+import numpy as np
+
+from cutils import cgrid2d
+
+
+def best_time(fct, *args, repeat=5):
+    """
+    Return the best wall time (in s) of repeat calls to fct(*args)
+    """
+    t = np.inf
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        fct(*args)
+        t = min(t, time.perf_counter() - t1)
+    return t
+
+
+def legacy_copy(values):
+    """
+    Element by element copy, as done by Grid2Dcpp.raytrace before input
+    arrays were passed as typed memoryviews
+    """
+    out = []
+    for v in values:
+        out.append(float(v))
+    return out
+
+
+def legacy_copy_pts(pts):
+    out = []
+    for p in pts:
+        out.append((float(p[0]), float(p[2])))
+    return out
+
+
+def bench_marshalling(ncells=(1000, 10000, 80000, 320000), nrays=(1000, 10000, 30000, 100000)):
+    """
+    Time needed to hand the input arrays over to the C++ grid
+
+    Returns two lists of tuples
+        (ncell, time legacy, time zero-copy)
+        (nray, time legacy, time zero-copy)
+    """
+    res_cells = []
+    for nc in ncells:
+        nz = int(np.sqrt(nc / 2))
+        nx = nc // nz
+        g = cgrid2d.Grid2Dcpp(b'iso', nx, nz, 1.0, 1.0, 0.0, 0.0, 1, 1, 1)
+        s = np.ones((nx * nz,))
+        res_cells.append((nx * nz, best_time(legacy_copy, s), best_time(g.setSlowness, s)))
+
+    res_rays = []
+    for nr in nrays:
+        data = np.random.rand(nr, 15)
+        # input is usually a slice of the data array from Model.getModelData
+        res_rays.append((nr, best_time(legacy_copy_pts, data[:, 0:3]),
+                         best_time(np.ascontiguousarray, data[:, 0:3], np.float64)))
+
+    return res_cells, res_rays
+
+
+if __name__ == '__main__':
+
+    cells, rays = bench_marshalling()
+
+    print('Slowness marshalling')
+    print('{0:>10s} {1:>14s} {2:>14s} {3:>8s}'.format('ncell', 'legacy (ms)', 'zero-copy (ms)', 'speedup'))
+    for nc, t1, t2 in cells:
+        print('{0:10d} {1:14.3f} {2:14.3f} {3:8.1f}'.format(nc, 1000 * t1, 1000 * t2, t1 / t2))
+
+    print('\nTx/Rx marshalling')
+    print('{0:>10s} {1:>14s} {2:>14s} {3:>8s}'.format('nray', 'legacy (ms)', 'zero-copy (ms)', 'speedup'))
+    for nr, t1, t2 in rays:
+        print('{0:10d} {1:14.3f} {2:14.3f} {3:8.1f}'.format(nr, 1000 * t1, 1000 * t2, t1 / t2))
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark and regression suite of the raytracing code
+
+Copyright 2017 Bernard Giroux
+email: Bernard.Giroux@ete.inrs.ca
+
+This file is part of BhTomoPy.
+
+BhTomoPy is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+Grid2D.raytrace (isotropic, elliptical and tilted elliptical media),
+Grid2D.getForwardStraightRays and Grid2Dcpp.Lsr2da are timed over a matrix
+of grid sizes, numbers of rays and numbers of threads, for synthetic
+crosshole geometries and for the borehole layouts of the files in testData.
+Results are written to a JSON file, along with checksums of the outputs
+(traveltimes and L), and can be compared to a baseline file obtained on the
+same machine: cases slower than the baseline by more than a threshold, or
+whose outputs changed, are flagged.
+
+Usage (from the top directory of BhTomoPy):
+    python -m benchmarks.bench_suite -o baseline.json                 (first run)
+    python -m benchmarks.bench_suite -o new.json -b baseline.json     (after changes)
+
+The exit status is 1 if a case was flagged.
+
+The other modules of the benchmarks directory hold focused benchmarks, run
+in the same way:
+    bench_raytrace: handing input arrays over to the C++ grids
+    bench_fmm: accuracy and speed of the raytracing engines of Grid2D
+    bench_inversion: memory and time of the geostatistical inversion
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+
+import numpy as np
+
+from cutils import cgrid2d
+from grid import Grid2D
+import straightrays
+from benchmarks.bench_raytrace import best_time
+
+
+def synthetic(scale, nray):
+    """
+    Crosshole geometry on a 10 m x 15 m domain, cell size 0.5/scale m, with
+    about nray rays between sources in the left border and receivers in the
+    right one
+
+    Returns grx, grz, Tx, Rx
+    """
+    dx = 0.5 / scale
+    grx = np.arange(0.0, 10.0 + dx / 2, dx)
+    grz = np.arange(0.0, 15.0 + dx / 2, dx)
+    n = max(2, int(round(np.sqrt(nray))))
+    z = np.linspace(0.5, 14.5, n)
+    Tx = np.array([[0.5, 0.0, a] for a in z for _ in z])
+    Rx = np.array([[9.5, 0.0, b] for _ in z for b in z])
+    return grx, grz, Tx, Rx
+
+
+def survey(fname, scale, nray):
+    """
+    Borehole layout of a traveltime file of testData (columns: Tx x, y, z,
+    Rx x, y, z, tt, ...), projected in the vertical plane holding the first
+    Tx and Rx; nray Tx-Rx pairs evenly picked in the file are kept and the
+    cell size is 0.25/scale m
+
+    Returns grx, grz, Tx, Rx
+    """
+    data = np.loadtxt(fname)
+    ind = np.unique(np.linspace(0, data.shape[0] - 1, min(nray, data.shape[0])).astype(int))
+    data = data[ind, :]
+    origin = data[0, 0:2]
+    u = data[0, 3:5] - origin
+    u /= np.sqrt(np.sum(u * u))
+    Tx = np.column_stack(((data[:, 0:2] - origin).dot(u), np.zeros(ind.size), data[:, 2]))
+    Rx = np.column_stack(((data[:, 3:5] - origin).dot(u), np.zeros(ind.size), data[:, 5]))
+
+    dx = 0.25 / scale
+    pts = np.vstack((Tx, Rx))
+    grx = np.arange(pts[:, 0].min() - dx, pts[:, 0].max() + 1.5 * dx, dx)
+    grz = np.arange(pts[:, 2].min() - dx, pts[:, 2].max() + 1.5 * dx, dx)
+    return grx, grz, Tx, Rx
+
+
+def models(grx, grz):
+    """
+    Slowness of a linear velocity gradient, and anisotropy parameters
+    """
+    nx = grx.size - 1
+    nz = grz.size - 1
+    zc = 0.5 * (grz[1:] + grz[:-1])
+    v = 0.10 + 0.02 * (zc - zc[0]) / max(zc[-1] - zc[0], 1.e-6)
+    s = np.tile(1.0 / v, nx)
+    xi = 1.1 * np.ones((nx * nz,))
+    theta = 0.2 * np.ones((nx * nz,))
+    return s, xi, theta
+
+
+def layouts():
+    """
+    Traveltime files of testData holding the coordinates of Tx and Rx
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testData')
+    out = []
+    for fname in sorted(os.listdir(path)):
+        if fname.endswith('.dat'):
+            with open(os.path.join(path, fname)) as f:
+                if len(f.readline().split()) >= 7:
+                    out.append(fname)
+    return out
+
+
+def cases(quick=False):
+    """
+    Matrix of benchmark cases, list of dicts with keys
+        name, geometry, scale, nray, nthreads, function
+    """
+    geometries = ['synthetic'] + layouts()
+    if quick:
+        geometries = geometries[:2]
+        scales = (1,)
+        nrays = (100,)
+        nthreads = (1, 2)
+    else:
+        scales = (1, 2, 4)
+        nrays = (100, 900)
+        nthreads = (1, 2, 4)
+
+    out = []
+    for geom in geometries:
+        for scale in scales:
+            for nray in nrays:
+                for fct in ('raytrace_iso', 'raytrace_elliptical', 'raytrace_tilted'):
+                    for nt in nthreads:
+                        out.append({'geometry': geom, 'scale': scale, 'nray': nray, 'nthreads': nt,
+                                    'function': fct})
+                for fct in ('getForwardStraightRays', 'Lsr2da'):
+                    out.append({'geometry': geom, 'scale': scale, 'nray': nray, 'nthreads': 1,
+                                'function': fct})
+    for c in out:
+        c['name'] = '{function}/{geometry}/scale{scale}/nray{nray}/nthreads{nthreads}'.format(**c)
+    return out
+
+
+def runCase(case, repeat=5, nsn=4):
+    """
+    Time a benchmark case
+
+    Returns a dict holding the case parameters, the number of cells and of
+    rays, the best time over repeat calls, and checksums of the output
+    """
+    if case['geometry'] == 'synthetic':
+        grx, grz, Tx, Rx = synthetic(case['scale'], case['nray'])
+    else:
+        fname = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testData',
+                             case['geometry'])
+        grx, grz, Tx, Rx = survey(fname, case['scale'], case['nray'])
+
+    g = Grid2D(grx, grz, case['nthreads'])
+    g.nsnx = g.nsnz = nsn
+    g.Tx = Tx
+    g.Rx = Rx
+    s, xi, theta = models(grx, grz)
+
+    fct = case['function']
+    if fct.startswith('raytrace'):
+        if fct == 'raytrace_iso':
+            xi = ()
+            theta = ()
+        elif fct == 'raytrace_elliptical':
+            theta = ()
+
+        def f():
+            return g.raytrace(s, Tx, Rx, xi=xi, theta=theta)
+        res = f()  # the C++ grid is instantiated at the first call
+        tt, L = res.tt, res.L
+    elif fct == 'getForwardStraightRays':
+        def f():
+            # the cache would otherwise be timed
+            straightrays.cache.clear()
+            return g.getForwardStraightRays()
+        L = f()
+        tt = L * s
+    else:
+        Tx2 = np.ascontiguousarray(Tx[:, [0, 2]])
+        Rx2 = np.ascontiguousarray(Rx[:, [0, 2]])
+
+        def f():
+            return cgrid2d.Grid2Dcpp.Lsr2da(Tx2, Rx2, grx, grz)
+        L = f()
+        tt = L * np.concatenate((s, xi * s))
+
+    out = dict(case)
+    out['ncell'] = g.getNumberOfCells()
+    out['ndata'] = Tx.shape[0]
+    out['time'] = best_time(f, repeat=repeat)
+    out['tt_sum'] = float(np.sum(tt))
+    out['L_sum'] = float(L.sum())
+    out['L_nnz'] = int(L.nnz)
+    return out
+
+
+def runSuite(case_list, repeat=5, verbose=True):
+    """
+    Run the benchmark cases
+
+    Returns a dict with keys 'meta' (description of the machine and of the
+    run) and 'results' (list of the dicts returned by runCase)
+    """
+    meta = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'repeat': repeat}
+    results = []
+    for case in case_list:
+        r = runCase(case, repeat)
+        results.append(r)
+        if verbose:
+            print('{0:70s} {1:10.4f} s'.format(r['name'], r['time']))
+    return {'meta': meta, 'results': results}
+
+
+def compare(results, baseline, threshold=0.2, rtol=1.e-6, min_time=1.e-3):
+    """
+    Compare results to a baseline
+
+    Input:
+        results, baseline: dicts returned by runSuite
+        threshold: relative slowdown above which a case is flagged
+        rtol: relative tolerance on the checksums of the outputs
+        min_time: cases faster than this (s) are not flagged as slower,
+            their timing being dominated by noise
+    Output:
+        list of dicts with keys name, ratio (time / baseline time), slower
+        and changed (outputs differ from baseline), one per case found in
+        the baseline
+    """
+    base = {r['name']: r for r in baseline['results']}
+    out = []
+    for r in results['results']:
+        b = base.get(r['name'])
+        if b is None:
+            continue
+        ratio = r['time'] / b['time'] if b['time'] > 0 else np.inf
+        changed = r['L_nnz'] != b['L_nnz']
+        for key in ('tt_sum', 'L_sum'):
+            if abs(r[key] - b[key]) > rtol * max(abs(b[key]), 1.e-30):
+                changed = True
+        slower = ratio > 1.0 + threshold and r['time'] > min_time
+        out.append({'name': r['name'], 'ratio': ratio, 'slower': slower, 'changed': changed})
+    return out
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark and regression suite of the raytracing code')
+    parser.add_argument('-o', '--output', default='bench_results.json', help='JSON file of results')
+    parser.add_argument('-b', '--baseline', help='JSON file of results to compare with')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='relative slowdown above which cases are flagged (default 0.2)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of timed calls per case')
+    parser.add_argument('-q', '--quick', action='store_true', help='run a small subset of the cases')
+    args = parser.parse_args()
+
+    results = runSuite(cases(args.quick), args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results written to ' + args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('platform') != results['meta']['platform'] or \
+                baseline['meta'].get('cpu_count') != results['meta']['cpu_count']:
+            print('Warning: baseline obtained on another machine')
+        comparison = compare(results, baseline, args.threshold)
+        nflag = 0
+        print('\n{0:70s} {1:>8s}'.format('case', 'ratio'))
+        for c in comparison:
+            flag = ''
+            if c['slower']:
+                flag += ' SLOWER'
+            if c['changed']:
+                flag += ' CHANGED'
+            if flag:
+                nflag += 1
+            print('{0:70s} {1:8.2f}{2}'.format(c['name'], c['ratio'], flag))
+        print('\n{0} case(s) flagged out of {1}'.format(nflag, len(comparison)))
+        sys.exit(1 if nflag > 0 else 0)
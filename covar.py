@@ -30,6 +30,8 @@ import sys
 import numpy as np
 from scipy.special import erfcinv
 from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import LinearOperator
+from scipy.spatial import cKDTree
 from scipy import linalg
 # import pyfftw.interfaces.numpy_fft as np_fft
 
@@ -345,6 +347,138 @@ class CovarianceModel(object):
         return Cm
 
 
+class CovarianceOperator(LinearOperator):
+    """
+    Covariance matrix of a stationary field on the cells of a regular 2D
+    grid, applied by FFT without being stored
+
+    The matrix is block-Toeplitz; it is embedded in a block-circulant matrix
+    whose eigenvalues are the FFT of the covariance at the lags of the
+    embedding grid (see Grid2D.covarianceEmbedding).  Products with vectors
+    or blocks of columns are thus done by zero-padding the columns on the
+    embedding grid, and by multiplying their FFT by these eigenvalues.
+    Instances are obtained with Grid2D.covarianceOperator.
+
+    Attributes:
+        nx, nz: number of cells along X and Z (cell index is ix*nz + iz)
+        nugget: nugget effect added to the diagonal
+        max_mb: max size, in MB, of the spectra of the columns processed at once
+    """
+    def __init__(self, K, nx, nz, nugget=0.0, max_mb=256):
+        """
+        Input:
+            K: covariance at the lags of the embedding grid (Nx x Nz), with
+               Nx >= 2*nx - 1 and Nz >= 2*nz - 1
+            nx, nz: number of cells along X and Z
+            nugget: nugget effect
+        """
+        if K.shape[0] < 2 * nx - 1 or K.shape[1] < 2 * nz - 1:
+            raise ValueError('Embedding grid too small')
+        self.nx = nx
+        self.nz = nz
+        self.nugget = nugget
+        self.max_mb = max_mb
+        self.Nx, self.Nz = K.shape
+        self.c0 = float(K[0, 0])
+        # K is even (K(-h) = K(h)), its spectrum is real
+        self.Khat = np.fft.rfft2(K).real
+        LinearOperator.__init__(self, dtype=np.float64, shape=(nx * nz, nx * nz))
+
+    def _matvec(self, x):
+        return self._matmat(np.reshape(x, (-1, 1))).ravel()
+
+    def _matmat(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X.reshape(-1, 1)
+        ncol = X.shape[1]
+        Y = np.empty((self.shape[0], ncol))
+        nb = max(1, int(self.max_mb * 1024 * 1024 / (16 * self.Khat.size)))
+        for n0 in range(0, ncol, nb):
+            n1 = min(n0 + nb, ncol)
+            B = X[:, n0:n1].T.reshape(n1 - n0, self.nx, self.nz)
+            F = np.fft.rfft2(B, s=(self.Nx, self.Nz))
+            F *= self.Khat
+            B = np.fft.irfft2(F, s=(self.Nx, self.Nz))[:, :self.nx, :self.nz]
+            Y[:, n0:n1] = B.reshape(n1 - n0, -1).T
+        if self.nugget != 0:
+            Y += self.nugget * X
+        return Y
+
+    def _adjoint(self):
+        return self
+
+    def diagonal(self):
+        """
+        Variance at the cells
+        """
+        return np.full((self.shape[0],), self.c0 + self.nugget)
+
+    def LCmLt(self, L, return_CmLt=False, chunk_size=256):
+        """
+        Covariance of the data, L*Cm*L'
+
+        Input:
+            L: ray projection matrix (ndata x ncell), sparse
+            return_CmLt: also return Cm*L'
+            chunk_size: number of rows of L processed at once
+        Output:
+            LCmLt: ndata x ndata array
+            CmLt: ncell x ndata array (if return_CmLt is true)
+        """
+        L = csr_matrix(L)
+        ndata = L.shape[0]
+        LCmLt = np.empty((ndata, ndata))
+        CmLt = np.empty((self.shape[0], ndata)) if return_CmLt else None
+        for n0 in range(0, ndata, chunk_size):
+            n1 = min(n0 + chunk_size, ndata)
+            Y = self._matmat(L[n0:n1, :].T.toarray())
+            LCmLt[:, n0:n1] = L @ Y
+            if return_CmLt:
+                CmLt[:, n0:n1] = Y
+        if return_CmLt:
+            return LCmLt, CmLt
+        return LCmLt
+
+
+def compactCovariance(cm, x, support=1.0):
+    """
+    Sparse approximation of the covariance matrix cm.compute(x, x), holding
+    only the covariances of points closer than support times the largest
+    range of the structures of cm
+
+    Covariances are tapered (Furrer et al., 2006, J. Comput. Graph. Stat.
+    15(3), 502-523): they are multiplied by a spherical covariance of range
+    support * rmax, so that the approximation remains positive definite.
+
+    Input:
+        cm: CovarianceModel instance, without xi and tilt
+        x: coordinates of the points (n x ndim)
+        support: radius of the approximation, in units of the largest range
+    Output:
+        C: n x n CSR matrix
+    """
+    if cm.use_xi or cm.use_tilt:
+        raise ValueError('Compact approximation not implemented for anisotropic models')
+    rmax = max([np.max(c.range) for c in cm.covar if c.type != CovarianceFactory.Nugget] + [0.0])
+    tree = cKDTree(x)
+    pairs = tree.sparse_distance_matrix(tree, support * rmax, output_type='ndarray')
+    i = np.concatenate((pairs['i'], np.arange(x.shape[0])))
+    j = np.concatenate((pairs['j'], np.arange(x.shape[0])))
+    # pairs of distinct points, and the points themselves
+    keep = np.concatenate((pairs['i'] != pairs['j'], np.ones((x.shape[0],), dtype=bool)))
+    i = i[keep]
+    j = j[keep]
+
+    h = x[i, :] - x[j, :]
+    v = 0
+    for c in cm.covar:
+        v = v + np.ravel(c.compute(h, np.zeros((1, x.shape[1]))))
+    r = np.minimum(np.sqrt(np.sum(h * h, axis=1)) / (support * rmax), 1.0) if rmax > 0 else 0.0
+    v = v * (1.0 - 1.5 * r + 0.5 * r**3) + cm.nugget_model * (i == j)
+    return csr_matrix((v, (i, j)), shape=(x.shape[0], x.shape[0]))
+
+
 def cokri(x, x0, cm, itype, avg, block, nd, ival, nk, rad, ntok, verbose=False):
     """
     Translation of cokri matlab function from D. Marcotte (adapted
@@ -820,7 +820,11 @@ class CovarUI(QtWidgets.QFrame):
         if self.model.grid.type == '2D' or self.model.grid.type == '2D+':
             xc = self.temp_grid.getCellCenter()
             cm = self.current_covar()
-            Cm = cm.compute(xc, xc)
+            if not (cm.use_xi or cm.use_tilt):
+                # L*Cm*L' is formed without storing Cm
+                Cm = self.temp_grid.covarianceOperator(cm)
+            else:
+                Cm = cm.compute(xc, xc)
 
             s = (self.data[:, 0].reshape(-1) / np.sum(self.L, 1).reshape(-1)).T
             s0 = np.mean(s)
@@ -841,7 +845,10 @@ class CovarUI(QtWidgets.QFrame):
                     xi0 = np.ones([int(np_), 1])
                     J = covar.computeJ(self.L, np.concatenate([s0, xi0]))
                     Cm = J.dot(np.dot(Cm.toarray(), J.T))
+            elif isinstance(Cm, covar.CovarianceOperator):
+                Cm = Cm.LCmLt(self.L)
             else:
+                # tilt is ignored without xi
                 Cm = self.L.dot(Cm.dot(self.L.T.toarray()))
 
             if cm.use_c0:
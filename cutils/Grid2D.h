@@ -86,6 +86,9 @@ namespace ttcr {
         virtual size_t getNumberOfNodes() const { return 0; }
         virtual size_t getNumberOfCells() const { return 0; }
         
+        virtual void getTT(std::vector<T1>& tt, const size_t threadNo=0) const {}
+        virtual T1 getTraveltimeFromTT(const S& Rx, const std::vector<T1>& tt) const { return 0; }
+        
         virtual void saveTT(const std::string &, const int, const size_t nt=0,
                             const bool vtkFormat=0) const {}
         
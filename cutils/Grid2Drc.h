@@ -52,6 +52,13 @@ namespace ttcr {
         size_t getNumberOfNodes() const { return nodes.size(); }
         size_t getNumberOfCells() const { return ncx*ncz; }
         
+        void getTT(std::vector<T1>& tt, const size_t threadNo=0) const {
+            tt.resize( nodes.size() );
+            for ( size_t n=0; n<nodes.size(); ++n ) {
+                tt[n] = nodes[n].getTT(threadNo);
+            }
+        }
+        
         T2 getCellNo(const sxz<T1>& pt) const {
             T1 x = xmax-pt.x < small ? xmax-.5*dx : pt.x;
             T1 z = zmax-pt.z < small ? zmax-.5*dz : pt.z;
@@ -0,0 +1,591 @@
+//
+//  Grid2Drcfm.h
+//  ttcr
+//
+//  Rectilinear 2D grid with slowness defined on cells, traveltimes computed
+//  with the fast marching method on a refined grid of nodes.
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+/*
+ * Each cell is divided in nsx by nsz sub-cells, where nsx = nsnx+1 and
+ * nsz = nsnz+1, so that nodes lie on cell edges at the same positions as
+ * the secondary nodes of Grid2Drcsp.  Travel times at nodes are obtained
+ * with a first order fast marching scheme applied to the factored eikonal
+ * equation (Treister and Haber, 2016), t = t0 + T0*tau with T0 the travel
+ * time in a homogeneous medium having the slowness at the source.  Local
+ * updates use, for each sub-cell, the upwind differences of tau when the
+ * two adjacent nodes on the sub-cell edges are frozen, as well as the
+ * transmission along the edges and the diagonal of the sub-cell.  One-sided
+ * factored updates are not used, they assume tau constant across layer
+ * interfaces and underestimate travel times.  Nodes of the cell
+ * holding the source and its neighbours are initialized with straight ray
+ * travel times.
+ *
+ * Traveltimes at receivers are interpolated bilinearly, and ray paths are
+ * traced back from the receivers to the source following the opposite of
+ * the travel time gradient.
+ */
+
+#ifndef Grid2Drcfm_h
+#define Grid2Drcfm_h
+
+#include <algorithm>
+#include <cmath>
+#include <functional>
+#include <iostream>
+#include <limits>
+#include <queue>
+#include <utility>
+#include <vector>
+
+#include "Grid2D.h"
+
+namespace ttcr {
+
+    template<typename T1, typename T2>
+    class Grid2Drcfm : public Grid2D<T1,T2,sxz<T1>> {
+    public:
+        Grid2Drcfm(const T2 nx, const T2 nz, const T1 ddx, const T1 ddz,
+                   const T1 minx, const T1 minz, const T2 nnx, const T2 nnz,
+                   const size_t nt=1);
+
+        virtual ~Grid2Drcfm() {
+        }
+
+        int setSlowness(const std::vector<T1>& s) {
+            if ( s.size() != slowness.size() ) {
+                return 1;
+            }
+            slowness = s;
+            return 0;
+        }
+
+        int raytrace(const std::vector<sxz<T1>>& Tx,
+                     const std::vector<T1>& t0,
+                     const std::vector<sxz<T1>>& Rx,
+                     std::vector<T1>& traveltimes,
+                     const size_t threadNo=0) const;
+
+        int raytrace(const std::vector<sxz<T1>>& Tx,
+                     const std::vector<T1>& t0,
+                     const std::vector<sxz<T1>>& Rx,
+                     std::vector<T1>& traveltimes,
+                     std::vector<std::vector<sxz<T1>>>& r_data,
+                     const size_t threadNo=0) const;
+
+        int raytrace(const std::vector<sxz<T1>>& Tx,
+                     const std::vector<T1>& t0,
+                     const std::vector<sxz<T1>>& Rx,
+                     std::vector<T1>& traveltimes,
+                     std::vector<std::vector<sxz<T1>>>& r_data,
+                     std::vector<std::vector<siv2<T1>>>& l_data,
+                     const size_t threadNo=0) const;
+
+        int raytrace(const std::vector<sxz<T1>>& Tx,
+                     const std::vector<T1>& t0,
+                     const std::vector<sxz<T1>>& Rx,
+                     std::vector<T1>& traveltimes,
+                     std::vector<std::vector<siv2<T1>>>& l_data,
+                     const size_t threadNo=0) const;
+
+        size_t getNumberOfNodes() const { return nnx*nnz; }
+        size_t getNumberOfCells() const { return ncx*ncz; }
+
+        void getTT(std::vector<T1>& t, const size_t threadNo=0) const {
+            t = tt[threadNo];
+        }
+        T1 getTraveltimeFromTT(const sxz<T1>& Rx, const std::vector<T1>& t) const {
+            return interpTT(Rx, t);
+        }
+
+        const size_t getNthreads() const { return nThreads; }
+        const T1 getXmin() const { return xmin; }
+        const T1 getZmin() const { return zmin; }
+        const T1 getDx() const { return dx; }
+        const T1 getDz() const { return dz; }
+        const T2 getNcx() const { return ncx; }
+        const T2 getNcz() const { return ncz; }
+
+    private:
+        size_t nThreads;
+        T1 dx;           // cell size in x
+        T1 dz;           // cell size in z
+        T1 xmin;         // x origin of the grid
+        T1 zmin;         // z origin of the grid
+        T1 xmax;         // x end of the grid
+        T1 zmax;         // z end of the grid
+        T2 ncx;          // number of cells in x
+        T2 ncz;          // number of cells in z
+        T2 nsx;          // number of sub-cells per cell in x
+        T2 nsz;          // number of sub-cells per cell in z
+        T1 hx;           // sub-cell size in x
+        T1 hz;           // sub-cell size in z
+        T2 nnx;          // number of nodes in x
+        T2 nnz;          // number of nodes in z
+
+        std::vector<T1> slowness;  // column-wise (z axis) slowness vector of the cells
+        mutable std::vector<std::vector<T1>> tt;  // travel times at nodes, for each thread
+
+        Grid2Drcfm() {}
+
+        T2 nodeNo(const T2 i, const T2 k) const { return i*nnz + k; }
+
+        // slowness of sub-cell (i,k), i.e. of the cell holding it
+        T1 subSlowness(const T2 i, const T2 k) const {
+            return slowness[ (i/nsx)*ncz + k/nsz ];
+        }
+
+        T2 getCellNo(const sxz<T1>& pt) const {
+            T1 x = xmax-pt.x < small ? xmax-.5*dx : pt.x;
+            T1 z = zmax-pt.z < small ? zmax-.5*dz : pt.z;
+            T2 nx = static_cast<T2>( small + (x-xmin)/dx );
+            T2 nz = static_cast<T2>( small + (z-zmin)/dz );
+            return nx*ncz + nz;
+        }
+
+        int checkPts(const std::vector<sxz<T1>>& pts) const;
+
+        void solve(const std::vector<sxz<T1>>& Tx,
+                   const std::vector<T1>& t0,
+                   const size_t threadNo) const;
+
+        T1 localUpdate(const T2 i, const T2 k, const T2 m,
+                       const sxz<T1>& Tx, const T1 t0, const T1 s0,
+                       const std::vector<T1>& t,
+                       const std::vector<bool>& frozen) const;
+
+        T1 straightRayTime(const sxz<T1>& a, const sxz<T1>& b) const;
+
+        void subCell(const sxz<T1>& pt, T2& i, T2& k) const;
+
+        T1 interpTT(const sxz<T1>& Rx, const std::vector<T1>& t) const;
+
+        void getRaypath(const std::vector<sxz<T1>>& Tx,
+                        const T1 t0,
+                        const sxz<T1>& Rx,
+                        std::vector<sxz<T1>>& r_data,
+                        const size_t threadNo) const;
+
+        void getLdata(const std::vector<sxz<T1>>& r_data,
+                      std::vector<siv2<T1>>& l_data) const;
+    };
+
+    template<typename T1, typename T2>
+    Grid2Drcfm<T1,T2>::Grid2Drcfm(const T2 nx, const T2 nz, const T1 ddx, const T1 ddz,
+                                  const T1 minx, const T1 minz, const T2 nnx_, const T2 nnz_,
+                                  const size_t nt) : nThreads(nt),
+    dx(ddx), dz(ddz), xmin(minx), zmin(minz), xmax(minx+nx*ddx), zmax(minz+nz*ddz),
+    ncx(nx), ncz(nz), nsx(nnx_+1), nsz(nnz_+1), hx(ddx/(nnx_+1)), hz(ddz/(nnz_+1)),
+    nnx(nx*(nnx_+1)+1), nnz(nz*(nnz_+1)+1),
+    slowness(std::vector<T1>(nx*nz)),
+    tt(std::vector<std::vector<T1>>(nt, std::vector<T1>(nnx*nnz)))
+    { }
+
+    template<typename T1, typename T2>
+    int Grid2Drcfm<T1,T2>::checkPts(const std::vector<sxz<T1>>& pts) const {
+        for (size_t n=0; n<pts.size(); ++n) {
+            if ( pts[n].x < xmin || pts[n].x > xmax ||
+                pts[n].z < zmin || pts[n].z > zmax ) {
+                std::cerr << "Error: point no " << (n+1)
+                << " outside the grid.\n";
+                return 1;
+            }
+        }
+        return 0;
+    }
+
+    template<typename T1, typename T2>
+    void Grid2Drcfm<T1,T2>::subCell(const sxz<T1>& pt, T2& i, T2& k) const {
+        // sub-cell holding pt, points on the far edges belong to the last sub-cell
+        T1 x = (pt.x-xmin)/hx;
+        T1 z = (pt.z-zmin)/hz;
+        i = x <= 0 ? 0 : static_cast<T2>( x );
+        k = z <= 0 ? 0 : static_cast<T2>( z );
+        if ( i > nnx-2 ) i = nnx-2;
+        if ( k > nnz-2 ) k = nnz-2;
+    }
+
+    template<typename T1, typename T2>
+    T1 Grid2Drcfm<T1,T2>::straightRayTime(const sxz<T1>& a, const sxz<T1>& b) const {
+
+        // integral of slowness along segment ab, using the crossings with cell edges
+        std::vector<T1> u(1, 0.0);
+        T1 ddx = b.x - a.x;
+        T1 ddz = b.z - a.z;
+        if ( std::abs(ddx) > small*hx ) {
+            T1 x1 = ddx > 0 ? a.x : b.x;
+            T1 x2 = ddx > 0 ? b.x : a.x;
+            for ( T1 x=xmin+dx*std::ceil((x1-xmin)/dx); x<x2; x+=dx ) {
+                u.push_back( (x-a.x)/ddx );
+            }
+        }
+        if ( std::abs(ddz) > small*hz ) {
+            T1 z1 = ddz > 0 ? a.z : b.z;
+            T1 z2 = ddz > 0 ? b.z : a.z;
+            for ( T1 z=zmin+dz*std::ceil((z1-zmin)/dz); z<z2; z+=dz ) {
+                u.push_back( (z-a.z)/ddz );
+            }
+        }
+        u.push_back( 1.0 );
+        std::sort(u.begin(), u.end());
+
+        T1 len = std::sqrt( ddx*ddx + ddz*ddz );
+        T1 t = 0.0;
+        for ( size_t n=1; n<u.size(); ++n ) {
+            T1 um = 0.5*(u[n-1]+u[n]);
+            sxz<T1> mid(a.x+um*ddx, a.z+um*ddz);
+            t += (u[n]-u[n-1])*len*slowness[ getCellNo(mid) ];
+        }
+        return t;
+    }
+
+    template<typename T1, typename T2>
+    T1 Grid2Drcfm<T1,T2>::localUpdate(const T2 i, const T2 k, const T2 m,
+                                      const sxz<T1>& Tx, const T1 t0, const T1 s0,
+                                      const std::vector<T1>& t,
+                                      const std::vector<bool>& frozen) const {
+
+        // smallest travel time at node (i,k) from the frozen nodes of the
+        // sub-cells shared with node m, the node just frozen
+
+        // factored form t = t0 + T0*tau, T0 = s0*|x-Tx|
+        // nodes closer than dmin to the source are considered at the source
+        T1 dmin = small*std::min(hx, hz);
+        sxz<T1> pn(xmin+i*hx, zmin+k*hz);
+        T1 dist = pn.getDistance(Tx);
+        if ( dist < dmin ) dist = 0.0;
+        T1 T0 = s0*dist;
+        T1 T0x = dist > 0.0 ? s0*(pn.x-Tx.x)/dist : 0.0;
+        T1 T0z = dist > 0.0 ? s0*(pn.z-Tx.z)/dist : 0.0;
+
+        T1 tmin = std::numeric_limits<T1>::max();
+        T1 hd = std::sqrt(hx*hx + hz*hz);
+        for ( int di=-1; di<=1; di+=2 ) {
+            if ( (di<0 && i==0) || (di>0 && i==nnx-1) ) continue;
+            for ( int dk=-1; dk<=1; dk+=2 ) {
+                if ( (dk<0 && k==0) || (dk>0 && k==nnz-1) ) continue;
+
+                T2 nA = nodeNo(i+di, k);     // neighbour along x
+                T2 nB = nodeNo(i, k+dk);     // neighbour along z
+                T2 nC = nodeNo(i+di, k+dk);  // opposite corner
+                if ( m != nA && m != nB && m != nC ) continue;
+
+                T1 s = subSlowness( di<0 ? i-1 : i, dk<0 ? k-1 : k );
+                bool fA = frozen[nA];
+                bool fB = frozen[nB];
+
+                // transmission along edges and diagonal of the sub-cell
+                if ( fA ) tmin = std::min(tmin, t[nA] + hx*s);
+                if ( fB ) tmin = std::min(tmin, t[nB] + hz*s);
+                if ( frozen[nC] ) tmin = std::min(tmin, t[nC] + hd*s);
+
+                if ( T0 == 0.0 || !(fA && fB) ) continue;
+
+                // upwind differences of tau, (a*tau - b) is the derivative of t
+                T1 ax = T0x, bx = 0.0, az = T0z, bz = 0.0;
+                if ( fA ) {
+                    T1 dA = sxz<T1>(xmin+(i+di)*hx, pn.z).getDistance(Tx);
+                    if ( dA < dmin ) continue;
+                    T1 T0A = s0*dA;
+                    ax += -di*T0/hx;
+                    bx = -di*T0*(t[nA]-t0)/T0A/hx;
+                }
+                if ( fB ) {
+                    T1 dB = sxz<T1>(pn.x, zmin+(k+dk)*hz).getDistance(Tx);
+                    if ( dB < dmin ) continue;
+                    T1 T0B = s0*dB;
+                    az += -dk*T0/hz;
+                    bz = -dk*T0*(t[nB]-t0)/T0B/hz;
+                }
+                T1 qa = ax*ax + az*az;
+                T1 qb = ax*bx + az*bz;
+                T1 disc = qb*qb - qa*(bx*bx + bz*bz - s*s);
+                if ( qa == 0.0 || disc < 0.0 ) continue;
+                T1 tp = t0 + T0*(qb + std::sqrt(disc))/qa;
+                // causality
+                if ( (!fA || tp >= t[nA]) && (!fB || tp >= t[nB]) ) {
+                    tmin = std::min(tmin, tp);
+                }
+            }
+        }
+        return tmin;
+    }
+
+    template<typename T1, typename T2>
+    void Grid2Drcfm<T1,T2>::solve(const std::vector<sxz<T1>>& Tx,
+                                  const std::vector<T1>& t0,
+                                  const size_t threadNo) const {
+
+        std::vector<T1>& t = tt[threadNo];
+        std::fill(t.begin(), t.end(), std::numeric_limits<T1>::max());
+        std::vector<bool> frozen( t.size(), false );
+
+        typedef std::pair<T1,T2> heapElem;
+        std::priority_queue<heapElem, std::vector<heapElem>, std::greater<heapElem>> narrowBand;
+
+        // nodes of the cells around the sources get straight ray travel times
+        for ( size_t ns=0; ns<Tx.size(); ++ns ) {
+            T2 cellNo = getCellNo( Tx[ns] );
+            T2 ic = cellNo / ncz;
+            T2 kc = cellNo % ncz;
+            T2 i1 = ic > 0 ? (ic-1)*nsx : 0;
+            T2 i2 = std::min(ic+2, ncx)*nsx;
+            T2 k1 = kc > 0 ? (kc-1)*nsz : 0;
+            T2 k2 = std::min(kc+2, ncz)*nsz;
+            for ( T2 i=i1; i<=i2; ++i ) {
+                for ( T2 k=k1; k<=k2; ++k ) {
+                    sxz<T1> pt(xmin+i*hx, zmin+k*hz);
+                    T1 tn = t0[ns] + straightRayTime(Tx[ns], pt);
+                    T2 n = nodeNo(i, k);
+                    if ( tn < t[n] ) {
+                        t[n] = tn;
+                        narrowBand.push( heapElem(tn, n) );
+                    }
+                }
+            }
+        }
+
+        // the factored form uses the first source and the slowness at its location
+        T1 s0 = slowness[ getCellNo(Tx[0]) ];
+
+        while ( !narrowBand.empty() ) {
+            heapElem e = narrowBand.top();
+            narrowBand.pop();
+            T2 n = e.second;
+            if ( frozen[n] || e.first > t[n] ) {
+                continue;  // outdated entry
+            }
+            frozen[n] = true;
+
+            T2 i = n / nnz;
+            T2 k = n % nnz;
+            T2 i1 = i > 0 ? i-1 : 0;
+            T2 i2 = i < nnx-1 ? i+1 : i;
+            T2 k1 = k > 0 ? k-1 : 0;
+            T2 k2 = k < nnz-1 ? k+1 : k;
+            for ( T2 ii=i1; ii<=i2; ++ii ) {
+                for ( T2 kk=k1; kk<=k2; ++kk ) {
+                    T2 nn = nodeNo(ii, kk);
+                    if ( frozen[nn] ) continue;
+                    T1 tn = localUpdate(ii, kk, n, Tx[0], t0[0], s0, t, frozen);
+                    if ( tn < t[nn] ) {
+                        t[nn] = tn;
+                        narrowBand.push( heapElem(tn, nn) );
+                    }
+                }
+            }
+        }
+    }
+
+    template<typename T1, typename T2>
+    T1 Grid2Drcfm<T1,T2>::interpTT(const sxz<T1>& Rx, const std::vector<T1>& t) const {
+        T2 i, k;
+        subCell(Rx, i, k);
+        T1 u = (Rx.x - (xmin+i*hx))/hx;
+        T1 w = (Rx.z - (zmin+k*hz))/hz;
+        return (1.-u)*(1.-w)*t[nodeNo(i,k)] + u*(1.-w)*t[nodeNo(i+1,k)] +
+        (1.-u)*w*t[nodeNo(i,k+1)] + u*w*t[nodeNo(i+1,k+1)];
+    }
+
+    template<typename T1, typename T2>
+    void Grid2Drcfm<T1,T2>::getRaypath(const std::vector<sxz<T1>>& Tx,
+                                       const T1 t0,
+                                       const sxz<T1>& Rx,
+                                       std::vector<sxz<T1>>& r_data,
+                                       const size_t threadNo) const {
+
+        // steepest descent from Rx, the path is returned from Tx to Rx.
+        // The gradient is computed from the factored form t = t0 + T0*tau,
+        // with tau interpolated bilinearly, which yields straight rays in
+        // homogeneous regions around the source.
+        const std::vector<T1>& t = tt[threadNo];
+        T1 h = 0.5*std::min(hx, hz);
+        T1 dmin = small*std::min(hx, hz);
+        T1 s0 = slowness[ getCellNo(Tx[0]) ];
+        size_t maxStep = 10*(nnx + nnz);
+
+        r_data.clear();
+        r_data.push_back( Rx );
+        sxz<T1> pt = Rx;
+        for ( size_t step=0; step<maxStep; ++step ) {
+
+            // stop when a source is reached
+            bool reached = false;
+            for ( size_t ns=0; ns<Tx.size(); ++ns ) {
+                if ( pt.getDistance(Tx[ns]) <= h ) {
+                    if ( pt.getDistance(Tx[ns]) > dmin ) {
+                        r_data.push_back( Tx[ns] );
+                    }
+                    reached = true;
+                    break;
+                }
+            }
+            if ( reached ) break;
+
+            T2 i, k;
+            subCell(pt, i, k);
+            T1 u = (pt.x - (xmin+i*hx))/hx;
+            T1 w = (pt.z - (zmin+k*hz))/hz;
+            T1 tau[2][2];
+            for ( T2 a=0; a<2; ++a ) {
+                for ( T2 b=0; b<2; ++b ) {
+                    T1 d = sxz<T1>(xmin+(i+a)*hx, zmin+(k+b)*hz).getDistance(Tx[0]);
+                    tau[a][b] = d > dmin ? (t[nodeNo(i+a,k+b)]-t0)/(s0*d) : 1.0;
+                }
+            }
+            T1 taup = (1.-u)*(1.-w)*tau[0][0] + u*(1.-w)*tau[1][0] +
+            (1.-u)*w*tau[0][1] + u*w*tau[1][1];
+            T1 taux = ((1.-w)*(tau[1][0]-tau[0][0]) + w*(tau[1][1]-tau[0][1]))/hx;
+            T1 tauz = ((1.-u)*(tau[0][1]-tau[0][0]) + u*(tau[1][1]-tau[1][0]))/hz;
+            T1 d = pt.getDistance(Tx[0]);
+            T1 gx = s0*(taup*(pt.x-Tx[0].x)/d + d*taux);
+            T1 gz = s0*(taup*(pt.z-Tx[0].z)/d + d*tauz);
+            T1 g = std::sqrt( gx*gx + gz*gz );
+            if ( g == 0.0 ) break;
+
+            pt.x -= h*gx/g;
+            pt.z -= h*gz/g;
+            pt.x = std::min(std::max(pt.x, xmin), xmax);
+            pt.z = std::min(std::max(pt.z, zmin), zmax);
+            r_data.push_back( pt );
+        }
+        std::reverse(r_data.begin(), r_data.end());
+    }
+
+    template<typename T1, typename T2>
+    void Grid2Drcfm<T1,T2>::getLdata(const std::vector<sxz<T1>>& r_data,
+                                     std::vector<siv2<T1>>& l_data) const {
+
+        // length of ray segments within cells, sorted by cell index
+        std::vector<std::pair<T2,T1>> seg;
+        for ( size_t n=1; n<r_data.size(); ++n ) {
+            const sxz<T1>& a = r_data[n-1];
+            const sxz<T1>& b = r_data[n];
+            std::vector<T1> u(1, 0.0);
+            T1 ddx = b.x - a.x;
+            T1 ddz = b.z - a.z;
+            if ( std::abs(ddx) > 0.0 ) {
+                T1 x1 = ddx > 0 ? a.x : b.x;
+                T1 x2 = ddx > 0 ? b.x : a.x;
+                for ( T1 x=xmin+dx*std::ceil((x1-xmin)/dx); x<x2; x+=dx ) {
+                    u.push_back( (x-a.x)/ddx );
+                }
+            }
+            if ( std::abs(ddz) > 0.0 ) {
+                T1 z1 = ddz > 0 ? a.z : b.z;
+                T1 z2 = ddz > 0 ? b.z : a.z;
+                for ( T1 z=zmin+dz*std::ceil((z1-zmin)/dz); z<z2; z+=dz ) {
+                    u.push_back( (z-a.z)/ddz );
+                }
+            }
+            u.push_back( 1.0 );
+            std::sort(u.begin(), u.end());
+            T1 len = std::sqrt( ddx*ddx + ddz*ddz );
+            for ( size_t nu=1; nu<u.size(); ++nu ) {
+                T1 um = 0.5*(u[nu-1]+u[nu]);
+                sxz<T1> mid(a.x+um*ddx, a.z+um*ddz);
+                seg.push_back( std::make_pair(getCellNo(mid), (u[nu]-u[nu-1])*len) );
+            }
+        }
+        std::sort(seg.begin(), seg.end());
+
+        l_data.clear();
+        for ( size_t n=0; n<seg.size(); ++n ) {
+            if ( seg[n].second == 0.0 ) continue;
+            if ( !l_data.empty() && l_data.back().i == seg[n].first ) {
+                l_data.back().v += seg[n].second;
+            } else {
+                siv2<T1> s;
+                s.i = seg[n].first;
+                s.v = seg[n].second;
+                s.v2 = 0.0;
+                l_data.push_back( s );
+            }
+        }
+    }
+
+    template<typename T1, typename T2>
+    int Grid2Drcfm<T1,T2>::raytrace(const std::vector<sxz<T1>>& Tx,
+                                    const std::vector<T1>& t0,
+                                    const std::vector<sxz<T1>>& Rx,
+                                    std::vector<T1>& traveltimes,
+                                    const size_t threadNo) const {
+
+        if ( checkPts(Tx) == 1 ) return 1;
+        if ( checkPts(Rx) == 1 ) return 1;
+
+        solve(Tx, t0, threadNo);
+
+        traveltimes.resize( Rx.size() );
+        for ( size_t n=0; n<Rx.size(); ++n ) {
+            traveltimes[n] = interpTT(Rx[n], tt[threadNo]);
+        }
+        return 0;
+    }
+
+    template<typename T1, typename T2>
+    int Grid2Drcfm<T1,T2>::raytrace(const std::vector<sxz<T1>>& Tx,
+                                    const std::vector<T1>& t0,
+                                    const std::vector<sxz<T1>>& Rx,
+                                    std::vector<T1>& traveltimes,
+                                    std::vector<std::vector<sxz<T1>>>& r_data,
+                                    const size_t threadNo) const {
+
+        if ( raytrace(Tx, t0, Rx, traveltimes, threadNo) == 1 ) return 1;
+
+        r_data.resize( Rx.size() );
+        for ( size_t n=0; n<Rx.size(); ++n ) {
+            getRaypath(Tx, t0[0], Rx[n], r_data[n], threadNo);
+        }
+        return 0;
+    }
+
+    template<typename T1, typename T2>
+    int Grid2Drcfm<T1,T2>::raytrace(const std::vector<sxz<T1>>& Tx,
+                                    const std::vector<T1>& t0,
+                                    const std::vector<sxz<T1>>& Rx,
+                                    std::vector<T1>& traveltimes,
+                                    std::vector<std::vector<sxz<T1>>>& r_data,
+                                    std::vector<std::vector<siv2<T1>>>& l_data,
+                                    const size_t threadNo) const {
+
+        if ( raytrace(Tx, t0, Rx, traveltimes, r_data, threadNo) == 1 ) return 1;
+
+        l_data.resize( Rx.size() );
+        for ( size_t n=0; n<Rx.size(); ++n ) {
+            getLdata(r_data[n], l_data[n]);
+        }
+        return 0;
+    }
+
+    template<typename T1, typename T2>
+    int Grid2Drcfm<T1,T2>::raytrace(const std::vector<sxz<T1>>& Tx,
+                                    const std::vector<T1>& t0,
+                                    const std::vector<sxz<T1>>& Rx,
+                                    std::vector<T1>& traveltimes,
+                                    std::vector<std::vector<siv2<T1>>>& l_data,
+                                    const size_t threadNo) const {
+
+        std::vector<std::vector<sxz<T1>>> r_data;
+        return raytrace(Tx, t0, Rx, traveltimes, r_data, l_data, threadNo);
+    }
+
+}
+
+#endif /* Grid2Drcfm_h */
@@ -91,17 +91,19 @@ namespace ttcr {
                      const std::vector<T1>& t0,
                      const std::vector<sxz<T1>>& Rx,
                      std::vector<T1>& traveltimes,
-                     std::vector<std::vector<sxz<double>>>& r_data,
-                     std::vector<std::vector<siv2<double>>>& l_data,
+                     std::vector<std::vector<sxz<T1>>>& r_data,
+                     std::vector<std::vector<siv2<T1>>>& l_data,
                      const size_t threadNo=0) const;
 
         int raytrace(const std::vector<sxz<T1>>& Tx,
                      const std::vector<T1>& t0,
                      const std::vector<sxz<T1>>& Rx,
                      std::vector<T1>& traveltimes,
-                     std::vector<std::vector<siv2<double>>>& l_data,
+                     std::vector<std::vector<siv2<T1>>>& l_data,
                      const size_t threadNo=0) const;
 
+        T1 getTraveltimeFromTT(const sxz<T1>& Rx, const std::vector<T1>& tt) const;
+        
         const T2 getNsnx() const { return nsnx; }
         const T2 getNsnz() const { return nsnz; }
         
@@ -536,9 +538,9 @@ namespace ttcr {
             std::vector<Node2Dcsp<T1,T2>> *node_p;
             node_p = &(this->nodes);
             
-            std::vector<sxz<double>> r_tmp;
+            std::vector<sxz<T1>> r_tmp;
             T2 iChild, iParent = nodeParentRx;
-            sxz<double> child;
+            sxz<T1> child;
             
             // store the son's coord
             child.x = Rx[n].x;
@@ -707,8 +709,8 @@ namespace ttcr {
                                          const std::vector<T1>& t0,
                                          const std::vector<sxz<T1>>& Rx,
                                          std::vector<T1>& traveltimes,
-                                         std::vector<std::vector<sxz<double>>>& r_data,
-                                         std::vector<std::vector<siv2<double>>>& l_data,
+                                         std::vector<std::vector<sxz<T1>>>& r_data,
+                                         std::vector<std::vector<siv2<T1>>>& l_data,
                                          const size_t threadNo) const {
         
 //        std::cout << "in raytrace " << Tx[0].z << '\t' << threadNo << '\n';
@@ -758,10 +760,10 @@ namespace ttcr {
             std::vector<Node2Dcsp<T1,T2>> *node_p;
             node_p = &(this->nodes);
             
-            std::vector<sxz<double>> r_tmp;
+            std::vector<sxz<T1>> r_tmp;
             T2 iChild, iParent = nodeParentRx;
-            sxz<double> child;
-            siv2<double> cell;
+            sxz<T1> child;
+            siv2<T1> cell;
             
             // store the son's coord
             child.x = Rx[n].x;
@@ -841,7 +843,7 @@ namespace ttcr {
                                          const std::vector<T1>& t0,
                                          const std::vector<sxz<T1>>& Rx,
                                          std::vector<T1>& traveltimes,
-                                         std::vector<std::vector<siv2<double>>>& l_data,
+                                         std::vector<std::vector<siv2<T1>>>& l_data,
                                          const size_t threadNo) const {
         
         if ( this->checkPts(Tx) == 1 ) return 1;
@@ -884,8 +886,8 @@ namespace ttcr {
             node_p = &(this->nodes);
             
             T2 iChild, iParent = nodeParentRx;
-            sxz<double> child;
-            siv2<double> cell;
+            sxz<T1> child;
+            siv2<T1> cell;
             
             // store the son's coord
             child.x = Rx[n].x;
@@ -995,13 +997,15 @@ namespace ttcr {
                                              const std::vector<Node2Dcsp<T1,T2>>& nodes,
                                              const size_t threadNo) const {
         
-        for ( size_t nn=0; nn<nodes.size(); ++nn ) {
+        // a node coinciding with Rx belongs to the cell containing Rx
+        T2 cellNo = this->getCellNo( Rx );
+        for ( size_t k=0; k< this->neighbors[cellNo].size(); ++k ) {
+            T2 nn = this->neighbors[cellNo][k];
             if ( nodes[nn] == Rx ) {
                 return nodes[nn].getTT(threadNo);
             }
         }
         
-        T2 cellNo = this->getCellNo( Rx );
         T2 neibNo = this->neighbors[cellNo][0];
         T1 dt = this->cells.computeDt(nodes[neibNo], Rx, cellNo);
         
@@ -1017,13 +1021,46 @@ namespace ttcr {
     }
     
     
+    template<typename T1, typename T2, typename CELL>
+    T1 Grid2Drcsp<T1,T2,CELL>::getTraveltimeFromTT(const sxz<T1>& Rx,
+                                                   const std::vector<T1>& tt) const {
+        
+        // same as getTraveltime, with travel times of the nodes given in tt
+        // (as returned by getTT).  A node coinciding with Rx necessarily
+        // belongs to the cell containing Rx, only those are checked.
+        T2 cellNo = this->getCellNo( Rx );
+        for ( size_t k=0; k< this->neighbors[cellNo].size(); ++k ) {
+            T2 neibNo = this->neighbors[cellNo][k];
+            if ( this->nodes[neibNo] == Rx ) {
+                return tt[neibNo];
+            }
+        }
+        
+        T2 neibNo = this->neighbors[cellNo][0];
+        T1 dt = this->cells.computeDt(this->nodes[neibNo], Rx, cellNo);
+        
+        T1 traveltime = tt[neibNo]+dt;
+        for ( size_t k=1; k< this->neighbors[cellNo].size(); ++k ) {
+            neibNo = this->neighbors[cellNo][k];
+            dt = this->cells.computeDt(this->nodes[neibNo], Rx, cellNo);
+            if ( traveltime > tt[neibNo]+dt ) {
+                traveltime =  tt[neibNo]+dt;
+            }
+        }
+        return traveltime;
+    }
+    
+    
     template<typename T1, typename T2, typename CELL>
     T1 Grid2Drcsp<T1,T2,CELL>::getTraveltime(const sxz<T1>& Rx,
                                              const std::vector<Node2Dcsp<T1,T2>>& nodes,
                                              T2& nodeParentRx, T2& cellParentRx,
                                              const size_t threadNo) const {
         
-        for ( size_t nn=0; nn<nodes.size(); ++nn ) {
+        // a node coinciding with Rx belongs to the cell containing Rx
+        T2 cellNo = this->getCellNo( Rx );
+        for ( size_t k=0; k< this->neighbors[cellNo].size(); ++k ) {
+            T2 nn = this->neighbors[cellNo][k];
             if ( nodes[nn] == Rx ) {
                 nodeParentRx = nodes[nn].getNodeParent(threadNo);
                 cellParentRx = nodes[nn].getCellParent(threadNo);
@@ -1031,7 +1068,6 @@ namespace ttcr {
             }
         }
         
-        T2 cellNo = this->getCellNo( Rx );
         T2 neibNo = this->neighbors[cellNo][0];
         T1 dt = this->cells.computeDt(nodes[neibNo], Rx, cellNo);
         
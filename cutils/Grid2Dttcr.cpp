@@ -22,7 +22,9 @@
  *
  */
 
-#include <thread>
+#include <algorithm>
+#include <functional>
+#include <stdexcept>
 
 #include "Grid2Dttcr.h"
 
@@ -31,482 +33,487 @@ using namespace std;
 
 namespace ttcr {
 
-    Grid2Dttcr::Grid2Dttcr(std::string& _type,
+    template<typename T>
+    Grid2Dttcr<T>::Grid2Dttcr(std::string& _type,
                            uint32_t nx, uint32_t nz,
                            double dx, double dz,
                            double xmin, double zmin,
                            uint32_t nsnx, uint32_t nsnz,
-                           size_t nthreads) : type(_type){
+                           size_t nthreads,
+                           const std::string& method) : type(_type), method(method),
+    nx(nx), nz(nz), dx(dx), dz(dz), xmin(xmin), zmin(zmin), nsnx(nsnx), nsnz(nsnz),
+    cacheMaxBytes(0), cacheHits(0), cacheMisses(0) {
 
-        if ( type.compare("iso")==0 ) {
-            grid_instance = new gridiso(nx, nz,
-                                        dx, dz,
-                                        xmin, zmin,
-                                        nsnx, nsnz,
-                                        nthreads);
+        grid_instance = newGrid(nthreads);
+    }
+
+    template<typename T>
+    typename Grid2Dttcr<T>::grid* Grid2Dttcr<T>::newGrid(const size_t nthreads) const {
+
+        if ( method.compare("fmm")==0 ) {
+            if ( type.compare("iso")!=0 ) {
+                throw invalid_argument("Fast marching is only implemented for isotropic media.");
+            }
+            return new gridfm(nx, nz,
+                              dx, dz,
+                              xmin, zmin,
+                              nsnx, nsnz,
+                              nthreads);
+        } else if ( method.compare("spm")!=0 ) {
+            throw invalid_argument("Raytracing method should be spm or fmm.");
+        } else if ( type.compare("iso")==0 ) {
+            return new gridiso(nx, nz,
+                               dx, dz,
+                               xmin, zmin,
+                               nsnx, nsnz,
+                               nthreads);
         } else if ( type.compare("elliptical")==0 ) {
-            grid_instance = new gridaniso(nx, nz,
-                                          dx, dz,
-                                          xmin, zmin,
-                                          nsnx, nsnz,
-                                          nthreads);
+            return new gridaniso(nx, nz,
+                                 dx, dz,
+                                 xmin, zmin,
+                                 nsnx, nsnz,
+                                 nthreads);
         } else if ( type.compare("tilted")==0 ) {
-            grid_instance = new gridtilted(nx, nz,
-                                           dx, dz,
-                                           xmin, zmin,
-                                           nsnx, nsnz,
-                                           nthreads);
+            return new gridtilted(nx, nz,
+                                  dx, dz,
+                                  xmin, zmin,
+                                  nsnx, nsnz,
+                                  nthreads);
         } else {
             // error: type not defined
             throw bad_cast();
         }
     }
 
-    void Grid2Dttcr::setSlowness(const std::vector<double>& slowness) {
-        if ( grid_instance->setSlowness(slowness) == 1 ) {
+    template<typename T>
+    void Grid2Dttcr<T>::setSlowness(const double* slowness, const size_t n) {
+        checkCacheModel(cacheSlowness, slowness, n);
+        if ( grid_instance->setSlowness( vector<T>(slowness, slowness+n) ) == 1 ) {
             throw out_of_range("Slowness values must be defined for each grid cell.");
         }
     }
 
-    void Grid2Dttcr::setXi(const std::vector<double>& xi) {
-        if ( grid_instance->setXi(xi) == 1 ) {
+    template<typename T>
+    void Grid2Dttcr<T>::setXi(const double* xi, const size_t n) {
+        checkCacheModel(cacheXi, xi, n);
+        if ( grid_instance->setXi( vector<T>(xi, xi+n) ) == 1 ) {
             throw out_of_range("Xi values must be defined for each grid cell.");
         }
     }
 
-    void Grid2Dttcr::setTheta(const std::vector<double>& theta) {
-        if ( grid_instance->setTiltAngle(theta) == 1 ) {
+    template<typename T>
+    void Grid2Dttcr<T>::setTheta(const double* theta, const size_t n) {
+        checkCacheModel(cacheTheta, theta, n);
+        if ( grid_instance->setTiltAngle( vector<T>(theta, theta+n) ) == 1 ) {
             throw out_of_range("Theta values must be defined for each grid cell.");
         }
     }
 
-    int Grid2Dttcr::raytrace(const std::vector<sxz<double>>& Tx,
-                             const std::vector<double>& tTx,
-                             const std::vector<sxz<double>>& Rx,
-                             double* traveltimes,
-                             PyObject* rays,
-                             PyObject* L) const {
-
-        // rays must be a pointer to a tuple object of size nRx
+    template<typename T>
+    void Grid2Dttcr<T>::groupTx(const double* Tx,
+                             const double* tTx,
+                             const size_t nTx,
+                             vector<vector<sxz<T>>>& vTx,
+                             vector<vector<T>>& t0,
+                             vector<vector<size_t>>& iTx) const {
 
         /*
          Looking for redundants Tx pts
          */
 
-        size_t nTx = Tx.size();
-        size_t nRx = Rx.size();
-        vector<vector<sxz<double>>> vTx;
-        vector<vector<double>> t0;
-        vector<vector<size_t>> iTx;
-        vTx.push_back( vector<sxz<double> >(1, Tx[0]) );
-        t0.push_back( vector<double>(1, tTx[0]) );
+        vTx.push_back( vector<sxz<T> >(1, sxz<T>(Tx[0], Tx[2])) );
+        t0.push_back( vector<T>(1, tTx[0]) );
         iTx.push_back( vector<size_t>(1, 0) );  // indices of Rx corresponding to current Tx
         for ( size_t ntx=1; ntx<nTx; ++ntx ) {
+            sxz<T> tx(Tx[3*ntx], Tx[3*ntx+2]);
             bool found = false;
 
             for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-                if ( vTx[nv][0]==Tx[ntx] ) {
+                if ( vTx[nv][0]==tx ) {
                     found = true;
                     iTx[nv].push_back( ntx ) ;
                     break;
                 }
             }
             if ( !found ) {
-                vTx.push_back( vector<sxz<double>>(1, Tx[ntx]) );
-                t0.push_back( vector<double>(1, tTx[ntx]) );
+                vTx.push_back( vector<sxz<T>>(1, tx) );
+                t0.push_back( vector<T>(1, tTx[ntx]) );
                 iTx.push_back( vector<size_t>(1, ntx) );
             }
         }
+    }
 
-        /*
-         Looping over all non redundant Tx
-         */
-
-        vector<sxz<double>> vRx;
-        vector<vector<double>> tt( vTx.size() );
-        vector<vector<vector<sxz<double>>>> r_data( vTx.size() );
-        vector<vector<siv2<double>>> L_data(nTx);
-        vector<vector<vector<siv2<double>>>> l_data( vTx.size() );
-
-        if ( grid_instance->getNthreads() == 1 || grid_instance->getNthreads()<= vTx.size() ) {
-            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-
-                vRx.resize( 0 );
-                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
+    template<typename T>
+    int Grid2Dttcr<T>::raytrace(const double* Tx_p,
+                             const double* tTx,
+                             const double* Rx_p,
+                             const size_t nTx,
+                             double* traveltimes,
+                             vector<vector<siv2<T>>>* L_data,
+                             vector<vector<sxz<T>>>* r_data) const {
 
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv]) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
-                }
-            }
-        } else {
-            size_t num_threads = grid_instance->getNthreads();
-            size_t blk_size = vTx.size()/num_threads;
-            if ( blk_size == 0 ) blk_size++;
+        // L_data and r_data are optional (nullptr if not needed)
 
-            vector<thread> threads(num_threads-1);
-            size_t blk_start = 0;
-            for ( size_t i=0; i<num_threads-1; ++i ) {
+        size_t nRx = nTx;
+        vector<sxz<T>> Rx( nRx );
+        for ( size_t n=0; n<nRx; ++n ) {
+            Rx[n].x = Rx_p[3*n];
+            Rx[n].z = Rx_p[3*n+2];
+        }
+        vector<vector<sxz<T>>> vTx;
+        vector<vector<T>> t0;
+        vector<vector<size_t>> iTx;
+        groupTx(Tx_p, tTx, nTx, vTx, t0, iTx);
 
-                size_t blk_end = blk_start + blk_size;
-                grid *grid_ref = grid_instance;
-                threads[i]=thread( [&grid_ref,&vTx,&tt,&t0,&Rx,&iTx,&nRx,
-                                    &r_data,&l_data,blk_start,blk_end,i]{
+        /*
+         Looping over all non redundant Tx
+         */
 
-                    for ( size_t nv=blk_start; nv<blk_end; ++nv ) {
+        vector<vector<T>> tt( vTx.size() );
+        vector<vector<vector<sxz<T>>>> r_tmp( r_data==nullptr ? 0 : vTx.size() );
+        vector<vector<vector<siv2<T>>>> l_data( L_data==nullptr ? 0 : vTx.size() );
 
-                        vector<sxz<double>> vRx;
-                        for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                            vRx.push_back( Rx[ iTx[nv][ni] ] );
-                        }
-                        if ( grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv], i+1) == 1 ) {
-                            throw runtime_error("Problem while raytracing.");
-                        }
+        // when only traveltimes are needed, sources with a travel-time field
+        // in cache are handled by interpolation
+        vector<size_t> toSolve;
+        bool useCache = cacheMaxBytes > 0 && L_data == nullptr && r_data == nullptr;
+        T xmax = grid_instance->getXmin() + grid_instance->getNcx()*grid_instance->getDx();
+        T zmax = grid_instance->getZmin() + grid_instance->getNcz()*grid_instance->getDz();
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            const ttField* field = nullptr;
+            if ( useCache ) {
+                field = findTTField(vTx[nv][0]);
+                // points outside the grid are reported by the solver
+                for ( size_t ni=0; ni<iTx[nv].size() && field != nullptr; ++ni ) {
+                    const sxz<T>& rx = Rx[ iTx[nv][ni] ];
+                    if ( rx.x < grid_instance->getXmin() || rx.x > xmax ||
+                        rx.z < grid_instance->getZmin() || rx.z > zmax ) {
+                        field = nullptr;
                     }
-                });
-
-                blk_start = blk_end;
+                }
             }
-
-            for ( size_t nv=blk_start; nv<vTx.size(); ++nv ) {
-                vector<sxz<double>> vRx;
+            if ( field != nullptr ) {
+                tt[nv].resize( iTx[nv].size() );
                 for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv], 0) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
+                    tt[nv][ni] = grid_instance->getTraveltimeFromTT(Rx[ iTx[nv][ni] ], field->tt) +
+                    t0[nv][0] - field->t0;
                 }
+            } else {
+                toSolve.push_back( nv );
             }
-
-            std::for_each(threads.begin(),threads.end(),
-                          std::mem_fn(&std::thread::join));
         }
 
-        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+        grid *grid_ref = grid_instance;
+        auto solve = [this,&grid_ref,&vTx,&tt,&t0,&Rx,&iTx,&r_tmp,&l_data,
+                      L_data,r_data](const size_t nv, const size_t threadNo) {
+            vector<sxz<T>> vRx;
             for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                traveltimes[ iTx[nv][ni] ] = tt[nv][ni];
+                vRx.push_back( Rx[ iTx[nv][ni] ] );
             }
-        }
-
-        // rays
-        import_array();  // to use PyArray_SimpleNewFromData
-
-        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                size_t npts = r_data[nv][ni].size();
-                npy_intp dims[] = {static_cast<npy_intp>(npts), 2};
-                double* ray_p = new double[2*npts];
-                PyObject* ray = PyArray_SimpleNewFromData(2, dims, NPY_DOUBLE, ray_p);
-                PyArray_ENABLEFLAGS((PyArrayObject*)ray, NPY_ARRAY_OWNDATA);
-
-                for ( size_t np=0; np<npts; ++np ) {
-                    ray_p[2*np] = r_data[nv][ni][np].x;
-                    ray_p[2*np+1] = r_data[nv][ni][np].z;
-                }
-
-                PyTuple_SetItem(rays, iTx[nv][ni], ray);
+            int ret;
+            if ( L_data != nullptr && r_data != nullptr ) {
+                ret = grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_tmp[nv], l_data[nv], threadNo);
+            } else if ( L_data != nullptr ) {
+                ret = grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv], threadNo);
+            } else if ( r_data != nullptr ) {
+                ret = grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_tmp[nv], threadNo);
+            } else {
+                ret = grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv], threadNo);
             }
-        }
-
-        // L
-        // first element of tuple contains data, size is nnz
-        // second element contains column indices for rows of the matrix, size is nnz
-        // third element contains pointers for indices, size is nrow+1 (nTx+1)
+            if ( ret == 1 ) {
+                throw runtime_error("Problem while raytracing.");
+            }
+            if ( cacheMaxBytes > 0 ) {
+                storeTTField(vTx[nv][0], t0[nv][0], threadNo);
+            }
+        };
+
+        // groups with more receivers are solved first, threads then take
+        // the next group as soon as they are done (see runTasks)
+        std::stable_sort(toSolve.begin(), toSolve.end(), [&iTx](const size_t a, const size_t b) {
+            return iTx[a].size() > iTx[b].size();
+        });
+        auto task = [&solve,&toSolve](const size_t n, const size_t threadNo) {
+            solve(toSolve[n], threadNo);
+        };
+        runTasks(grid_instance->getNthreads(), toSolve.size(), task, threadTime, threadCount);
 
         for ( size_t nv=0; nv<vTx.size(); ++nv ) {
             for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                L_data[ iTx[nv][ni] ] = l_data[nv][ni];
+                traveltimes[ iTx[nv][ni] ] = tt[nv][ni];
             }
         }
 
-        size_t nnz = 0;
-        for ( size_t n=0; n<L_data.size(); ++n ) {
-            nnz += L_data[n].size();
-        }
-        size_t ncell = grid_instance->getNumberOfCells();
-
-        if ( type.compare("iso")==0 ) {
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }
-                    }
+        // rays and rows of L are moved in the order of the input Tx-Rx pairs
+        if ( r_data != nullptr ) {
+            r_data->resize( nTx );
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                    (*r_data)[ iTx[nv][ni] ].swap( r_tmp[nv][ni] );
                 }
             }
-            indptr_p[nTx] = k;
-
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
-
-        } else {
-            nnz *= 2;
-
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<2*ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }	else if ( L_data[i][n].i+ncell == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v2;
-                            k++;
-                        }
-                    }
+        }
+        if ( L_data != nullptr ) {
+            L_data->resize( nTx );
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                    (*L_data)[ iTx[nv][ni] ].swap( l_data[nv][ni] );
                 }
             }
-            indptr_p[nTx] = k;
-
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
         }
 
         return 0;
     }
 
-    int Grid2Dttcr::raytrace(const std::vector<sxz<double>>& Tx,
-                             const std::vector<double>& tTx,
-                             const std::vector<sxz<double>>& Rx,
-                             double* traveltimes,
-                             PyObject* L) const {
-
-        /*
-         Looking for redundants Tx pts
-         */
-
-        size_t nTx = Tx.size();
-        size_t nRx = Rx.size();
-        vector<vector<sxz<double>>> vTx;
-        vector<vector<double>> t0;
+    template<typename T>
+    int Grid2Dttcr<T>::raytraceBatch(const double* slowness,
+                                     const size_t nModels,
+                                     const double* xi,
+                                     const double* theta,
+                                     const size_t nCells,
+                                     const double* Tx_p,
+                                     const double* tTx,
+                                     const double* Rx_p,
+                                     const size_t nTx,
+                                     double* traveltimes,
+                                     vector<vector<vector<siv2<T>>>>* L_data) {
+
+        // Tasks are (model, Tx group) pairs.  Each thread works on its own
+        // grid instance (the main grid for thread 0), the slowness of which
+        // is updated when the thread takes a task of another model.
+
+        vector<sxz<T>> Rx( nTx );
+        for ( size_t n=0; n<nTx; ++n ) {
+            Rx[n].x = Rx_p[3*n];
+            Rx[n].z = Rx_p[3*n+2];
+        }
+        vector<vector<sxz<T>>> vTx;
+        vector<vector<T>> t0;
         vector<vector<size_t>> iTx;
-        vTx.push_back( vector<sxz<double> >(1, Tx[0]) );
-        t0.push_back( vector<double>(1, tTx[0]) );
-        iTx.push_back( vector<size_t>(1, 0) );  // indices of Rx corresponding to current Tx
-        for ( size_t ntx=1; ntx<nTx; ++ntx ) {
-            bool found = false;
-
-            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-                if ( vTx[nv][0]==Tx[ntx] ) {
-                    found = true;
-                    iTx[nv].push_back( ntx ) ;
-                    break;
-                }
+        groupTx(Tx_p, tTx, nTx, vTx, t0, iTx);
+        const size_t nGroups = vTx.size();
+
+        // groups with more receivers first, within each model
+        vector<size_t> order( nGroups );
+        for ( size_t nv=0; nv<nGroups; ++nv ) order[nv] = nv;
+        std::stable_sort(order.begin(), order.end(), [&iTx](const size_t a, const size_t b) {
+            return iTx[a].size() > iTx[b].size();
+        });
+
+        const size_t nThreads = grid_instance->getNthreads() < nModels*nGroups ?
+        grid_instance->getNthreads() : nModels*nGroups;
+        while ( batchGrids.size()+1 < nThreads ) {
+            batchGrids.push_back( newGrid(1) );
+        }
+        vector<grid*> grids( nThreads );
+        grids[0] = grid_instance;
+        for ( size_t i=1; i<nThreads; ++i ) {
+            grids[i] = batchGrids[i-1];
+        }
+        for ( size_t i=0; i<nThreads; ++i ) {
+            if ( xi != nullptr && grids[i]->setXi( vector<T>(xi, xi+nCells) ) == 1 ) {
+                throw out_of_range("Xi values must be defined for each grid cell.");
             }
-            if ( !found ) {
-                vTx.push_back( vector<sxz<double>>(1, Tx[ntx]) );
-                t0.push_back( vector<double>(1, tTx[ntx]) );
-                iTx.push_back( vector<size_t>(1, ntx) );
+            if ( theta != nullptr && grids[i]->setTiltAngle( vector<T>(theta, theta+nCells) ) == 1 ) {
+                throw out_of_range("Theta values must be defined for each grid cell.");
             }
         }
+        // the model of the main grid is changed, cached fields are no longer valid
+        clearTTCache();
+        cacheSlowness.clear();
+        cacheXi.clear();
+        cacheTheta.clear();
+        vector<size_t> model( nThreads, nModels );
+
+        vector<vector<vector<T>>> tt( nModels, vector<vector<T>>(nGroups) );
+        vector<vector<vector<vector<siv2<T>>>>> l_data( L_data==nullptr ? 0 : nModels,
+                                                        vector<vector<vector<siv2<T>>>>(nGroups) );
+
+        auto task = [&](const size_t n, const size_t threadNo) {
+            const size_t m = n / nGroups;
+            const size_t nv = order[ n % nGroups ];
+            grid* g = grids[threadNo];
+            if ( model[threadNo] != m ) {
+                if ( g->setSlowness( vector<T>(slowness+m*nCells, slowness+(m+1)*nCells) ) == 1 ) {
+                    throw out_of_range("Slowness values must be defined for each grid cell.");
+                }
+                model[threadNo] = m;
+            }
+            vector<sxz<T>> vRx;
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                vRx.push_back( Rx[ iTx[nv][ni] ] );
+            }
+            int ret;
+            if ( L_data != nullptr ) {
+                ret = g->raytrace(vTx[nv], t0[nv], vRx, tt[m][nv], l_data[m][nv], 0);
+            } else {
+                ret = g->raytrace(vTx[nv], t0[nv], vRx, tt[m][nv], 0);
+            }
+            if ( ret == 1 ) {
+                throw runtime_error("Problem while raytracing.");
+            }
+        };
+        runTasks(nThreads, nModels*nGroups, task, threadTime, threadCount);
 
-        /*
-         Looping over all non redundant Tx
-         */
-
-        vector<sxz<double>> vRx;
-        vector<vector<double>> tt( vTx.size() );
-        vector<vector<siv2<double>>> L_data(nTx);
-        vector<vector<vector<siv2<double>>>> l_data( vTx.size() );
-
-        if ( grid_instance->getNthreads() == 1 || vTx.size()<=grid_instance->getNthreads() ) {
-            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-
-                vRx.resize( 0 );
+        for ( size_t m=0; m<nModels; ++m ) {
+            for ( size_t nv=0; nv<nGroups; ++nv ) {
                 for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
+                    traveltimes[ m*nTx + iTx[nv][ni] ] = tt[m][nv][ni];
                 }
-
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv]) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
+            }
+        }
+        if ( L_data != nullptr ) {
+            L_data->resize( nModels );
+            for ( size_t m=0; m<nModels; ++m ) {
+                (*L_data)[m].resize( nTx );
+                for ( size_t nv=0; nv<nGroups; ++nv ) {
+                    for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                        (*L_data)[m][ iTx[nv][ni] ].swap( l_data[m][nv][ni] );
+                    }
                 }
             }
-        } else {
-            size_t num_threads = grid_instance->getNthreads() < vTx.size() ? grid_instance->getNthreads() : vTx.size();
-            size_t blk_size = vTx.size()/num_threads;
-            if ( blk_size == 0 ) blk_size++;
-
-            vector<thread> threads(num_threads-1);
-            size_t blk_start = 0;
-            for ( size_t i=0; i<num_threads-1; ++i ) {
+        }
 
-                size_t blk_end = blk_start + blk_size;
-                grid *grid_ref = grid_instance;
-                threads[i]=thread( [&grid_ref,&vTx,&tt,&t0,&Rx,&iTx,&nRx,
-                                    &l_data,blk_start,blk_end,i]{
+        return 0;
+    }
 
-                    for ( size_t nv=blk_start; nv<blk_end; ++nv ) {
+    template<typename T>
+    void Grid2Dttcr<T>::setTTCacheSize(const size_t maxBytes) {
+        lock_guard<mutex> lock(cacheMutex);
+        cacheMaxBytes = maxBytes;
+        size_t nBytes = grid_instance->getNumberOfNodes()*sizeof(T);
+        while ( !ttCache.empty() && ttCache.size()*nBytes > cacheMaxBytes ) {
+            ttCache.pop_back();
+        }
+        if ( cacheMaxBytes == 0 ) {
+            // model values are not needed anymore
+            vector<double>().swap(cacheSlowness);
+            vector<double>().swap(cacheXi);
+            vector<double>().swap(cacheTheta);
+        }
+    }
 
-                        vector<sxz<double>> vRx;
-                        for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                            vRx.push_back( Rx[ iTx[nv][ni] ] );
-                        }
-                        if ( grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv], i+1) == 1 ) {
-                            throw runtime_error("Problem while raytracing.");
-                        }
-                    }
-                });
+    template<typename T>
+    void Grid2Dttcr<T>::clearTTCache() {
+        lock_guard<mutex> lock(cacheMutex);
+        ttCache.clear();
+    }
 
-                blk_start = blk_end;
-            }
+    template<typename T>
+    void Grid2Dttcr<T>::getTTCacheStats(size_t& nFields, size_t& nBytes,
+                                     size_t& nHits, size_t& nMisses) const {
+        lock_guard<mutex> lock(cacheMutex);
+        nFields = ttCache.size();
+        nBytes = 0;
+        for ( auto it=ttCache.begin(); it!=ttCache.end(); ++it ) {
+            nBytes += it->tt.size()*sizeof(T);
+        }
+        nHits = cacheHits;
+        nMisses = cacheMisses;
+    }
 
-            for ( size_t nv=blk_start; nv<vTx.size(); ++nv ) {
-                vector<sxz<double>> vRx;
-                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv], 0) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
-                }
+    template<typename T>
+    const typename Grid2Dttcr<T>::ttField* Grid2Dttcr<T>::findTTField(const sxz<T>& Tx) const {
+        lock_guard<mutex> lock(cacheMutex);
+        for ( auto it=ttCache.begin(); it!=ttCache.end(); ++it ) {
+            if ( it->Tx == Tx ) {
+                // most recently used is moved to front, iterators remain valid
+                ttCache.splice(ttCache.begin(), ttCache, it);
+                cacheHits++;
+                return &(ttCache.front());
             }
-
-            std::for_each(threads.begin(),threads.end(),
-                          std::mem_fn(&std::thread::join));
         }
+        cacheMisses++;
+        return nullptr;
+    }
 
-        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                traveltimes[ iTx[nv][ni] ] = tt[nv][ni];
+    template<typename T>
+    void Grid2Dttcr<T>::storeTTField(const sxz<T>& Tx, const T t0,
+                                  const size_t threadNo) const {
+        size_t nBytes = grid_instance->getNumberOfNodes()*sizeof(T);
+        if ( nBytes > cacheMaxBytes ) {
+            return;
+        }
+        ttField field;
+        field.Tx = Tx;
+        field.t0 = t0;
+        grid_instance->getTT(field.tt, threadNo);
+
+        lock_guard<mutex> lock(cacheMutex);
+        for ( auto it=ttCache.begin(); it!=ttCache.end(); ++it ) {
+            if ( it->Tx == Tx ) {
+                ttCache.erase(it);
+                break;
             }
         }
+        ttCache.push_front( std::move(field) );
+        while ( ttCache.size()*nBytes > cacheMaxBytes ) {
+            ttCache.pop_back();
+        }
+    }
 
-        import_array();  // to use PyArray_SimpleNewFromData
+    template<typename T>
+    void Grid2Dttcr<T>::checkCacheModel(vector<double>& current,
+                                     const double* values, const size_t n) {
+        if ( cacheMaxBytes == 0 ) {
+            return;
+        }
+        if ( current.size() != n || !std::equal(values, values+n, current.begin()) ) {
+            clearTTCache();
+            current.assign(values, values+n);
+        }
+    }
 
-        // L
-        // first element of tuple contains data, size is nnz
-        // second element contains column indices for rows of the matrix, size is nnz
-        // third element contains pointers for indices, size is nrow+1 (nTx+1)
+    template<typename T>
+    size_t Grid2Dttcr<T>::getLindptr(const vector<vector<siv2<T>>>& L_data,
+                                  int64_t* indptr) const {
 
-        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                L_data[ iTx[nv][ni] ] = l_data[nv][ni];
-            }
+        // indptr has size nrow+1, nnz is returned
+        size_t fac = type.compare("iso")==0 ? 1 : 2;
+        size_t k = 0;
+        for ( size_t i=0; i<L_data.size(); ++i ) {
+            indptr[i] = k;
+            k += fac*L_data[i].size();
         }
+        indptr[L_data.size()] = k;
+        return k;
+    }
 
-        size_t nnz = 0;
-        for ( size_t n=0; n<L_data.size(); ++n ) {
-            nnz += L_data[n].size();
-        }
-        size_t ncell = grid_instance->getNumberOfCells();
+    template<typename T>
+    void Grid2Dttcr<T>::fillL(const vector<vector<siv2<T>>>& L_data,
+                           int64_t* indices,
+                           T* data) const {
+
+        // elements of L_data are sorted by cell index, columns of each
+        // row are thus written in increasing order.  For anisotropic media,
+        // the X components come first (columns 0 to ncell-1) followed by
+        // the Z components (columns ncell to 2*ncell-1)
 
+        size_t k = 0;
         if ( type.compare("iso")==0 ) {
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }
-                    }
+            for ( size_t i=0; i<L_data.size(); ++i ) {
+                for ( size_t n=0; n<L_data[i].size(); ++n, ++k ) {
+                    indices[k] = L_data[i][n].i;
+                    data[k] = L_data[i][n].v;
                 }
             }
-            indptr_p[nTx] = k;
-
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
-
         } else {
-            nnz *= 2;
-
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<2*ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }	else if ( L_data[i][n].i+ncell == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v2;
-                            k++;
-                        }
-                    }
+            size_t ncell = grid_instance->getNumberOfCells();
+            for ( size_t i=0; i<L_data.size(); ++i ) {
+                for ( size_t n=0; n<L_data[i].size(); ++n, ++k ) {
+                    indices[k] = L_data[i][n].i;
+                    data[k] = L_data[i][n].v;
+                }
+                for ( size_t n=0; n<L_data[i].size(); ++n, ++k ) {
+                    indices[k] = L_data[i][n].i + ncell;
+                    data[k] = L_data[i][n].v2;
                 }
             }
-            indptr_p[nTx] = k;
-
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
         }
-
-        return 0;
     }
 
-    int Grid2Dttcr::Lsr2d(const double* Tx,
+    template<typename T>
+    int Grid2Dttcr<T>::Lsr2d(const double* Tx,
                           const double* Rx,
                           const size_t nTx,
                           const double* grx,
@@ -518,7 +525,8 @@ namespace ttcr {
         const double  small=1.e-10;
 
         size_t nCells = (n_grx-1)*(n_grz-1);
-        size_t nLmax = nTx * n_grx * n_grz/2;
+        // a straight ray crosses at most n_grx+n_grz cells
+        size_t nLmax = nTx * (n_grx + n_grz);
         double percent_sp = (nLmax*1.0)/(nTx*nCells*1.0);
 
         double* data_p = (double*)malloc( nLmax*sizeof(double) );
@@ -703,7 +711,7 @@ namespace ttcr {
         data_p = (double*)realloc( data_p, nnz*sizeof(double) );
         indices_p = (int64_t*)realloc( indices_p, nnz*sizeof(int64_t) );
 
-        import_array();  // to use PyArray_SimpleNewFromData
+        import_array1(-1);  // to use PyArray_SimpleNewFromData, returns -1 on failure
 
         npy_intp dims[] = {static_cast<npy_intp>(nnz)};
         PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
@@ -721,7 +729,8 @@ namespace ttcr {
     }
 
 
-    int Grid2Dttcr::Lsr2da(const double* Tx,
+    template<typename T>
+    int Grid2Dttcr<T>::Lsr2da(const double* Tx,
                            const double* Rx,
                            const size_t nTx,
                            const double* grx,
@@ -733,7 +742,8 @@ namespace ttcr {
         const double  small=1.e-10;
 
         size_t nCells = (n_grx-1)*(n_grz-1);
-        size_t nLmax = nTx * n_grx * n_grz/2;
+        // a straight ray crosses at most n_grx+n_grz cells, with 2 values per cell
+        size_t nLmax = 2 * nTx * (n_grx + n_grz);
         double percent_sp = (nLmax*1.0)/(nTx*nCells*1.0);
 
         double* data_p = (double*)malloc( nLmax*sizeof(double) );
@@ -921,7 +931,7 @@ namespace ttcr {
         data_p = (double*)realloc( data_p, nnz*sizeof(double) );
         indices_p = (int64_t*)realloc( indices_p, nnz*sizeof(int64_t) );
 
-        import_array();  // to use PyArray_SimpleNewFromData
+        import_array1(-1);  // to use PyArray_SimpleNewFromData, returns -1 on failure
 
         npy_intp dims[] = {static_cast<npy_intp>(nnz)};
         PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
@@ -937,4 +947,10 @@ namespace ttcr {
 
         return 0;
     }
+
+    // double precision, and single precision for large grids where memory
+    // bandwidth is the bottleneck
+    template class Grid2Dttcr<double>;
+    template class Grid2Dttcr<float>;
+
 }
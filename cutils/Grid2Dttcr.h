@@ -31,44 +31,98 @@
 #include "Python.h"
 #include "numpy/ndarrayobject.h"
 
+#include <list>
+#include <mutex>
 #include <string>
 #include <vector>
 
 #include "Cell.h"
+#include "Grid2Drcfm.h"
 #include "Grid2Drcsp.h"
+#include "Scheduler.h"
 
 
 namespace ttcr {
     
-    typedef Grid2D<double,uint32_t,sxz<double>> grid;
-    typedef Grid2Drcsp<double,uint32_t,Cell<double,Node2Dcsp<double,uint32_t>,sxz<double>>> gridiso;
-    typedef Grid2Drcsp<double,uint32_t,CellElliptical<double,Node2Dcsp<double,uint32_t>,sxz<double>>> gridaniso;
-    typedef Grid2Drcsp<double,uint32_t,CellTiltedElliptical<double,Node2Dcsp<double,uint32_t>,sxz<double>>> gridtilted;
-    
+    // T is the floating point type used for slowness, travel times, ray
+    // paths and L (instantiated for double and float in Grid2Dttcr.cpp);
+    // coordinates and traveltimes are passed as double in all cases
+    template<typename T>
     class Grid2Dttcr {
     public:
-        Grid2Dttcr(std::string&, uint32_t, uint32_t, double, double, double, double, uint32_t, uint32_t, size_t);
+        typedef Grid2D<T,uint32_t,sxz<T>> grid;
+        typedef Grid2Drcsp<T,uint32_t,Cell<T,Node2Dcsp<T,uint32_t>,sxz<T>>> gridiso;
+        typedef Grid2Drcsp<T,uint32_t,CellElliptical<T,Node2Dcsp<T,uint32_t>,sxz<T>>> gridaniso;
+        typedef Grid2Drcsp<T,uint32_t,CellTiltedElliptical<T,Node2Dcsp<T,uint32_t>,sxz<T>>> gridtilted;
+        typedef Grid2Drcfm<T,uint32_t> gridfm;
+
+        // method is "spm" (shortest path) or "fmm" (fast marching, isotropic media only)
+        Grid2Dttcr(std::string&, uint32_t, uint32_t, double, double, double, double, uint32_t, uint32_t, size_t,
+                   const std::string& method="spm");
         ~Grid2Dttcr() {
             delete grid_instance;
+            for ( size_t n=0; n<batchGrids.size(); ++n ) {
+                delete batchGrids[n];
+            }
         }
         std::string getType() const { return type; }
         
-        void setSlowness(const std::vector<double>& slowness);
-        void setXi(const std::vector<double>& xi);
-        void setTheta(const std::vector<double>& theta);
+        void setSlowness(const double* slowness, const size_t n);
+        void setXi(const double* xi, const size_t n);
+        void setTheta(const double* theta, const size_t n);
+
+        // time (s) spent raytracing and number of Tx groups solved by each
+        // thread during the last call to raytrace
+        const std::vector<double>& getThreadTime() const { return threadTime; }
+        const std::vector<size_t>& getThreadCount() const { return threadCount; }
         
-        int raytrace(const std::vector<sxz<double>>& Tx,
-                     const std::vector<double>& tTx,
-                     const std::vector<sxz<double>>& Rx,
+        // Tx and Rx are C-ordered (nTx x 3) arrays, Y (2nd column) is ignored
+        // L_data and r_data are computed only if not null
+        int raytrace(const double* Tx,
+                     const double* tTx,
+                     const double* Rx,
+                     const size_t nTx,
                      double* traveltimes,
-                     PyObject* rays,
-                     PyObject* L) const;
+                     std::vector<std::vector<siv2<T>>>* L_data,
+                     std::vector<std::vector<sxz<T>>>* r_data) const;
         
-        int raytrace(const std::vector<sxz<double>>& Tx,
-                     const std::vector<double>& tTx,
-                     const std::vector<sxz<double>>& Rx,
-                     double* traveltimes,
-                     PyObject* L) const;
+        // Raytracing in nModels slowness models (C-ordered nModels x nCells
+        // array), with the same xi and theta (null for isotropic media).
+        // Traveltimes are returned in a C-ordered nModels x nTx array, and
+        // the rows of L of model m in (*L_data)[m] if L_data is not null.
+        // Models and Tx groups are processed in parallel, with one grid
+        // instance per thread.
+        int raytraceBatch(const double* slowness,
+                          const size_t nModels,
+                          const double* xi,
+                          const double* theta,
+                          const size_t nCells,
+                          const double* Tx,
+                          const double* tTx,
+                          const double* Rx,
+                          const size_t nTx,
+                          double* traveltimes,
+                          std::vector<std::vector<std::vector<siv2<T>>>>* L_data);
+
+        // L_data holds the rows of the ray projection matrix, it is
+        // converted in CSR format in two steps: getLindptr returns nnz and
+        // fills indptr (size nrow+1), fillL fills indices and data (size nnz)
+        size_t getLindptr(const std::vector<std::vector<siv2<T>>>& L_data,
+                          int64_t* indptr) const;
+        
+        void fillL(const std::vector<std::vector<siv2<T>>>& L_data,
+                   int64_t* indices,
+                   T* data) const;
+        
+        // Travel-time fields computed for each source can be kept in a LRU
+        // cache holding at most maxBytes bytes (0 disables the cache).  When
+        // only traveltimes are requested, receivers of sources found in the
+        // cache are obtained by interpolation, without solving again.  The
+        // cache is emptied when the slowness model changes.
+        void setTTCacheSize(const size_t maxBytes);
+        void clearTTCache();
+        void getTTCacheStats(size_t& nFields, size_t& nBytes,
+                             size_t& nHits, size_t& nMisses) const;
         
         static int Lsr2d(const double* Tx,
                           const double* Rx,
@@ -91,9 +145,46 @@ namespace ttcr {
 		
     private:
         const std::string type;
+        const std::string method;
+        uint32_t nx, nz;
+        double dx, dz, xmin, zmin;
+        uint32_t nsnx, nsnz;
         grid *grid_instance;
+        std::vector<grid*> batchGrids;  // grids of threads 1 to n-1 in raytraceBatch
+        mutable std::vector<double> threadTime;
+        mutable std::vector<size_t> threadCount;
+        
+        struct ttField {
+            sxz<T> Tx;
+            T t0;
+            std::vector<T> tt;  // travel times at grid nodes
+        };
+        size_t cacheMaxBytes;
+        mutable std::list<ttField> ttCache;  // most recently used first
+        mutable std::mutex cacheMutex;
+        mutable size_t cacheHits;
+        mutable size_t cacheMisses;
+        // model for which fields in cache were computed
+        std::vector<double> cacheSlowness;
+        std::vector<double> cacheXi;
+        std::vector<double> cacheTheta;
 		
         Grid2Dttcr() {}
+
+        grid* newGrid(const size_t nthreads) const;
+        
+        void groupTx(const double* Tx,
+                     const double* tTx,
+                     const size_t nTx,
+                     std::vector<std::vector<sxz<T>>>& vTx,
+                     std::vector<std::vector<T>>& t0,
+                     std::vector<std::vector<size_t>>& iTx) const;
+        
+        const ttField* findTTField(const sxz<T>& Tx) const;
+        void storeTTField(const sxz<T>& Tx, const T t0,
+                          const size_t threadNo) const;
+        void checkCacheModel(std::vector<double>& current,
+                             const double* values, const size_t n);
     };
 	
 }
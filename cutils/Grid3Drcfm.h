@@ -0,0 +1,630 @@
+//
+//  Grid3Drcfm.h
+//  ttcr
+//
+//  Rectilinear 3D grid with slowness defined on cells, traveltimes computed
+//  with the fast marching method on a refined grid of nodes.
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+/*
+ * 3D counterpart of Grid2Drcfm.  Each cell is divided in nsx by nsy by nsz
+ * sub-cells (nsx = nsnx+1, ...), and travel times at nodes are obtained
+ * with a first order fast marching scheme applied to the factored eikonal
+ * equation t = t0 + T0*tau.  Local updates use, for each sub-cell, the
+ * upwind differences of tau when the three adjacent nodes along the axes,
+ * or two of them (update within a face of the sub-cell), are frozen, as
+ * well as the transmission along the edges and the diagonals of the
+ * sub-cell.  For updates within a face, the derivative of t (rather than
+ * of tau) normal to the face is taken null: keeping tau constant instead
+ * underestimates travel times when the slowness varies along that normal.
+ *
+ * Cells are numbered with z as the fast axis, then y, then x:
+ *     cell = (ix*ncy + iy)*ncz + iz
+ *
+ * Rows of the ray projection matrix hold (cell, length) pairs only, to
+ * limit the memory needed for large 3D grids.
+ */
+
+#ifndef Grid3Drcfm_h
+#define Grid3Drcfm_h
+
+#include <algorithm>
+#include <cmath>
+#include <functional>
+#include <iostream>
+#include <limits>
+#include <queue>
+#include <utility>
+#include <vector>
+
+#include "ttcr_t.h"
+
+namespace ttcr {
+
+    template<typename T1, typename T2>
+    class Grid3Drcfm {
+    public:
+        Grid3Drcfm(const T2 nx, const T2 ny, const T2 nz,
+                   const T1 ddx, const T1 ddy, const T1 ddz,
+                   const T1 minx, const T1 miny, const T1 minz,
+                   const T2 nnx, const T2 nny, const T2 nnz,
+                   const size_t nt=1);
+
+        virtual ~Grid3Drcfm() {
+        }
+
+        int setSlowness(const std::vector<T1>& s) {
+            if ( s.size() != slowness.size() ) {
+                return 1;
+            }
+            slowness = s;
+            return 0;
+        }
+
+        // r_data and l_data are computed only if not null
+        int raytrace(const std::vector<sxyz<T1>>& Tx,
+                     const std::vector<T1>& t0,
+                     const std::vector<sxyz<T1>>& Rx,
+                     std::vector<T1>& traveltimes,
+                     std::vector<std::vector<sxyz<T1>>>* r_data,
+                     std::vector<std::vector<siv<T1>>>* l_data,
+                     const size_t threadNo=0) const;
+
+        size_t getNumberOfNodes() const { return size_t(nnx)*nny*nnz; }
+        size_t getNumberOfCells() const { return size_t(ncx)*ncy*ncz; }
+
+        const size_t getNthreads() const { return nThreads; }
+
+        T2 getCellNo(const sxyz<T1>& pt) const {
+            T1 x = xmax-pt.x < small ? xmax-.5*dx : pt.x;
+            T1 y = ymax-pt.y < small ? ymax-.5*dy : pt.y;
+            T1 z = zmax-pt.z < small ? zmax-.5*dz : pt.z;
+            T2 nx = static_cast<T2>( small + (x-xmin)/dx );
+            T2 ny = static_cast<T2>( small + (y-ymin)/dy );
+            T2 nz = static_cast<T2>( small + (z-zmin)/dz );
+            return (nx*ncy + ny)*ncz + nz;
+        }
+
+    private:
+        size_t nThreads;
+        T1 dx;           // cell size in x
+        T1 dy;           // cell size in y
+        T1 dz;           // cell size in z
+        T1 xmin;         // origin of the grid
+        T1 ymin;
+        T1 zmin;
+        T1 xmax;         // end of the grid
+        T1 ymax;
+        T1 zmax;
+        T2 ncx;          // number of cells in x
+        T2 ncy;          // number of cells in y
+        T2 ncz;          // number of cells in z
+        T2 nsx;          // number of sub-cells per cell in x
+        T2 nsy;          // number of sub-cells per cell in y
+        T2 nsz;          // number of sub-cells per cell in z
+        T1 hx;           // sub-cell size in x
+        T1 hy;           // sub-cell size in y
+        T1 hz;           // sub-cell size in z
+        T2 nnx;          // number of nodes in x
+        T2 nny;          // number of nodes in y
+        T2 nnz;          // number of nodes in z
+
+        std::vector<T1> slowness;  // slowness vector of the cells
+        mutable std::vector<std::vector<T1>> tt;  // travel times at nodes, for each thread
+
+        Grid3Drcfm() {}
+
+        T2 nodeNo(const T2 i, const T2 j, const T2 k) const { return (i*nny + j)*nnz + k; }
+
+        sxyz<T1> nodeCoord(const T2 i, const T2 j, const T2 k) const {
+            return sxyz<T1>(xmin+i*hx, ymin+j*hy, zmin+k*hz);
+        }
+
+        // slowness of sub-cell (i,j,k), i.e. of the cell holding it
+        T1 subSlowness(const T2 i, const T2 j, const T2 k) const {
+            return slowness[ ((i/nsx)*ncy + j/nsy)*ncz + k/nsz ];
+        }
+
+        int checkPts(const std::vector<sxyz<T1>>& pts) const;
+
+        void solve(const std::vector<sxyz<T1>>& Tx,
+                   const std::vector<T1>& t0,
+                   const size_t threadNo) const;
+
+        T1 localUpdate(const T2 i, const T2 j, const T2 k, const T2 m,
+                       const sxyz<T1>& Tx, const T1 t0, const T1 s0,
+                       const std::vector<T1>& t,
+                       const std::vector<bool>& frozen) const;
+
+        void crossings(const sxyz<T1>& a, const sxyz<T1>& b,
+                       std::vector<T1>& u) const;
+
+        T1 straightRayTime(const sxyz<T1>& a, const sxyz<T1>& b) const;
+
+        void subCell(const sxyz<T1>& pt, T2& i, T2& j, T2& k) const;
+
+        T1 interpTT(const sxyz<T1>& Rx, const sxyz<T1>& Tx, const T1 t0,
+                    const std::vector<T1>& t) const;
+
+        void getRaypath(const std::vector<sxyz<T1>>& Tx,
+                        const T1 t0,
+                        const sxyz<T1>& Rx,
+                        std::vector<sxyz<T1>>& r_data,
+                        const size_t threadNo) const;
+
+        void getLdata(const std::vector<sxyz<T1>>& r_data,
+                      std::vector<siv<T1>>& l_data) const;
+    };
+
+    template<typename T1, typename T2>
+    Grid3Drcfm<T1,T2>::Grid3Drcfm(const T2 nx, const T2 ny, const T2 nz,
+                                  const T1 ddx, const T1 ddy, const T1 ddz,
+                                  const T1 minx, const T1 miny, const T1 minz,
+                                  const T2 nnx_, const T2 nny_, const T2 nnz_,
+                                  const size_t nt) : nThreads(nt),
+    dx(ddx), dy(ddy), dz(ddz), xmin(minx), ymin(miny), zmin(minz),
+    xmax(minx+nx*ddx), ymax(miny+ny*ddy), zmax(minz+nz*ddz),
+    ncx(nx), ncy(ny), ncz(nz), nsx(nnx_+1), nsy(nny_+1), nsz(nnz_+1),
+    hx(ddx/(nnx_+1)), hy(ddy/(nny_+1)), hz(ddz/(nnz_+1)),
+    nnx(nx*(nnx_+1)+1), nny(ny*(nny_+1)+1), nnz(nz*(nnz_+1)+1),
+    slowness(std::vector<T1>(size_t(nx)*ny*nz)),
+    tt(std::vector<std::vector<T1>>(nt))
+    {
+        // travel time vectors are allocated on first use by each thread
+    }
+
+    template<typename T1, typename T2>
+    int Grid3Drcfm<T1,T2>::checkPts(const std::vector<sxyz<T1>>& pts) const {
+        for (size_t n=0; n<pts.size(); ++n) {
+            if ( pts[n].x < xmin || pts[n].x > xmax ||
+                pts[n].y < ymin || pts[n].y > ymax ||
+                pts[n].z < zmin || pts[n].z > zmax ) {
+                std::cerr << "Error: point no " << (n+1)
+                << " outside the grid.\n";
+                return 1;
+            }
+        }
+        return 0;
+    }
+
+    template<typename T1, typename T2>
+    void Grid3Drcfm<T1,T2>::subCell(const sxyz<T1>& pt, T2& i, T2& j, T2& k) const {
+        // sub-cell holding pt, points on the far faces belong to the last sub-cell
+        T1 x = (pt.x-xmin)/hx;
+        T1 y = (pt.y-ymin)/hy;
+        T1 z = (pt.z-zmin)/hz;
+        i = x <= 0 ? 0 : static_cast<T2>( x );
+        j = y <= 0 ? 0 : static_cast<T2>( y );
+        k = z <= 0 ? 0 : static_cast<T2>( z );
+        if ( i > nnx-2 ) i = nnx-2;
+        if ( j > nny-2 ) j = nny-2;
+        if ( k > nnz-2 ) k = nnz-2;
+    }
+
+    template<typename T1, typename T2>
+    void Grid3Drcfm<T1,T2>::crossings(const sxyz<T1>& a, const sxyz<T1>& b,
+                                      std::vector<T1>& u) const {
+
+        // sorted parameters (0 to 1) of the crossings of segment ab with cell faces
+        u.assign(1, 0.0);
+        const T1 d[3] = {b.x-a.x, b.y-a.y, b.z-a.z};
+        const T1 pa[3] = {a.x, a.y, a.z};
+        const T1 pb[3] = {b.x, b.y, b.z};
+        const T1 o[3] = {xmin, ymin, zmin};
+        const T1 h[3] = {dx, dy, dz};
+        for ( size_t n=0; n<3; ++n ) {
+            if ( std::abs(d[n]) > 0.0 ) {
+                T1 v1 = d[n] > 0 ? pa[n] : pb[n];
+                T1 v2 = d[n] > 0 ? pb[n] : pa[n];
+                for ( T1 v=o[n]+h[n]*std::ceil((v1-o[n])/h[n]); v<v2; v+=h[n] ) {
+                    u.push_back( (v-pa[n])/d[n] );
+                }
+            }
+        }
+        u.push_back( 1.0 );
+        std::sort(u.begin(), u.end());
+    }
+
+    template<typename T1, typename T2>
+    T1 Grid3Drcfm<T1,T2>::straightRayTime(const sxyz<T1>& a, const sxyz<T1>& b) const {
+
+        // integral of slowness along segment ab
+        std::vector<T1> u;
+        crossings(a, b, u);
+        sxyz<T1> d = b - a;
+        T1 len = std::sqrt( d.x*d.x + d.y*d.y + d.z*d.z );
+        T1 t = 0.0;
+        for ( size_t n=1; n<u.size(); ++n ) {
+            T1 um = 0.5*(u[n-1]+u[n]);
+            t += (u[n]-u[n-1])*len*slowness[ getCellNo(a + um*d) ];
+        }
+        return t;
+    }
+
+    template<typename T1, typename T2>
+    T1 Grid3Drcfm<T1,T2>::localUpdate(const T2 i, const T2 j, const T2 k, const T2 m,
+                                      const sxyz<T1>& Tx, const T1 t0, const T1 s0,
+                                      const std::vector<T1>& t,
+                                      const std::vector<bool>& frozen) const {
+
+        // smallest travel time at node (i,j,k) from the frozen nodes of the
+        // sub-cells shared with node m, the node just frozen
+
+        // factored form t = t0 + T0*tau, T0 = s0*|x-Tx|
+        // nodes closer than dmin to the source are considered at the source
+        T1 dmin = small*std::min(hx, std::min(hy, hz));
+        sxyz<T1> pn = nodeCoord(i, j, k);
+        T1 dist = pn.getDistance(Tx);
+        if ( dist < dmin ) dist = 0.0;
+        T1 T0 = s0*dist;
+        const T1 T0d[3] = {
+            dist > 0.0 ? s0*(pn.x-Tx.x)/dist : 0.0,
+            dist > 0.0 ? s0*(pn.y-Tx.y)/dist : 0.0,
+            dist > 0.0 ? s0*(pn.z-Tx.z)/dist : 0.0 };
+        const T1 h[3] = {hx, hy, hz};
+
+        T1 tmin = std::numeric_limits<T1>::max();
+        for ( int di=-1; di<=1; di+=2 ) {
+            if ( (di<0 && i==0) || (di>0 && i==nnx-1) ) continue;
+            for ( int dj=-1; dj<=1; dj+=2 ) {
+                if ( (dj<0 && j==0) || (dj>0 && j==nny-1) ) continue;
+                for ( int dk=-1; dk<=1; dk+=2 ) {
+                    if ( (dk<0 && k==0) || (dk>0 && k==nnz-1) ) continue;
+
+                    // the 7 other nodes of the sub-cell, bit n set for a step along axis n
+                    T2 nb[8];
+                    bool contains_m = false;
+                    for ( int b=1; b<8; ++b ) {
+                        nb[b] = nodeNo(i + ((b&1) ? di : 0),
+                                       j + ((b&2) ? dj : 0),
+                                       k + ((b&4) ? dk : 0));
+                        if ( nb[b] == m ) contains_m = true;
+                    }
+                    if ( !contains_m ) continue;
+
+                    T1 s = subSlowness( di<0 ? i-1 : i, dj<0 ? j-1 : j, dk<0 ? k-1 : k );
+
+                    // transmission along edges and diagonals of the sub-cell
+                    for ( int b=1; b<8; ++b ) {
+                        if ( !frozen[nb[b]] ) continue;
+                        T1 l2 = 0.0;
+                        for ( int n=0; n<3; ++n ) {
+                            if ( b & (1<<n) ) l2 += h[n]*h[n];
+                        }
+                        tmin = std::min(tmin, t[nb[b]] + std::sqrt(l2)*s);
+                    }
+
+                    if ( T0 == 0.0 ) continue;
+
+                    // upwind differences of tau along axes with a frozen
+                    // neighbour, (a*tau - b) is the derivative of t
+                    const int dd[3] = {di, dj, dk};
+                    T1 a[3], bb[3];
+                    bool f[3];
+                    bool valid = true;
+                    for ( int n=0; n<3; ++n ) {
+                        T2 nn = nb[1<<n];
+                        f[n] = frozen[nn];
+                        a[n] = T0d[n];
+                        bb[n] = 0.0;
+                        if ( f[n] ) {
+                            sxyz<T1> p = nodeCoord(i + (n==0 ? di : 0),
+                                                   j + (n==1 ? dj : 0),
+                                                   k + (n==2 ? dk : 0));
+                            T1 dN = p.getDistance(Tx);
+                            if ( dN < dmin ) {
+                                valid = false;
+                                break;
+                            }
+                            a[n] += -dd[n]*T0/h[n];
+                            bb[n] = -dd[n]*T0*(t[nn]-t0)/(s0*dN)/h[n];
+                        }
+                    }
+                    if ( !valid ) continue;
+
+                    // updates using all three axes, or two of them with the
+                    // derivative of t null along the third one
+                    for ( int set=3; set<8; ++set ) {
+                        if ( set==4 ) continue;  // subsets with a single axis are not used
+                        bool ok = true;
+                        for ( int n=0; n<3; ++n ) {
+                            if ( (set & (1<<n)) && !f[n] ) ok = false;
+                        }
+                        if ( !ok ) continue;
+                        T1 qa = 0.0, qb = 0.0, qc = -s*s;
+                        for ( int n=0; n<3; ++n ) {
+                            if ( set & (1<<n) ) {
+                                qa += a[n]*a[n];
+                                qb += a[n]*bb[n];
+                                qc += bb[n]*bb[n];
+                            }
+                        }
+                        T1 disc = qb*qb - qa*qc;
+                        if ( qa == 0.0 || disc < 0.0 ) continue;
+                        T1 tp = t0 + T0*(qb + std::sqrt(disc))/qa;
+                        // causality
+                        bool causal = true;
+                        for ( int n=0; n<3; ++n ) {
+                            if ( (set & (1<<n)) && tp < t[nb[1<<n]] ) causal = false;
+                        }
+                        if ( causal ) {
+                            tmin = std::min(tmin, tp);
+                        }
+                    }
+                }
+            }
+        }
+        return tmin;
+    }
+
+    template<typename T1, typename T2>
+    void Grid3Drcfm<T1,T2>::solve(const std::vector<sxyz<T1>>& Tx,
+                                  const std::vector<T1>& t0,
+                                  const size_t threadNo) const {
+
+        std::vector<T1>& t = tt[threadNo];
+        t.assign( getNumberOfNodes(), std::numeric_limits<T1>::max() );
+        std::vector<bool> frozen( t.size(), false );
+
+        typedef std::pair<T1,T2> heapElem;
+        std::priority_queue<heapElem, std::vector<heapElem>, std::greater<heapElem>> narrowBand;
+
+        // nodes of the cells around the sources get straight ray travel times
+        for ( size_t ns=0; ns<Tx.size(); ++ns ) {
+            T2 cellNo = getCellNo( Tx[ns] );
+            T2 ic = cellNo / (ncy*ncz);
+            T2 jc = (cellNo / ncz) % ncy;
+            T2 kc = cellNo % ncz;
+            T2 i1 = ic > 0 ? (ic-1)*nsx : 0;
+            T2 i2 = std::min(ic+2, ncx)*nsx;
+            T2 j1 = jc > 0 ? (jc-1)*nsy : 0;
+            T2 j2 = std::min(jc+2, ncy)*nsy;
+            T2 k1 = kc > 0 ? (kc-1)*nsz : 0;
+            T2 k2 = std::min(kc+2, ncz)*nsz;
+            for ( T2 i=i1; i<=i2; ++i ) {
+                for ( T2 j=j1; j<=j2; ++j ) {
+                    for ( T2 k=k1; k<=k2; ++k ) {
+                        T1 tn = t0[ns] + straightRayTime(Tx[ns], nodeCoord(i, j, k));
+                        T2 n = nodeNo(i, j, k);
+                        if ( tn < t[n] ) {
+                            t[n] = tn;
+                            narrowBand.push( heapElem(tn, n) );
+                        }
+                    }
+                }
+            }
+        }
+
+        // the factored form uses the first source and the slowness at its location
+        T1 s0 = slowness[ getCellNo(Tx[0]) ];
+
+        while ( !narrowBand.empty() ) {
+            heapElem e = narrowBand.top();
+            narrowBand.pop();
+            T2 n = e.second;
+            if ( frozen[n] || e.first > t[n] ) {
+                continue;  // outdated entry
+            }
+            frozen[n] = true;
+
+            T2 i = n / (nny*nnz);
+            T2 j = (n / nnz) % nny;
+            T2 k = n % nnz;
+            T2 i1 = i > 0 ? i-1 : 0;
+            T2 i2 = i < nnx-1 ? i+1 : i;
+            T2 j1 = j > 0 ? j-1 : 0;
+            T2 j2 = j < nny-1 ? j+1 : j;
+            T2 k1 = k > 0 ? k-1 : 0;
+            T2 k2 = k < nnz-1 ? k+1 : k;
+            for ( T2 ii=i1; ii<=i2; ++ii ) {
+                for ( T2 jj=j1; jj<=j2; ++jj ) {
+                    for ( T2 kk=k1; kk<=k2; ++kk ) {
+                        T2 nn = nodeNo(ii, jj, kk);
+                        if ( frozen[nn] ) continue;
+                        T1 tn = localUpdate(ii, jj, kk, n, Tx[0], t0[0], s0, t, frozen);
+                        if ( tn < t[nn] ) {
+                            t[nn] = tn;
+                            narrowBand.push( heapElem(tn, nn) );
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+    template<typename T1, typename T2>
+    T1 Grid3Drcfm<T1,T2>::interpTT(const sxyz<T1>& Rx, const sxyz<T1>& Tx, const T1 t0,
+                                   const std::vector<T1>& t) const {
+
+        // tau rather than t is interpolated trilinearly, t varies as the
+        // distance to the source and would be overestimated between nodes
+        T2 i, j, k;
+        subCell(Rx, i, j, k);
+        T1 u = (Rx.x - (xmin+i*hx))/hx;
+        T1 v = (Rx.y - (ymin+j*hy))/hy;
+        T1 w = (Rx.z - (zmin+k*hz))/hz;
+        T1 dmin = small*std::min(hx, std::min(hy, hz));
+        T1 s0 = slowness[ getCellNo(Tx) ];
+        T1 d = Rx.getDistance(Tx);
+        T1 tau = 0.0, val = 0.0;
+        for ( T2 a=0; a<2; ++a ) {
+            for ( T2 b=0; b<2; ++b ) {
+                for ( T2 c=0; c<2; ++c ) {
+                    T1 f = (a ? u : 1.-u)*(b ? v : 1.-v)*(c ? w : 1.-w);
+                    T2 n = nodeNo(i+a, j+b, k+c);
+                    T1 dn = nodeCoord(i+a, j+b, k+c).getDistance(Tx);
+                    tau += f*( dn > dmin ? (t[n]-t0)/(s0*dn) : 1.0 );
+                    val += f*t[n];
+                }
+            }
+        }
+        // close to the source, travel times are interpolated directly
+        return d > std::max(hx, std::max(hy, hz)) ? t0 + s0*d*tau : val;
+    }
+
+    template<typename T1, typename T2>
+    void Grid3Drcfm<T1,T2>::getRaypath(const std::vector<sxyz<T1>>& Tx,
+                                       const T1 t0,
+                                       const sxyz<T1>& Rx,
+                                       std::vector<sxyz<T1>>& r_data,
+                                       const size_t threadNo) const {
+
+        // steepest descent from Rx, the path is returned from Tx to Rx.
+        // The gradient is computed from the factored form t = t0 + T0*tau,
+        // with tau interpolated trilinearly.
+        const std::vector<T1>& t = tt[threadNo];
+        T1 h = 0.5*std::min(hx, std::min(hy, hz));
+        T1 dmin = small*std::min(hx, std::min(hy, hz));
+        T1 s0 = slowness[ getCellNo(Tx[0]) ];
+        size_t maxStep = 10*(size_t(nnx) + nny + nnz);
+
+        r_data.clear();
+        r_data.push_back( Rx );
+        sxyz<T1> pt = Rx;
+        for ( size_t step=0; step<maxStep; ++step ) {
+
+            // stop when a source is reached
+            bool reached = false;
+            for ( size_t ns=0; ns<Tx.size(); ++ns ) {
+                if ( pt.getDistance(Tx[ns]) <= h ) {
+                    if ( pt.getDistance(Tx[ns]) > dmin ) {
+                        r_data.push_back( Tx[ns] );
+                    }
+                    reached = true;
+                    break;
+                }
+            }
+            if ( reached ) break;
+
+            T2 i, j, k;
+            subCell(pt, i, j, k);
+            T1 w[3] = {(pt.x - (xmin+i*hx))/hx, (pt.y - (ymin+j*hy))/hy, (pt.z - (zmin+k*hz))/hz};
+            T1 tau[2][2][2];
+            for ( T2 a=0; a<2; ++a ) {
+                for ( T2 b=0; b<2; ++b ) {
+                    for ( T2 c=0; c<2; ++c ) {
+                        T1 d = nodeCoord(i+a, j+b, k+c).getDistance(Tx[0]);
+                        tau[a][b][c] = d > dmin ? (t[nodeNo(i+a,j+b,k+c)]-t0)/(s0*d) : 1.0;
+                    }
+                }
+            }
+            // trilinear interpolation of tau and of its derivatives
+            T1 taup = 0.0, taud[3] = {0.0, 0.0, 0.0};
+            for ( T2 a=0; a<2; ++a ) {
+                for ( T2 b=0; b<2; ++b ) {
+                    for ( T2 c=0; c<2; ++c ) {
+                        T1 fx = a ? w[0] : 1.-w[0];
+                        T1 fy = b ? w[1] : 1.-w[1];
+                        T1 fz = c ? w[2] : 1.-w[2];
+                        taup += fx*fy*fz*tau[a][b][c];
+                        taud[0] += (a ? 1. : -1.)*fy*fz*tau[a][b][c]/hx;
+                        taud[1] += fx*(b ? 1. : -1.)*fz*tau[a][b][c]/hy;
+                        taud[2] += fx*fy*(c ? 1. : -1.)*tau[a][b][c]/hz;
+                    }
+                }
+            }
+            T1 d = pt.getDistance(Tx[0]);
+            sxyz<T1> g(s0*(taup*(pt.x-Tx[0].x)/d + d*taud[0]),
+                       s0*(taup*(pt.y-Tx[0].y)/d + d*taud[1]),
+                       s0*(taup*(pt.z-Tx[0].z)/d + d*taud[2]));
+            T1 gn = std::sqrt( g.x*g.x + g.y*g.y + g.z*g.z );
+            if ( gn == 0.0 ) break;
+
+            pt -= (h/gn)*g;
+            pt.x = std::min(std::max(pt.x, xmin), xmax);
+            pt.y = std::min(std::max(pt.y, ymin), ymax);
+            pt.z = std::min(std::max(pt.z, zmin), zmax);
+            r_data.push_back( pt );
+        }
+        std::reverse(r_data.begin(), r_data.end());
+    }
+
+    template<typename T1, typename T2>
+    void Grid3Drcfm<T1,T2>::getLdata(const std::vector<sxyz<T1>>& r_data,
+                                     std::vector<siv<T1>>& l_data) const {
+
+        // length of ray segments within cells, sorted by cell index
+        std::vector<std::pair<T2,T1>> seg;
+        std::vector<T1> u;
+        for ( size_t n=1; n<r_data.size(); ++n ) {
+            const sxyz<T1>& a = r_data[n-1];
+            sxyz<T1> d = r_data[n] - a;
+            T1 len = std::sqrt( d.x*d.x + d.y*d.y + d.z*d.z );
+            crossings(a, r_data[n], u);
+            for ( size_t nu=1; nu<u.size(); ++nu ) {
+                T1 um = 0.5*(u[nu-1]+u[nu]);
+                seg.push_back( std::make_pair(getCellNo(a + um*d), (u[nu]-u[nu-1])*len) );
+            }
+        }
+        std::sort(seg.begin(), seg.end());
+
+        l_data.clear();
+        for ( size_t n=0; n<seg.size(); ++n ) {
+            if ( seg[n].second == 0.0 ) continue;
+            if ( !l_data.empty() && l_data.back().i == seg[n].first ) {
+                l_data.back().v += seg[n].second;
+            } else {
+                siv<T1> s;
+                s.i = seg[n].first;
+                s.v = seg[n].second;
+                l_data.push_back( s );
+            }
+        }
+        l_data.shrink_to_fit();
+    }
+
+    template<typename T1, typename T2>
+    int Grid3Drcfm<T1,T2>::raytrace(const std::vector<sxyz<T1>>& Tx,
+                                    const std::vector<T1>& t0,
+                                    const std::vector<sxyz<T1>>& Rx,
+                                    std::vector<T1>& traveltimes,
+                                    std::vector<std::vector<sxyz<T1>>>* r_data,
+                                    std::vector<std::vector<siv<T1>>>* l_data,
+                                    const size_t threadNo) const {
+
+        if ( checkPts(Tx) == 1 ) return 1;
+        if ( checkPts(Rx) == 1 ) return 1;
+
+        solve(Tx, t0, threadNo);
+
+        traveltimes.resize( Rx.size() );
+        for ( size_t n=0; n<Rx.size(); ++n ) {
+            traveltimes[n] = interpTT(Rx[n], Tx[0], t0[0], tt[threadNo]);
+        }
+
+        if ( r_data != nullptr || l_data != nullptr ) {
+            std::vector<sxyz<T1>> path;
+            if ( r_data != nullptr ) r_data->resize( Rx.size() );
+            if ( l_data != nullptr ) l_data->resize( Rx.size() );
+            for ( size_t n=0; n<Rx.size(); ++n ) {
+                getRaypath(Tx, t0[0], Rx[n], path, threadNo);
+                if ( l_data != nullptr ) {
+                    getLdata(path, (*l_data)[n]);
+                }
+                if ( r_data != nullptr ) {
+                    (*r_data)[n].swap( path );
+                }
+            }
+        }
+        return 0;
+    }
+
+}
+
+#endif /* Grid3Drcfm_h */
@@ -0,0 +1,303 @@
+//
+//  Grid3Dttcr.cpp
+//  ttcr
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+#include <algorithm>
+#include <functional>
+#include <stdexcept>
+
+#include "Grid3Dttcr.h"
+
+using namespace std;
+
+
+namespace ttcr {
+
+    Grid3Dttcr::Grid3Dttcr(std::string& _type,
+                           uint32_t nx, uint32_t ny, uint32_t nz,
+                           double dx, double dy, double dz,
+                           double xmin, double ymin, double zmin,
+                           uint32_t nsnx, uint32_t nsny, uint32_t nsnz,
+                           size_t nthreads) : type(_type) {
+
+        if ( type.compare("iso")==0 ) {
+            grid_instance = new grid3dfm(nx, ny, nz,
+                                         dx, dy, dz,
+                                         xmin, ymin, zmin,
+                                         nsnx, nsny, nsnz,
+                                         nthreads);
+        } else {
+            throw invalid_argument("Raytracing in 3D is only implemented for isotropic media.");
+        }
+    }
+
+    void Grid3Dttcr::setSlowness(const double* slowness, const size_t n) {
+        if ( grid_instance->setSlowness( vector<double>(slowness, slowness+n) ) == 1 ) {
+            throw out_of_range("Slowness values must be defined for each grid cell.");
+        }
+    }
+
+    void Grid3Dttcr::groupTx(const double* Tx,
+                             const double* tTx,
+                             const size_t nTx,
+                             vector<vector<sxyz<double>>>& vTx,
+                             vector<vector<double>>& t0,
+                             vector<vector<size_t>>& iTx) const {
+
+        /*
+         Looking for redundants Tx pts
+         */
+
+        vTx.push_back( vector<sxyz<double> >(1, sxyz<double>(Tx[0], Tx[1], Tx[2])) );
+        t0.push_back( vector<double>(1, tTx[0]) );
+        iTx.push_back( vector<size_t>(1, 0) );  // indices of Rx corresponding to current Tx
+        for ( size_t ntx=1; ntx<nTx; ++ntx ) {
+            sxyz<double> tx(Tx[3*ntx], Tx[3*ntx+1], Tx[3*ntx+2]);
+            bool found = false;
+
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                if ( vTx[nv][0]==tx ) {
+                    found = true;
+                    iTx[nv].push_back( ntx ) ;
+                    break;
+                }
+            }
+            if ( !found ) {
+                vTx.push_back( vector<sxyz<double>>(1, tx) );
+                t0.push_back( vector<double>(1, tTx[ntx]) );
+                iTx.push_back( vector<size_t>(1, ntx) );
+            }
+        }
+    }
+
+    int Grid3Dttcr::raytrace(const double* Tx_p,
+                             const double* tTx,
+                             const double* Rx_p,
+                             const size_t nTx,
+                             double* traveltimes,
+                             vector<vector<siv<double>>>* L_data,
+                             vector<vector<sxyz<double>>>* r_data) const {
+
+        // L_data and r_data are optional (nullptr if not needed)
+
+        vector<vector<sxyz<double>>> vTx;
+        vector<vector<double>> t0;
+        vector<vector<size_t>> iTx;
+        groupTx(Tx_p, tTx, nTx, vTx, t0, iTx);
+
+        /*
+         Looping over all non redundant Tx
+         */
+
+        vector<vector<double>> tt( vTx.size() );
+        vector<vector<vector<sxyz<double>>>> r_tmp( r_data==nullptr ? 0 : vTx.size() );
+        vector<vector<vector<siv<double>>>> l_data( L_data==nullptr ? 0 : vTx.size() );
+
+        grid3dfm *grid_ref = grid_instance;
+        auto solve = [&grid_ref,&vTx,&tt,&t0,Rx_p,&iTx,&r_tmp,&l_data,
+                      L_data,r_data](const size_t nv, const size_t threadNo) {
+            vector<sxyz<double>> vRx;
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                const double* rx = Rx_p + 3*iTx[nv][ni];
+                vRx.push_back( sxyz<double>(rx[0], rx[1], rx[2]) );
+            }
+            if ( grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv],
+                                    r_data==nullptr ? nullptr : &r_tmp[nv],
+                                    L_data==nullptr ? nullptr : &l_data[nv],
+                                    threadNo) == 1 ) {
+                throw runtime_error("Problem while raytracing.");
+            }
+        };
+
+        // groups with more receivers are solved first, threads then take
+        // the next group as soon as they are done (see runTasks)
+        vector<size_t> order( vTx.size() );
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) order[nv] = nv;
+        std::stable_sort(order.begin(), order.end(), [&iTx](const size_t a, const size_t b) {
+            return iTx[a].size() > iTx[b].size();
+        });
+        auto task = [&solve,&order](const size_t n, const size_t threadNo) {
+            solve(order[n], threadNo);
+        };
+        runTasks(grid_instance->getNthreads(), order.size(), task, threadTime, threadCount);
+
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                traveltimes[ iTx[nv][ni] ] = tt[nv][ni];
+            }
+        }
+
+        // rays and rows of L are moved in the order of the input Tx-Rx pairs
+        if ( r_data != nullptr ) {
+            r_data->resize( nTx );
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                    (*r_data)[ iTx[nv][ni] ].swap( r_tmp[nv][ni] );
+                }
+            }
+        }
+        if ( L_data != nullptr ) {
+            L_data->resize( nTx );
+            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                    (*L_data)[ iTx[nv][ni] ].swap( l_data[nv][ni] );
+                }
+            }
+        }
+
+        return 0;
+    }
+
+    size_t Grid3Dttcr::getLindptr(const vector<vector<siv<double>>>& L_data,
+                                  int64_t* indptr) const {
+
+        // indptr has size nrow+1, nnz is returned
+        size_t k = 0;
+        for ( size_t i=0; i<L_data.size(); ++i ) {
+            indptr[i] = k;
+            k += L_data[i].size();
+        }
+        indptr[L_data.size()] = k;
+        return k;
+    }
+
+    void Grid3Dttcr::fillL(vector<vector<siv<double>>>& L_data,
+                           int32_t* indices,
+                           double* data) const {
+
+        // elements of L_data are sorted by cell index, columns of each
+        // row are thus written in increasing order
+        size_t k = 0;
+        for ( size_t i=0; i<L_data.size(); ++i ) {
+            for ( size_t n=0; n<L_data[i].size(); ++n, ++k ) {
+                indices[k] = static_cast<int32_t>( L_data[i][n].i );
+                data[k] = L_data[i][n].v;
+            }
+            vector<siv<double>>().swap( L_data[i] );
+        }
+    }
+
+    int Grid3Dttcr::Lsr3d(const double* Tx,
+                          const double* Rx,
+                          const size_t nTx,
+                          const double* grx,
+                          const size_t n_grx,
+                          const double* gry,
+                          const size_t n_gry,
+                          const double* grz,
+                          const size_t n_grz,
+                          const bool aniso,
+                          PyObject* L) {
+
+        const double* gr[3] = {grx, gry, grz};
+        const size_t ngr[3] = {n_grx, n_gry, n_grz};
+        const size_t ncell = (n_grx-1)*(n_gry-1)*(n_grz-1);
+
+        // a straight ray crosses at most n_grx+n_gry+n_grz-5 cells
+        const size_t fac = aniso ? 2 : 1;
+        size_t nLmax = fac * nTx * (n_grx + n_gry + n_grz - 5);
+
+        double* data_p = (double*)malloc( nLmax*sizeof(double) );
+        int32_t* indices_p = (int32_t*)malloc( nLmax*sizeof(int32_t) );
+        int64_t* indptr_p = (int64_t*)malloc( (nTx+1)*sizeof(int64_t) );
+
+        size_t k = 0;
+        vector<double> u;
+        vector<pair<size_t,double>> seg;
+        for ( size_t n=0; n<nTx; ++n ) {
+            indptr_p[n] = k;
+
+            const double a[3] = {Tx[3*n], Tx[3*n+1], Tx[3*n+2]};
+            const double d[3] = {Rx[3*n]-a[0], Rx[3*n+1]-a[1], Rx[3*n+2]-a[2]};
+            const double len = sqrt( d[0]*d[0] + d[1]*d[1] + d[2]*d[2] );
+            const double lenh = sqrt( d[0]*d[0] + d[1]*d[1] );
+
+            // parameters of the crossings with the grid planes
+            u.assign(1, 0.0);
+            for ( size_t m=0; m<3; ++m ) {
+                if ( d[m] == 0.0 ) continue;
+                double v1 = d[m] > 0 ? a[m] : a[m]+d[m];
+                double v2 = d[m] > 0 ? a[m]+d[m] : a[m];
+                const double* p = upper_bound(gr[m], gr[m]+ngr[m], v1);
+                for ( ; p<gr[m]+ngr[m] && *p<v2; ++p ) {
+                    u.push_back( (*p-a[m])/d[m] );
+                }
+            }
+            u.push_back( 1.0 );
+            sort(u.begin(), u.end());
+
+            seg.clear();
+            for ( size_t nu=1; nu<u.size(); ++nu ) {
+                double du = u[nu]-u[nu-1];
+                if ( du <= 0.0 ) continue;
+                double um = 0.5*(u[nu-1]+u[nu]);
+                size_t ic[3];
+                for ( size_t m=0; m<3; ++m ) {
+                    double v = a[m] + um*d[m];
+                    size_t i = upper_bound(gr[m], gr[m]+ngr[m], v) - gr[m];
+                    ic[m] = i==0 ? 0 : (i>ngr[m]-1 ? ngr[m]-2 : i-1);
+                }
+                seg.push_back( make_pair((ic[0]*(n_gry-1) + ic[1])*(n_grz-1) + ic[2], du) );
+            }
+            sort(seg.begin(), seg.end());
+
+            if ( k + fac*seg.size() > nLmax ) {
+                // rays starting or ending outside the grid
+                nLmax = k + fac*seg.size() + fac*(nTx-n)*(n_grx + n_gry + n_grz - 5);
+                data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
+                indices_p = (int32_t*)realloc( indices_p, nLmax*sizeof(int32_t) );
+            }
+            for ( size_t ns=0; ns<seg.size(); ++ns, ++k ) {
+                indices_p[k] = static_cast<int32_t>( seg[ns].first );
+                data_p[k] = seg[ns].second*(aniso ? lenh : len);
+            }
+            if ( aniso ) {
+                for ( size_t ns=0; ns<seg.size(); ++ns, ++k ) {
+                    indices_p[k] = static_cast<int32_t>( seg[ns].first + ncell );
+                    data_p[k] = seg[ns].second*fabs(d[2]);
+                }
+            }
+        }
+
+        indptr_p[nTx] = k;
+        size_t nnz = k;
+
+        // keep at least one element, realloc of size 0 may return NULL
+        data_p = (double*)realloc( data_p, (nnz>0 ? nnz : 1)*sizeof(double) );
+        indices_p = (int32_t*)realloc( indices_p, (nnz>0 ? nnz : 1)*sizeof(int32_t) );
+
+        import_array1(-1);  // to use PyArray_SimpleNewFromData, returns -1 on failure
+
+        npy_intp dims[] = {static_cast<npy_intp>(nnz)};
+        PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
+        PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT32, indices_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
+        dims[0] = nTx+1;
+        PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
+        PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
+        PyTuple_SetItem(L, 0, data);
+        PyTuple_SetItem(L, 1, indices);
+        PyTuple_SetItem(L, 2, indptr);
+
+        return 0;
+    }
+
+}
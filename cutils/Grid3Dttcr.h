@@ -0,0 +1,113 @@
+//
+//  Grid3Dttcr.h
+//  ttcr
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+#ifndef Grid3Dttcr_h
+#define Grid3Dttcr_h
+
+
+
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include "Python.h"
+#include "numpy/ndarrayobject.h"
+
+#include <string>
+#include <vector>
+
+#include "Grid3Drcfm.h"
+#include "Scheduler.h"
+
+
+namespace ttcr {
+
+    typedef Grid3Drcfm<double,uint32_t> grid3dfm;
+
+    class Grid3Dttcr {
+    public:
+        Grid3Dttcr(std::string&, uint32_t, uint32_t, uint32_t, double, double, double,
+                   double, double, double, uint32_t, uint32_t, uint32_t, size_t);
+        ~Grid3Dttcr() {
+            delete grid_instance;
+        }
+        std::string getType() const { return type; }
+
+        void setSlowness(const double* slowness, const size_t n);
+
+        // time (s) spent raytracing and number of Tx groups solved by each
+        // thread during the last call to raytrace
+        const std::vector<double>& getThreadTime() const { return threadTime; }
+        const std::vector<size_t>& getThreadCount() const { return threadCount; }
+
+        // Tx and Rx are C-ordered (nTx x 3) arrays
+        // L_data and r_data are computed only if not null
+        int raytrace(const double* Tx,
+                     const double* tTx,
+                     const double* Rx,
+                     const size_t nTx,
+                     double* traveltimes,
+                     std::vector<std::vector<siv<double>>>* L_data,
+                     std::vector<std::vector<sxyz<double>>>* r_data) const;
+
+        // L_data holds the rows of the ray projection matrix, it is
+        // converted in CSR format in two steps: getLindptr returns nnz and
+        // fills indptr (size nrow+1), fillL fills indices and data (size nnz).
+        // Column indices are 32 bit integers, and the rows of L_data are
+        // released as they are copied so that L is not held twice in memory.
+        size_t getLindptr(const std::vector<std::vector<siv<double>>>& L_data,
+                          int64_t* indptr) const;
+
+        void fillL(std::vector<std::vector<siv<double>>>& L_data,
+                   int32_t* indices,
+                   double* data) const;
+
+        // straight rays, L is a tuple (data, indices, indptr) of a CSR matrix
+        // with ncell columns, or 2*ncell columns for anisotropic media (aniso
+        // true), horizontal components first followed by vertical ones
+        static int Lsr3d(const double* Tx,
+                         const double* Rx,
+                         const size_t nTx,
+                         const double* grx,
+                         const size_t n_grx,
+                         const double* gry,
+                         const size_t n_gry,
+                         const double* grz,
+                         const size_t n_grz,
+                         const bool aniso,
+                         PyObject* L);
+
+    private:
+        const std::string type;
+        grid3dfm *grid_instance;
+        mutable std::vector<double> threadTime;
+        mutable std::vector<size_t> threadCount;
+
+        Grid3Dttcr() {}
+
+        void groupTx(const double* Tx,
+                     const double* tTx,
+                     const size_t nTx,
+                     std::vector<std::vector<sxyz<double>>>& vTx,
+                     std::vector<std::vector<double>>& t0,
+                     std::vector<std::vector<size_t>>& iTx) const;
+    };
+
+}
+
+#endif /* Grid3Dttcr_h */
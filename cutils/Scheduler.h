@@ -0,0 +1,93 @@
+//
+//  Scheduler.h
+//  ttcr
+//
+//  Dynamic scheduling of independent tasks over threads
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+#ifndef Scheduler_h
+#define Scheduler_h
+
+#include <atomic>
+#include <chrono>
+#include <exception>
+#include <thread>
+#include <vector>
+
+namespace ttcr {
+
+    /*
+     * Run task(n, threadNo) for n = 0 to nTasks-1 on at most nThreads
+     * threads (threadNo 0 is the calling thread).  Instead of splitting the
+     * tasks in equal blocks, each thread takes the next task from a shared
+     * counter when it is done with the previous one, so that threads stay
+     * busy when tasks have very different costs.  Tasks should thus be
+     * ordered from the most to the least expensive.
+     *
+     * On return, time[i] holds the time (s) spent in tasks by thread i and
+     * count[i] the number of tasks it ran.  The first exception thrown by a
+     * task is rethrown once all threads are done.
+     */
+    template<typename F>
+    void runTasks(const size_t nThreads, const size_t nTasks, F& task,
+                  std::vector<double>& time, std::vector<size_t>& count) {
+
+        size_t num_threads = nThreads < nTasks ? nThreads : nTasks;
+        if ( num_threads == 0 ) num_threads = 1;
+        time.assign(num_threads, 0.0);
+        count.assign(num_threads, 0);
+
+        std::atomic<size_t> next(0);
+        std::atomic<bool> failed(false);
+        std::vector<std::exception_ptr> errors(num_threads);
+
+        auto worker = [&](const size_t threadNo) {
+            auto start = std::chrono::steady_clock::now();
+            try {
+                for ( size_t n=next++; n<nTasks && !failed; n=next++ ) {
+                    task(n, threadNo);
+                    count[threadNo]++;
+                }
+            } catch (...) {
+                errors[threadNo] = std::current_exception();
+                failed = true;
+            }
+            std::chrono::duration<double> elapsed = std::chrono::steady_clock::now() - start;
+            time[threadNo] = elapsed.count();
+        };
+
+        std::vector<std::thread> threads;
+        for ( size_t i=1; i<num_threads; ++i ) {
+            threads.push_back( std::thread(worker, i) );
+        }
+        worker(0);
+        for ( size_t i=0; i<threads.size(); ++i ) {
+            threads[i].join();
+        }
+
+        for ( size_t i=0; i<num_threads; ++i ) {
+            if ( errors[i] ) {
+                std::rethrow_exception( errors[i] );
+            }
+        }
+    }
+
+}
+
+#endif /* Scheduler_h */
@@ -21,29 +21,38 @@
 
 from libcpp.string cimport string
 from libcpp.vector cimport vector
-from libc.stdint cimport uint32_t
+from libc.stdint cimport uint32_t, int64_t
 
 import numpy as np
 cimport numpy as np
 
 from scipy.sparse import csr_matrix
 
-from utils import nargout
-
 cdef extern from "ttcr_t.h" namespace "ttcr":
     cdef cppclass sxz[T]:
         sxz(T, T) except +
+        T x
+        T z
+    cdef cppclass siv2[T]:
+        pass
 
 
 cdef extern from "Grid2Dttcr.h" namespace "ttcr":
-    cdef cppclass Grid2Dttcr:
-        Grid2Dttcr(string&, uint32_t, uint32_t, double, double, double, double, uint32_t, uint32_t, size_t) except +
+    cdef cppclass Grid2Dttcr[T]:
+        Grid2Dttcr(string&, uint32_t, uint32_t, double, double, double, double, uint32_t, uint32_t, size_t, string&) except +
         string getType()
-        void setSlowness(const vector[double]&) except +
-        void setXi(const vector[double]&) except +
-        void setTheta(const vector[double]&) except +
-        int raytrace(vector[sxz[double]]&,vector[double]&,vector[sxz[double]]&,double*,object,object)
-        int raytrace(vector[sxz[double]]&,vector[double]&,vector[sxz[double]]&,double*,object)
+        const vector[double]& getThreadTime()
+        const vector[size_t]& getThreadCount()
+        void setSlowness(const double*, size_t) except +
+        void setXi(const double*, size_t) except +
+        void setTheta(const double*, size_t) except +
+        int raytrace(const double*,const double*,const double*,size_t,double*,vector[vector[siv2[T]]]*,vector[vector[sxz[T]]]*) except +
+        int raytraceBatch(const double*,size_t,const double*,const double*,size_t,const double*,const double*,const double*,size_t,double*,vector[vector[vector[siv2[T]]]]*) except +
+        size_t getLindptr(const vector[vector[siv2[T]]]&, int64_t*)
+        void fillL(const vector[vector[siv2[T]]]&, int64_t*, T*)
+        void setTTCacheSize(size_t)
+        void clearTTCache()
+        void getTTCacheStats(size_t&, size_t&, size_t&, size_t&)
         @staticmethod
         int Lsr2d(double*,double*,size_t,double*,size_t,double*,size_t,object)
         @staticmethod
@@ -52,95 +61,354 @@ cdef extern from "Grid2Dttcr.h" namespace "ttcr":
 
 
 cdef class Grid2Dcpp:
-    cdef Grid2Dttcr* grid
+    # only one of grid (double precision) and gridf (single precision) is
+    # instantiated
+    cdef Grid2Dttcr[double]* grid
+    cdef Grid2Dttcr[float]* gridf
     def __cinit__(self, gridType, uint32_t nx, uint32_t nz, double dx, double dz,
                   double xmin, double zmin,uint32_t nsnx, uint32_t nsnz,
-                  size_t nthreads):
-        self.grid = new Grid2Dttcr(gridType, nx, nz, dx, dz, xmin, zmin, nsnx, nsnz, nthreads)
+                  size_t nthreads, method=b'spm', precision=b'double'):
+        # method: b'spm' for the shortest path method, b'fmm' for fast marching
+        # precision: b'double', or b'single' to compute in float32 (slowness,
+        #            travel times, ray paths and L), which halves the memory used
+        self.grid = NULL
+        self.gridf = NULL
+        if precision == b'double':
+            self.grid = new Grid2Dttcr[double](gridType, nx, nz, dx, dz, xmin, zmin, nsnx, nsnz, nthreads, method)
+        elif precision == b'single':
+            self.gridf = new Grid2Dttcr[float](gridType, nx, nz, dx, dz, xmin, zmin, nsnx, nsnz, nthreads, method)
+        else:
+            raise ValueError('precision should be double or single')
 
     def __dealloc__(self):
-        del self.grid
+        if self.grid != NULL:
+            del self.grid
+        if self.gridf != NULL:
+            del self.gridf
 
     def getType(self):
+        if self.gridf != NULL:
+            return self.gridf.getType()
         return self.grid.getType()
 
-    def raytrace(self, slowness, xi, theta, Tx, Rx, t0):
+    def getPrecision(self):
+        return b'single' if self.gridf != NULL else b'double'
+
+    def getThreadStats(self):
+        """
+        Time (s) spent raytracing and number of Tx groups solved by each
+        thread during the last call to raytrace
+        """
+        if self.gridf != NULL:
+            return (np.array(self.gridf.getThreadTime(), dtype=np.double),
+                    np.array(self.gridf.getThreadCount(), dtype=np.int64))
+        return (np.array(self.grid.getThreadTime(), dtype=np.double),
+                np.array(self.grid.getThreadCount(), dtype=np.int64))
+
+    def setSlowness(self, double[::1] slowness):
+        """
+        Assign slowness values of the grid cells (contiguous float64 vector)
+        """
+        if self.gridf != NULL:
+            self.gridf.setSlowness(&slowness[0], slowness.shape[0])
+        else:
+            self.grid.setSlowness(&slowness[0], slowness.shape[0])
+
+    def setTTCacheSize(self, size_t max_bytes):
+        """
+        Set the maximum size (in bytes) of the cache of travel-time fields,
+        0 disables the cache
+        """
+        if self.gridf != NULL:
+            self.gridf.setTTCacheSize(max_bytes)
+        else:
+            self.grid.setTTCacheSize(max_bytes)
 
-        nout = nargout()
+    def clearTTCache(self):
+        if self.gridf != NULL:
+            self.gridf.clearTTCache()
+        else:
+            self.grid.clearTTCache()
+
+    def getTTCacheStats(self):
+        """
+        Returns number of fields in cache, size in bytes, number of hits and of misses
+        """
+        cdef size_t nFields = 0, nBytes = 0, nHits = 0, nMisses = 0
+        if self.gridf != NULL:
+            self.gridf.getTTCacheStats(nFields, nBytes, nHits, nMisses)
+        else:
+            self.grid.getTTCacheStats(nFields, nBytes, nHits, nMisses)
+        return nFields, nBytes, nHits, nMisses
+
+    def raytrace(self, double[::1] slowness, double[::1] xi, double[::1] theta,
+                 double[:, ::1] Tx, double[:, ::1] Rx, double[::1] t0,
+                 compute_L=True, compute_rays=False):
+        """
+        Raytracing
+
+        All input arguments must be C-contiguous float64 arrays; Tx and Rx are
+        (ndata x 3) and xi and theta are empty for isotropic grids.  Pointers
+        to the buffers are handed directly to the C++ grid, no copy is made on
+        the python side.
+
+        Returns tt, L, rays ; L and rays are None if not computed.  rays is a
+        tuple (xz, offsets) holding the packed coordinates of all ray paths,
+        ray n being xz[offsets[n]:offsets[n+1], :].  tt is float64; the data
+        of L are float32 in single precision, float64 otherwise.
+        """
         # check if types are consistent with input data
-        if len(xi) != 0:
-            if len(theta) != 0:
-                if self.grid.getType() != b'tilted':
+        gridType = self.getType()
+        if xi.shape[0] != 0:
+            if theta.shape[0] != 0:
+                if gridType != b'tilted':
                     raise TypeError('Grid should handle raytracing in tilted elliptically anisotropic media')
             else:
-                if self.grid.getType() != b'elliptical':
+                if gridType != b'elliptical':
                     raise TypeError('Grid should handle raytracing in elliptically anisotropic media')
         else:
-            if self.grid.getType() != b'iso':
+            if gridType != b'iso':
                 raise TypeError('Grid should handle raytracing in isotropic media')
 
+        if Tx.shape[1] != 3 or Rx.shape[1] != 3:
+            raise ValueError('Tx and Rx should be ndata x 3')
+        if Tx.shape[0] != Rx.shape[0] or t0.shape[0] != Tx.shape[0]:
+            raise ValueError('Tx, Rx and t0 should have the same number of rows')
+
+        if self.gridf != NULL:
+            return self.raytraceSingle(slowness, xi, theta, Tx, Rx, t0, compute_L, compute_rays)
+
         # assing model data
-        cdef vector[double] slown# = slowness.tolist()
-        for tmp in slowness:
-            slown.push_back(tmp)
-        self.grid.setSlowness(slown)
-        cdef vector[double] x
-        if len(xi) != 0:
-            for tmp in xi:
-                x.push_back(tmp)
-            self.grid.setXi(x)
-        cdef vector[double] t
-        if len(theta) != 0:
-            for tmp in theta:
-                t.push_back(tmp)
-            self.grid.setTheta(t)
-
-        # create C++ input variables
-        cdef vector[sxz[double]] cTx
-        for t in Tx:
-            cTx.push_back(sxz[double](t[0], t[2]))
-
-        cdef vector[sxz[double]] cRx
-        for r in Rx:
-            cRx.push_back(sxz[double](r[0], r[2]))
-
-        cdef vector[double] ct0# = t0.tolist()
-        for tmp in t0:
-            ct0.push_back(tmp)
+        self.grid.setSlowness(&slowness[0], slowness.shape[0])
+        if xi.shape[0] != 0:
+            self.grid.setXi(&xi[0], xi.shape[0])
+        if theta.shape[0] != 0:
+            self.grid.setTheta(&theta[0], theta.shape[0])
+
+        cdef size_t nTx = Tx.shape[0]
 
         # instantiate output variables
         cdef np.ndarray tt = np.empty([Rx.shape[0],], dtype=np.double)  # tt should be the right size
+        cdef vector[vector[siv2[double]]] L_data
+        cdef vector[vector[sxz[double]]] r_data
+        cdef vector[vector[siv2[double]]]* L_p = NULL
+        cdef vector[vector[sxz[double]]]* r_p = NULL
+        if compute_L:
+            L_p = &L_data
+        if compute_rays:
+            r_p = &r_data
+
+        if self.grid.raytrace(&Tx[0, 0], &t0[0], &Rx[0, 0], nTx, <double*> np.PyArray_DATA(tt), L_p, r_p) != 0:
+            raise RuntimeError()
+
+        L = None
+        if compute_L:
+            L = self.buildL(L_data, slowness.shape[0])
+
+        rays = None
+        if compute_rays:
+            rays = self.buildRays(r_data)
+
+        return tt, L, rays
+
+    def raytraceBatch(self, double[:, ::1] slowness, double[::1] xi, double[::1] theta,
+                      double[:, ::1] Tx, double[:, ::1] Rx, double[::1] t0,
+                      compute_L=False):
+        """
+        Raytracing in several slowness models sharing the same geometry
+
+        slowness is a C-contiguous (nmodels x ncell) float64 array, the other
+        arguments are as in raytrace (xi and theta are the same for all
+        models).  Tasks (model, group of receivers of a Tx) are distributed
+        over the threads, each thread raytracing on its own grid.
+
+        Returns tt, a (nmodels x ndata) array, and L, a list of nmodels CSR
+        matrices (None if not computed).
+        """
+        gridType = self.getType()
+        if xi.shape[0] != 0:
+            if theta.shape[0] != 0:
+                if gridType != b'tilted':
+                    raise TypeError('Grid should handle raytracing in tilted elliptically anisotropic media')
+            else:
+                if gridType != b'elliptical':
+                    raise TypeError('Grid should handle raytracing in elliptically anisotropic media')
+        else:
+            if gridType != b'iso':
+                raise TypeError('Grid should handle raytracing in isotropic media')
 
-        if nout==2:
-            Ldata = ([0.0], [0.0], [0.0])
+        if Tx.shape[1] != 3 or Rx.shape[1] != 3:
+            raise ValueError('Tx and Rx should be ndata x 3')
+        if Tx.shape[0] != Rx.shape[0] or t0.shape[0] != Tx.shape[0]:
+            raise ValueError('Tx, Rx and t0 should have the same number of rows')
+        if (xi.shape[0] != 0 and xi.shape[0] != slowness.shape[1]) or \
+                (theta.shape[0] != 0 and theta.shape[0] != slowness.shape[1]):
+            raise ValueError('xi and theta should be defined for each grid cell')
 
-            if self.grid.raytrace(cTx, ct0, cRx, <double*> np.PyArray_DATA(tt), Ldata) != 0:
+        cdef size_t nModels = slowness.shape[0]
+        cdef size_t nCells = slowness.shape[1]
+        cdef size_t nTx = Tx.shape[0]
+        cdef size_t m
+        cdef const double* xi_p = NULL
+        cdef const double* theta_p = NULL
+        if xi.shape[0] != 0:
+            xi_p = &xi[0]
+        if theta.shape[0] != 0:
+            theta_p = &theta[0]
+
+        cdef np.ndarray tt = np.empty([nModels, nTx], dtype=np.double)
+        if nModels == 0 or nTx == 0:
+            return tt, [] if compute_L else None
+
+        cdef vector[vector[vector[siv2[double]]]] L_data
+        cdef vector[vector[vector[siv2[double]]]]* L_p = NULL
+        cdef vector[vector[vector[siv2[float]]]] L_dataf
+        cdef vector[vector[vector[siv2[float]]]]* L_pf = NULL
+        if compute_L:
+            L_p = &L_data
+            L_pf = &L_dataf
+
+        if self.gridf != NULL:
+            if self.gridf.raytraceBatch(&slowness[0, 0], nModels, xi_p, theta_p, nCells,
+                                        &Tx[0, 0], &t0[0], &Rx[0, 0], nTx,
+                                        <double*> np.PyArray_DATA(tt), L_pf) != 0:
                 raise RuntimeError()
-
-            M = Rx.shape[0]
-            N = len(slowness)
-            if self.grid.getType() != b'iso':
-                N = 2*N
-
-            L = csr_matrix(Ldata, shape=(M,N))
-
-            return tt,L
-            
-        elif nout==3:
-            rays = tuple([ [0.0] for i in range(Rx.shape[0]) ])
-            Ldata = ([0.0], [0.0], [0.0])
-
-            if self.grid.raytrace(cTx, ct0, cRx, <double*> np.PyArray_DATA(tt), rays, Ldata) != 0:
+        else:
+            if self.grid.raytraceBatch(&slowness[0, 0], nModels, xi_p, theta_p, nCells,
+                                       &Tx[0, 0], &t0[0], &Rx[0, 0], nTx,
+                                       <double*> np.PyArray_DATA(tt), L_p) != 0:
                 raise RuntimeError()
 
-            M = Rx.shape[0]
-            N = len(slowness)
-            if self.grid.getType() != b'iso':
-                N = 2*N
+        L = None
+        if compute_L:
+            L = []
+            for m in range(nModels):
+                if self.gridf != NULL:
+                    L.append(self.buildLSingle(L_dataf[m], nCells))
+                else:
+                    L.append(self.buildL(L_data[m], nCells))
+
+        return tt, L
+
+    cdef raytraceSingle(self, double[::1] slowness, double[::1] xi, double[::1] theta,
+                        double[:, ::1] Tx, double[:, ::1] Rx, double[::1] t0,
+                        compute_L, compute_rays):
+        """
+        Same as raytrace, for grids computing in single precision
+        """
+        self.gridf.setSlowness(&slowness[0], slowness.shape[0])
+        if xi.shape[0] != 0:
+            self.gridf.setXi(&xi[0], xi.shape[0])
+        if theta.shape[0] != 0:
+            self.gridf.setTheta(&theta[0], theta.shape[0])
 
-            L = csr_matrix(Ldata, shape=(M,N))
+        cdef size_t nTx = Tx.shape[0]
 
-            return tt,L,rays
+        cdef np.ndarray tt = np.empty([Rx.shape[0],], dtype=np.double)
+        cdef vector[vector[siv2[float]]] L_data
+        cdef vector[vector[sxz[float]]] r_data
+        cdef vector[vector[siv2[float]]]* L_p = NULL
+        cdef vector[vector[sxz[float]]]* r_p = NULL
+        if compute_L:
+            L_p = &L_data
+        if compute_rays:
+            r_p = &r_data
+
+        if self.gridf.raytrace(&Tx[0, 0], &t0[0], &Rx[0, 0], nTx, <double*> np.PyArray_DATA(tt), L_p, r_p) != 0:
+            raise RuntimeError()
+
+        L = None
+        if compute_L:
+            L = self.buildLSingle(L_data, slowness.shape[0])
+
+        rays = None
+        if compute_rays:
+            rays = self.buildRaysSingle(r_data)
+
+        return tt, L, rays
+
+    cdef buildRays(self, vector[vector[sxz[double]]]& r_data):
+        """
+        Pack the ray paths in a single (npts x 2) float32 array of coordinates
+        and a vector of ndata+1 int64 offsets
+        """
+        cdef size_t n, nn, k
+        cdef size_t nrays = r_data.size()
+        offsets = np.empty([nrays + 1, ], dtype=np.int64)
+        cdef int64_t[::1] off = offsets
+        off[0] = 0
+        for n in range(nrays):
+            off[n + 1] = off[n] + r_data[n].size()
+
+        xz = np.empty([off[nrays], 2], dtype=np.float32)
+        cdef float[:, ::1] r = xz
+        k = 0
+        for n in range(nrays):
+            for nn in range(r_data[n].size()):
+                r[k, 0] = r_data[n][nn].x
+                r[k, 1] = r_data[n][nn].z
+                k += 1
+        r_data.clear()
+        return xz, offsets
+
+    cdef buildRaysSingle(self, vector[vector[sxz[float]]]& r_data):
+        """
+        Same as buildRays, for ray paths computed in single precision
+        """
+        cdef size_t n, nn, k
+        cdef size_t nrays = r_data.size()
+        offsets = np.empty([nrays + 1, ], dtype=np.int64)
+        cdef int64_t[::1] off = offsets
+        off[0] = 0
+        for n in range(nrays):
+            off[n + 1] = off[n] + r_data[n].size()
+
+        xz = np.empty([off[nrays], 2], dtype=np.float32)
+        cdef float[:, ::1] r = xz
+        k = 0
+        for n in range(nrays):
+            for nn in range(r_data[n].size()):
+                r[k, 0] = r_data[n][nn].x
+                r[k, 1] = r_data[n][nn].z
+                k += 1
+        r_data.clear()
+        return xz, offsets
+
+    cdef buildL(self, vector[vector[siv2[double]]]& L_data, size_t ncell):
+        """
+        Build ray projection matrix in CSR format from the rows computed in C++
+        """
+        M = L_data.size()
+        N = ncell
+        if self.grid.getType() != b'iso':
+            N = 2*N
+
+        cdef np.ndarray indptr = np.empty([M+1,], dtype=np.int64)
+        nnz = self.grid.getLindptr(L_data, <int64_t*> np.PyArray_DATA(indptr))
+        cdef np.ndarray indices = np.empty([nnz,], dtype=np.int64)
+        cdef np.ndarray data = np.empty([nnz,], dtype=np.double)
+        self.grid.fillL(L_data, <int64_t*> np.PyArray_DATA(indices), <double*> np.PyArray_DATA(data))
+        L_data.clear()
+
+        return csr_matrix((data, indices, indptr), shape=(M,N), copy=False)
+
+    cdef buildLSingle(self, vector[vector[siv2[float]]]& L_data, size_t ncell):
+        """
+        Same as buildL, the data of L are float32
+        """
+        M = L_data.size()
+        N = ncell
+        if self.gridf.getType() != b'iso':
+            N = 2*N
+
+        cdef np.ndarray indptr = np.empty([M+1,], dtype=np.int64)
+        nnz = self.gridf.getLindptr(L_data, <int64_t*> np.PyArray_DATA(indptr))
+        cdef np.ndarray indices = np.empty([nnz,], dtype=np.int64)
+        cdef np.ndarray data = np.empty([nnz,], dtype=np.float32)
+        self.gridf.fillL(L_data, <int64_t*> np.PyArray_DATA(indices), <float*> np.PyArray_DATA(data))
+        L_data.clear()
+
+        return csr_matrix((data, indices, indptr), shape=(M,N), copy=False)
 
 
     @staticmethod
@@ -152,7 +420,7 @@ cdef class Grid2Dcpp:
 
         Ldata = ([0.0], [0.0], [0.0])
 
-        Grid2Dttcr.Lsr2d(<double*> np.PyArray_DATA(Tx), <double*> np.PyArray_DATA(Rx), nTx, <double*> np.PyArray_DATA(grx), n_grx, <double*> np.PyArray_DATA(grz), n_grz, Ldata)
+        Grid2Dttcr[double].Lsr2d(<double*> np.PyArray_DATA(Tx), <double*> np.PyArray_DATA(Rx), nTx, <double*> np.PyArray_DATA(grx), n_grx, <double*> np.PyArray_DATA(grz), n_grz, Ldata)
 
         M = nTx
         N = (n_grx-1)*(n_grz-1)
@@ -170,7 +438,7 @@ cdef class Grid2Dcpp:
 
         Ldata = ([0.0], [0.0], [0.0])
 
-        Grid2Dttcr.Lsr2da(<double*> np.PyArray_DATA(Tx), <double*> np.PyArray_DATA(Rx), nTx, <double*> np.PyArray_DATA(grx), n_grx, <double*> np.PyArray_DATA(grz), n_grz, Ldata)
+        Grid2Dttcr[double].Lsr2da(<double*> np.PyArray_DATA(Tx), <double*> np.PyArray_DATA(Rx), nTx, <double*> np.PyArray_DATA(grx), n_grx, <double*> np.PyArray_DATA(grz), n_grz, Ldata)
 
         M = nTx
         N = 2*(n_grx-1)*(n_grz-1)
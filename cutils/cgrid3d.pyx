@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Copyright 2017 Bernard Giroux
+    email: bernard.giroux@ete.inrs.ca
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from libcpp.string cimport string
+from libcpp.vector cimport vector
+from libcpp cimport bool
+from libc.stdint cimport uint32_t, int32_t, int64_t
+
+import numpy as np
+cimport numpy as np
+
+from scipy.sparse import csr_matrix
+
+cdef extern from "ttcr_t.h" namespace "ttcr":
+    cdef cppclass sxyz[T]:
+        sxyz(T, T, T) except +
+        T x
+        T y
+        T z
+    cdef cppclass siv[T]:
+        pass
+
+
+cdef extern from "Grid3Dttcr.h" namespace "ttcr":
+    cdef cppclass Grid3Dttcr:
+        Grid3Dttcr(string&, uint32_t, uint32_t, uint32_t, double, double, double, double, double, double,
+                   uint32_t, uint32_t, uint32_t, size_t) except +
+        string getType()
+        const vector[double]& getThreadTime()
+        const vector[size_t]& getThreadCount()
+        void setSlowness(const double*, size_t) except +
+        int raytrace(const double*,const double*,const double*,size_t,double*,vector[vector[siv[double]]]*,vector[vector[sxyz[double]]]*) except +
+        size_t getLindptr(const vector[vector[siv[double]]]&, int64_t*)
+        void fillL(vector[vector[siv[double]]]&, int32_t*, double*)
+        @staticmethod
+        int Lsr3d(double*,double*,size_t,double*,size_t,double*,size_t,double*,size_t,bool,object)
+
+
+
+cdef class Grid3Dcpp:
+    cdef Grid3Dttcr* grid
+    def __cinit__(self, gridType, uint32_t nx, uint32_t ny, uint32_t nz, double dx, double dy, double dz,
+                  double xmin, double ymin, double zmin, uint32_t nsnx, uint32_t nsny, uint32_t nsnz,
+                  size_t nthreads):
+        # travel times are computed by fast marching, cells are divided in
+        # (nsnx+1) x (nsny+1) x (nsnz+1) sub-cells
+        self.grid = new Grid3Dttcr(gridType, nx, ny, nz, dx, dy, dz, xmin, ymin, zmin, nsnx, nsny, nsnz, nthreads)
+
+    def __dealloc__(self):
+        del self.grid
+
+    def getType(self):
+        return self.grid.getType()
+
+    def getThreadStats(self):
+        """
+        Time (s) spent raytracing and number of Tx groups solved by each
+        thread during the last call to raytrace
+        """
+        return (np.array(self.grid.getThreadTime(), dtype=np.double),
+                np.array(self.grid.getThreadCount(), dtype=np.int64))
+
+    def setSlowness(self, double[::1] slowness):
+        """
+        Assign slowness values of the grid cells (contiguous float64 vector)
+        """
+        self.grid.setSlowness(&slowness[0], slowness.shape[0])
+
+    def raytrace(self, double[::1] slowness, double[:, ::1] Tx, double[:, ::1] Rx, double[::1] t0,
+                 compute_L=True, compute_rays=False):
+        """
+        Raytracing
+
+        All input arguments must be C-contiguous float64 arrays; Tx and Rx are
+        (ndata x 3).
+
+        Returns tt, L, rays ; L and rays are None if not computed.  L has
+        32 bit column indices.  rays is a tuple (xyz, offsets) holding the
+        packed coordinates of all ray paths, ray n being
+        xyz[offsets[n]:offsets[n+1], :]
+        """
+        if Tx.shape[1] != 3 or Rx.shape[1] != 3:
+            raise ValueError('Tx and Rx should be ndata x 3')
+        if Tx.shape[0] != Rx.shape[0] or t0.shape[0] != Tx.shape[0]:
+            raise ValueError('Tx, Rx and t0 should have the same number of rows')
+
+        self.grid.setSlowness(&slowness[0], slowness.shape[0])
+
+        cdef size_t nTx = Tx.shape[0]
+
+        cdef np.ndarray tt = np.empty([Rx.shape[0],], dtype=np.double)
+        cdef vector[vector[siv[double]]] L_data
+        cdef vector[vector[sxyz[double]]] r_data
+        cdef vector[vector[siv[double]]]* L_p = NULL
+        cdef vector[vector[sxyz[double]]]* r_p = NULL
+        if compute_L:
+            L_p = &L_data
+        if compute_rays:
+            r_p = &r_data
+
+        if self.grid.raytrace(&Tx[0, 0], &t0[0], &Rx[0, 0], nTx, <double*> np.PyArray_DATA(tt), L_p, r_p) != 0:
+            raise RuntimeError()
+
+        L = None
+        if compute_L:
+            L = self.buildL(L_data, slowness.shape[0])
+
+        rays = None
+        if compute_rays:
+            rays = self.buildRays(r_data)
+
+        return tt, L, rays
+
+    cdef buildRays(self, vector[vector[sxyz[double]]]& r_data):
+        """
+        Pack the ray paths in a single (npts x 3) float32 array of coordinates
+        and a vector of ndata+1 int64 offsets
+        """
+        cdef size_t n, nn, k
+        cdef size_t nrays = r_data.size()
+        offsets = np.empty([nrays + 1, ], dtype=np.int64)
+        cdef int64_t[::1] off = offsets
+        off[0] = 0
+        for n in range(nrays):
+            off[n + 1] = off[n] + r_data[n].size()
+
+        xyz = np.empty([off[nrays], 3], dtype=np.float32)
+        cdef float[:, ::1] r = xyz
+        k = 0
+        for n in range(nrays):
+            for nn in range(r_data[n].size()):
+                r[k, 0] = r_data[n][nn].x
+                r[k, 1] = r_data[n][nn].y
+                r[k, 2] = r_data[n][nn].z
+                k += 1
+        r_data.clear()
+        return xyz, offsets
+
+    cdef buildL(self, vector[vector[siv[double]]]& L_data, size_t ncell):
+        """
+        Build ray projection matrix in CSR format from the rows computed in C++
+        """
+        M = L_data.size()
+        N = ncell
+
+        cdef np.ndarray indptr = np.empty([M+1,], dtype=np.int64)
+        nnz = self.grid.getLindptr(L_data, <int64_t*> np.PyArray_DATA(indptr))
+        cdef np.ndarray indices = np.empty([nnz,], dtype=np.int32)
+        cdef np.ndarray data = np.empty([nnz,], dtype=np.double)
+        self.grid.fillL(L_data, <int32_t*> np.PyArray_DATA(indices), <double*> np.PyArray_DATA(data))
+        L_data.clear()
+
+        return csr_matrix((data, indices, indptr), shape=(M,N), copy=False)
+
+
+    @staticmethod
+    def Lsr3d(Tx, Rx, grx, gry, grz, aniso=False):
+        """
+        Ray projection matrix for straight rays
+
+        Tx and Rx are (ndata x 3) arrays, grx, gry and grz the coordinates of
+        the grid planes.  For anisotropic media (aniso true), L is
+        ndata x 2*ncell, lengths projected on the horizontal plane come first
+        followed by vertical projections.
+        """
+        Tx = np.ascontiguousarray(Tx, dtype=np.float64)
+        Rx = np.ascontiguousarray(Rx, dtype=np.float64)
+        grx = np.ascontiguousarray(grx, dtype=np.float64)
+        gry = np.ascontiguousarray(gry, dtype=np.float64)
+        grz = np.ascontiguousarray(grz, dtype=np.float64)
+
+        cdef size_t nTx = Tx.shape[0]
+        cdef size_t n_grx = grx.shape[0]
+        cdef size_t n_gry = gry.shape[0]
+        cdef size_t n_grz = grz.shape[0]
+
+        Ldata = ([0.0], [0.0], [0.0])
+
+        Grid3Dttcr.Lsr3d(<double*> np.PyArray_DATA(Tx), <double*> np.PyArray_DATA(Rx), nTx,
+                         <double*> np.PyArray_DATA(grx), n_grx, <double*> np.PyArray_DATA(gry), n_gry,
+                         <double*> np.PyArray_DATA(grz), n_grz, aniso, Ldata)
+
+        M = nTx
+        N = (n_grx-1)*(n_gry-1)*(n_grz-1)
+        if aniso:
+            N *= 2
+        L = csr_matrix(Ldata, shape=(M,N), copy=False)
+
+        return L
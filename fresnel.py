@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Fresnel-volume sensitivity kernels
+
+Copyright 2017 Bernard Giroux
+email: Bernard.Giroux@ete.inrs.ca
+
+This file is part of BhTomoPy.
+
+BhTomoPy is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+A ray only samples the cells it crosses, whereas the traveltime of a wave
+of finite frequency depends on the slowness in a volume around the ray,
+the first Fresnel zone.  Following Watanabe et al. (1999, Geophys. J. Int.
+138, 815-823), a cell at x belongs to the Fresnel zone of the pair (Tx, Rx)
+if
+
+    dt(x) = t(Tx, x) + t(x, Rx) - t(Tx, Rx) <= 1 / (2 f)
+
+where f is the dominant frequency, and its weight decreases linearly from 1
+on the ray to 0 on the border of the zone:  w(x) = 1 - 2 f dt(x).  The rows
+of the kernel are scaled so that K * slowness gives the traveltimes in the
+model used to compute the kernel; in a homogeneous model, the sum of a row is
+thus the length of the ray, as for the ray projection matrix L, and kernels
+can be used in place of L.
+
+Traveltimes t(Tx, x) and t(x, Rx) are obtained by raytracing from each
+unique Tx and Rx to the cell centers (t(x, Rx) = t(Rx, x) by reciprocity).
+"""
+
+import concurrent.futures
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def nominalFrequency(mog):
+    """
+    Nominal frequency of the antennas of a MOG, in the inverse of its time
+    units (rnomfreq is in MHz when times are in ns, in kHz for ms)
+    """
+    if 'ns' in str(mog.data.tunits):
+        return 1.e-3 * mog.data.rnomfreq
+    return mog.data.rnomfreq
+
+
+def fresnelKernel(grid, slowness, Tx, Rx, freq, max_nnz=256, nthreads=None):
+    """
+    Sensitivity matrix of the first Fresnel zone
+
+    Input:
+        grid: Grid2D or Grid3D instance
+        slowness: vector of slowness values at grid cells (ncell x 1),
+            isotropic media only
+        Tx: coordinates of sources points (ndata x 3)
+        Rx: coordinates of receivers      (ndata x 3)
+        freq: dominant frequency, in the inverse of the time units of the
+            slowness (e.g. GHz for slowness in ns/m), see nominalFrequency
+        max_nnz: max number of nonzeros per row, the cells of largest weight
+            are kept (None: no limit)
+        nthreads: number of threads used to build the rows, which are
+            processed by Tx (default: grid.getNthreads())
+    Output:
+        K: ndata x ncell CSR matrix
+    """
+    if freq <= 0:
+        raise ValueError('Frequency should be positive')
+    slowness = np.ravel(slowness).astype(np.float64)
+    if slowness.size != grid.getNumberOfCells():
+        raise ValueError('Slowness should have one value per cell (isotropic media only)')
+    Tx = np.asarray(Tx, dtype=np.float64)
+    Rx = np.asarray(Rx, dtype=np.float64)
+    ndata = Tx.shape[0]
+    ncell = slowness.size
+
+    xc = grid.getCellCenter()
+    if xc.shape[1] == 2:
+        xc = np.column_stack((xc[:, 0], np.zeros((ncell,)), xc[:, 1]))
+
+    src, isrc = np.unique(Tx, axis=0, return_inverse=True)
+    rcv, ircv = np.unique(Rx, axis=0, return_inverse=True)
+    isrc = np.ravel(isrc)
+    ircv = np.ravel(ircv)
+
+    # the traveltimes of the data are computed along with the fields of the
+    # sources, which are then solved only once
+    pts = np.vstack((np.repeat(src, ncell, axis=0), Tx))
+    tt = grid.raytrace(slowness, pts, np.vstack((np.tile(xc, (src.shape[0], 1)), Rx)),
+                       compute_L=False, reciprocity=False).tt
+    t_src = tt[:src.shape[0] * ncell].reshape(src.shape[0], ncell)
+    t_data = tt[src.shape[0] * ncell:]
+    t_rcv = grid.raytrace(slowness, np.repeat(rcv, ncell, axis=0), np.tile(xc, (rcv.shape[0], 1)),
+                          compute_L=False, reciprocity=False).tt.reshape(rcv.shape[0], ncell)
+
+    fac = 2.0 * freq
+    if max_nnz is None or max_nnz > ncell:
+        max_nnz = ncell
+
+    def rows(ns):
+        ind = np.nonzero(isrc == ns)[0]
+        dt = t_src[ns, None, :] + t_rcv[ircv[ind], :] - t_data[ind, None]
+        w = np.clip(1.0 - fac * dt, 0.0, 1.0)
+        if max_nnz < ncell:
+            drop = np.argpartition(-w, max_nnz, axis=1)[:, max_nnz:]
+            np.put_along_axis(w, drop, 0.0, axis=1)
+        ws = w.dot(slowness)
+        scale = np.divide(t_data[ind], ws, out=np.zeros(ind.shape), where=ws > 0.0)
+        r, c = np.nonzero(w)
+        return ind[r], c, w[r, c] * scale[r]
+
+    if nthreads is None:
+        nthreads = grid.getNthreads()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, nthreads)) as executor:
+        parts = list(executor.map(rows, range(src.shape[0])))
+
+    if len(parts) == 0:
+        return csr_matrix((ndata, ncell))
+    r = np.concatenate([p[0] for p in parts])
+    c = np.concatenate([p[1] for p in parts])
+    v = np.concatenate([p[2] for p in parts])
+    return csr_matrix((v, (r, c)), shape=(ndata, ncell))
+
+
+if __name__ == '__main__':
+
+    import time
+    from grid import Grid2D
+
+    grx = np.linspace(0, 10, 51)
+    grz = np.linspace(0, 15, 76)
+    g = Grid2D(grx, grz)
+    g.nsnx = g.nsnz = 5
+
+    z = np.linspace(1, 14, 14)
+    Tx = np.array([[0.5, 0.0, a] for a in z for b in z])
+    Rx = np.array([[9.5, 0.0, b] for a in z for b in z])
+    s = 1.0 / 0.1 * np.ones(g.getNumberOfCells())  # 0.1 m/ns
+
+    L = g.raytrace(s, Tx, Rx).L
+    print('rays: {0:.1f} nonzeros per row'.format(L.nnz / L.shape[0]))
+    for f in (0.1, 0.25, 1.0):
+        for max_nnz in (None, 256):
+            t = time.time()
+            K = fresnelKernel(g, s, Tx, Rx, f, max_nnz)
+            t = time.time() - t
+            print('f = {0:g} GHz, max_nnz {1}: {2:.2f} s, {3:.1f} nonzeros per row, '
+                  'max |sum(K)-sum(L)| {4:.2e} m'.format(f, max_nnz, t, K.nnz / K.shape[0],
+                                                        np.abs(np.asarray(K.sum(axis=1) - L.sum(axis=1))).max()))
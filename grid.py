@@ -23,15 +23,286 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+from collections import OrderedDict
+import hashlib
 import math
+import os
+import time
+import concurrent.futures
 import numpy as np
 from scipy.sparse import csr_matrix
+import scipy.sparse as sp
 import h5py
 
 from cutils import cgrid2d
+from cutils import cgrid3d
 
-from utils import nargout
 import covar
+import straightrays
+
+
+class RaytraceResult(object):
+    """
+    Output of Grid2D.raytrace and Grid3D.raytrace
+
+    Attributes:
+        tt: vector of traveltimes, ndata by 1
+        L: ray projection matrix, ndata by ncell (ndata x 2*ncell for anisotropic media),
+           None if not computed
+        rays: Rays instance holding the ray paths, None if not computed
+        nsolves: number of shortest-path solves performed
+        nsolves_saved: number of solves avoided by source/receiver reciprocity
+                       or by the cache of travel-time fields
+        thread_times: time (s) spent raytracing by each thread, None if not available
+        thread_nsolves: number of source groups solved by each thread, None if not available
+    """
+    def __init__(self, tt, L=None, rays=None, nsolves=0, nsolves_saved=0,
+                 thread_times=None, thread_nsolves=None):
+        self.tt = tt
+        self.L = L
+        self.rays = rays
+        self.nsolves = nsolves
+        self.nsolves_saved = nsolves_saved
+        self.thread_times = thread_times
+        self.thread_nsolves = thread_nsolves
+
+
+class CgridPool(object):
+    """
+    Pool of C++ grids shared by Grid2D and Grid3D instances
+
+    Instantiating a C++ grid builds the graph of primary and secondary
+    nodes, which takes time on large grids.  Grids are thus kept in this
+    pool, identified by a key holding all the parameters used to build them
+    (see Grid2D.getCgrid), and reused by any Grid2D or Grid3D instance with
+    the same parameters, e.g. models reloaded from the database.  A new grid
+    is built only when a parameter changes.  At most max_grids grids are
+    kept, least recently used ones are discarded first.
+
+    Attributes:
+        max_grids: max number of grids in the pool
+        hits: number of grids obtained from the pool
+        misses: number of grids built
+    """
+    def __init__(self, max_grids=4):
+        self.max_grids = max_grids
+        self.hits = 0
+        self.misses = 0
+        self.grids = OrderedDict()  # most recently used last
+
+    @staticmethod
+    def makeKey(grids, *params):
+        """
+        Key made of a hash of the coordinates of the grid planes and of params
+        """
+        h = hashlib.sha1()
+        for g in grids:
+            g = np.ascontiguousarray(g, dtype=np.float64)
+            h.update(str(g.shape).encode())
+            h.update(g.tobytes())
+        return (h.hexdigest(),) + params
+
+    def get(self, key, build):
+        """
+        Grid identified by key, built by calling build() if not in pool
+        """
+        cgrid = self.grids.get(key)
+        if cgrid is not None:
+            self.grids.move_to_end(key)
+            self.hits += 1
+            return cgrid
+        self.misses += 1
+        cgrid = build()
+        if self.max_grids > 0:
+            self.grids[key] = cgrid
+            while len(self.grids) > self.max_grids:
+                self.grids.popitem(last=False)
+        return cgrid
+
+    def clear(self):
+        """
+        Empty the pool (grids still referenced elsewhere are not deleted)
+        """
+        self.grids.clear()
+
+
+cgrid_pool = CgridPool()
+
+
+class Rays(object):
+    """
+    Container for ray paths
+
+    The coordinates of all rays are packed in a single (npts x 2) float32
+    array, ray n being xz[offsets[n]:offsets[n+1], :].  Instances behave like
+    a sequence of (nPts x 2) arrays; indexing with an integer returns a view
+    on the coordinates of one ray, and indexing with a slice, an array of
+    indices or a boolean mask returns a new Rays instance.  Since only a few
+    contiguous arrays are held, pickling does not involve per-ray objects.
+    Rays computed on 3D grids hold (npts x 3) coordinates.
+
+    Attributes:
+        xz: coordinates of ray points (npts x 2), or (npts x 3) for 3D grids, float32
+        offsets: index of the first point of each ray (nrays+1 x 1), int64
+        Tx: coordinates of source points (nrays x 3), None if not known
+        no_trace: trace numbers (nrays x 1), None if not known
+    """
+    def __init__(self, xz=None, offsets=None, Tx=None, no_trace=None):
+        if xz is None:
+            xz = np.empty((0, 2), dtype=np.float32)
+            offsets = np.zeros((1,), dtype=np.int64)
+        self.xz = np.ascontiguousarray(xz, dtype=np.float32)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        self.Tx = Tx
+        self.no_trace = no_trace
+
+    @staticmethod
+    def fromList(rays, Tx=None, no_trace=None):
+        """
+        Pack a sequence of (nPts x 2) arrays, e.g. rays stored in older files
+        """
+        if isinstance(rays, Rays):
+            return rays
+        npts = np.array([len(r) for r in rays], dtype=np.int64)
+        offsets = np.zeros((len(rays) + 1,), dtype=np.int64)
+        np.cumsum(npts, out=offsets[1:])
+        if len(rays) > 0:
+            xz = np.vstack([np.asarray(r)[:, [0, -1]] for r in rays])
+        else:
+            xz = None
+        return Rays(xz, offsets, Tx, no_trace)
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __getitem__(self, ind):
+        if isinstance(ind, (int, np.integer)):
+            n = len(self)
+            if ind < -n or ind >= n:
+                raise IndexError('ray index out of range')
+            ind %= n
+            return self.xz[self.offsets[ind]:self.offsets[ind + 1], :]
+        return self.take(ind)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.xz[self.offsets[n]:self.offsets[n + 1], :]
+
+    def getNumberOfPoints(self):
+        """
+        Number of points of each ray
+        """
+        return np.diff(self.offsets)
+
+    def take(self, ind):
+        """
+        Extract a subset of rays
+
+        Input:
+            ind: slice, indices or boolean mask of the rays to extract
+        Output:
+            new Rays instance
+        """
+        ind = np.arange(len(self))[ind]
+        npts = self.getNumberOfPoints()[ind]
+        offsets = np.zeros((ind.size + 1,), dtype=np.int64)
+        np.cumsum(npts, out=offsets[1:])
+        # index of every point of the selected rays, built without a python loop
+        ipts = np.arange(offsets[-1], dtype=np.int64) + np.repeat(self.offsets[ind] - offsets[:-1], npts)
+        Tx = None if self.Tx is None else self.Tx[ind]
+        no_trace = None if self.no_trace is None else self.no_trace[ind]
+        return Rays(self.xz[ipts], offsets, Tx, no_trace)
+
+    @staticmethod
+    def concatenate(rays):
+        """
+        Join a sequence of Rays instances
+        """
+        xz = np.concatenate([r.xz for r in rays])
+        npts = np.concatenate([r.getNumberOfPoints() for r in rays])
+        offsets = np.zeros((npts.size + 1,), dtype=np.int64)
+        np.cumsum(npts, out=offsets[1:])
+        Tx = None
+        if all(r.Tx is not None for r in rays):
+            Tx = np.concatenate([r.Tx for r in rays])
+        no_trace = None
+        if all(r.no_trace is not None for r in rays):
+            no_trace = np.concatenate([r.no_trace for r in rays])
+        return Rays(xz, offsets, Tx, no_trace)
+
+    def flip(self):
+        """
+        New Rays instance with the points of each ray in reverse order
+        """
+        npts = self.getNumberOfPoints()
+        first = np.repeat(self.offsets[:-1], npts)
+        last = np.repeat(self.offsets[1:] - 1, npts)
+        ipts = first + last - np.arange(self.offsets[-1], dtype=np.int64)
+        return Rays(self.xz[ipts], self.offsets.copy(), self.Tx, self.no_trace)
+
+    def selectTx(self, Tx, tol=1.e-6):
+        """
+        Indices of rays originating from a given source
+
+        Input:
+            Tx: coordinates of the source (x, y, z), or z only
+            tol: tolerance on coordinates
+        """
+        if self.Tx is None:
+            raise ValueError('Source coordinates unknown')
+        Tx = np.atleast_1d(Tx)
+        if Tx.size == 1:
+            return np.nonzero(np.abs(self.Tx[:, 2] - Tx[0]) <= tol)[0]
+        return np.nonzero(np.all(np.abs(self.Tx - Tx) <= tol, axis=1))[0]
+
+    def selectTrace(self, no_trace):
+        """
+        Indices of rays corresponding to given trace number(s)
+        """
+        if self.no_trace is None:
+            raise ValueError('Trace numbers unknown')
+        return np.nonzero(np.isin(self.no_trace, no_trace))[0]
+
+    @staticmethod
+    def selectResidual(res, rmin=-np.inf, rmax=np.inf):
+        """
+        Indices of rays whose residual is within [rmin, rmax]
+
+        Input:
+            res: residuals, one per ray
+        """
+        res = np.ravel(res)
+        return np.nonzero(np.logical_and(res >= rmin, res <= rmax))[0]
+
+    def segments(self):
+        """
+        List of (nPts x 2) views on the coordinates, e.g. for a LineCollection
+        """
+        return np.split(self.xz, self.offsets[1:-1])
+
+
+def raytraceWorker(grid, shm_name, sizes, Tx, Rx, t0, compute_L, compute_rays):
+    """
+    Raytracing of a subset of Tx-Rx pairs in a worker process (see
+    Grid2D.raytraceParallel)
+
+    slowness, xi and theta are read from the shared memory block shm_name,
+    where they are stored one after the other; sizes holds their lengths.
+    """
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        model = np.ndarray((sum(sizes),), dtype=np.float64, buffer=shm.buf)
+        slowness = model[:sizes[0]]
+        xi = model[sizes[0]:sizes[0] + sizes[1]]
+        theta = model[sizes[0] + sizes[1]:]
+        res = grid.raytrace(slowness, Tx, Rx, t0, xi, theta, compute_L, compute_rays)
+        # views on the shared block must be released before closing it
+        del model, slowness, xi, theta
+    finally:
+        shm.close()
+    return res
 
 
 class Grid(object):
@@ -57,6 +328,17 @@ class Grid(object):
         self.Rx_Z_water = np.nan
         self.in_vect = np.array([])
 
+    def getNthreads(self):
+        """
+        Number of threads used by the raytracing code: attribute nthreads if
+        set, or the number of processors available (nthreads = None)
+        """
+        if self.nthreads:
+            return int(self.nthreads)
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+
     def getNumberOfCells(self):
         """
         Returns the number of cells of the grid
@@ -109,8 +391,6 @@ class Grid(object):
 
         translation of the matlab function lsplane.m by I M Smith
         """
-#         nout = nargout()  # TODO fix nargout()
-#         print(nout)
 
         m = X.shape[0]
         if m < 3:
@@ -273,16 +553,23 @@ class Grid2D(Grid):
 
     """
 
-    def __init__(self, grx=None, grz=None, nthreads=1):
+    def __init__(self, grx=None, grz=None, nthreads=None):
         Grid.__init__(self)
         if grx is not None:
             self.grx = grx
         if grz is not None:
             self.grz = grz
-        self.nthreads = nthreads
+        self.nthreads = nthreads  # None: number of processors available, see getNthreads
         self.nsnx = 10
         self.nsnz = 10
         self.cgrid = None
+        self.cgrid_key = None  # key of cgrid in cgrid_pool
+        self.prev_raytrace = None  # inputs & results of last call to raytraceIncremental
+        self.coarse_grid = None  # (settings, grid, restriction) of last call to getCoarseGrid
+        self.nsn_tuning = None  # results of tuneSecondaryNodes
+        self.tt_cache_mb = 0  # max size of the cache of travel-time fields, in MB (0: no cache)
+        self.rt_method = 'spm'  # raytracing engine, 'spm' (shortest path) or 'fmm' (fast marching)
+        self.precision = 'double'  # floating point type of the raytracing code, 'double' or 'single'
         self.border = np.array([1, 1, 1, 1])
         self.flip = 0
         self.borehole_x0 = 1
@@ -291,19 +578,27 @@ class Grid2D(Grid):
 
     def __reduce__(self):
         # cgrid excluded volontarily, it will be set to None after unpickling
-        # (cgrid is instantiated when needed in method raytrace)
+        # (cgrid is obtained from cgrid_pool when needed in method raytrace,
+        # and is thus reused if a grid with the same parameters exists)
         # this is done to avoid writing code to pickle cython class Grid2Dcpp
+        # prev_raytrace and coarse_grid are also excluded, they are only caches
         return (Grid2D.rebuild, (self.grx, self.grz, self.cont, self.Tx, self.Rx,
                                  self.TxCosDir, self.RxCosDir, self.border,
                                  self.Tx_Z_water, self.Rx_Z_water, self.in_vect,
                                  self.nthreads, self.nsnx, self.nsnz, self.flip,
-                                 self.borehole_x0, self.x0, self.type))
+                                 self.borehole_x0, self.x0, self.type, self.tt_cache_mb,
+                                 self.rt_method, self.precision, self.nsn_tuning))
 
     @staticmethod
     def rebuild(grx, grz, cont, Tx, Rx, TxCosDir, RxCosDir, border, Tx_Z_water,
-                Rx_Z_water, in_vect, nthreads, nsnx, nsnz, flip, borehole_x0, x0, _type):
+                Rx_Z_water, in_vect, nthreads, nsnx, nsnz, flip, borehole_x0, x0, _type,
+                tt_cache_mb=0, rt_method='spm', precision='double', nsn_tuning=None):
 
         g = Grid2D(grx, grz, nthreads)
+        g.tt_cache_mb = tt_cache_mb
+        g.rt_method = rt_method
+        g.precision = precision
+        g.nsn_tuning = nsn_tuning
 
         g.cont = cont
         g.Tx = Tx
@@ -323,13 +618,15 @@ class Grid2D(Grid):
 
         return g
 
-    def raytrace(self, slowness, Tx, Rx, t0=(), xi=(), theta=()):
+    def raytrace(self, slowness, Tx, Rx, t0=(), xi=(), theta=(), compute_L=True, compute_rays=False,
+                 reciprocity=True):
         """
         Compute traveltimes, raypaths and build ray projection matrix
 
         Usages:
-            tt,L,rays = grid.raytrace(slowness,Tx,Rx,t0,xi,theta)
-            tt,L = grid.raytrace(slowness,Tx,Rx,t0,xi,theta)  {Note: rays can be omitted from output}
+            res = grid.raytrace(slowness,Tx,Rx,t0,xi,theta)  {res.tt and res.L are computed}
+            res = grid.raytrace(slowness,Tx,Rx,compute_rays=True)  {res.rays is also computed}
+            res = grid.raytrace(slowness,Tx,Rx,compute_L=False)  {only res.tt is computed}
 
         Input:
             slowness: vector of slowness values at grid cells (ncell x 1)
@@ -340,14 +637,24 @@ class Grid2D(Grid):
                 values are ratio of slowness in Z over slowness in X
             theta (optional): angle of rotation of the ellipse of anisotropy ( ncell x 1 ),
                 counter-clockwise from horizontal, units in radian
+            compute_L: build ray projection matrix
+            compute_rays: extract ray paths
+            reciprocity: if there are fewer unique Rx than unique Tx, swap
+                the role of Tx and Rx so that fewer shortest-path solves are
+                needed; results are returned for the original Tx and Rx
         Output:
-            tt: vector of traveltimes, ndata by 1
-            L: ray projection matrix, ndata by ncell (ndata x 2*ncell for anisotropic media)
-            rays: tuple containing the matrices of coordinates of the ray
-                  paths, ndata by 1.  Each matrix is nPts by 2
+            RaytraceResult instance with attributes
+                tt: vector of traveltimes, ndata by 1
+                L: ray projection matrix, ndata by ncell (ndata x 2*ncell for anisotropic media)
+                rays: Rays instance, ndata ray paths of nPts x 2 coordinates
+                nsolves: number of shortest-path solves performed
+                nsolves_saved: number of solves avoided by swapping Tx and Rx
+                    or by using the cache of travel-time fields
+                thread_times, thread_nsolves: time spent and number of source
+                    groups solved by each thread; groups are handed to the
+                    threads dynamically, largest groups first
         """
 
-        nout = nargout()
         # check input data consistency
 
         if Tx.ndim != 2 or Rx.ndim != 2:
@@ -368,32 +675,586 @@ class Grid2D(Grid):
         if len(theta) != 0 and len(theta) != len(slowness):
             raise ValueError('Length of theta should equal length of slowness')
 
+        if self.rt_method == 'fmm' and len(xi) != 0:
+            raise ValueError('Fast marching is only implemented for isotropic media')
+
         if len(t0) == 0:
             t0 = np.zeros([Tx.shape[0], ])
         elif len(t0) != Tx.shape[0]:
             raise ValueError('Length of t0 should equal number of Tx')
 
-        if self.cgrid is None:
-            nx = len(self.grx) - 1
-            nz = len(self.grz) - 1
-            dx = self.grx[1] - self.grx[0]
-            dz = self.grz[1] - self.grz[0]
+        self.getCgrid(xi, theta)
+
+        # the C++ grid reads directly from contiguous float64 buffers
+        slowness = np.ascontiguousarray(np.ravel(slowness), dtype=np.float64)
+        xi = np.ascontiguousarray(np.ravel(xi), dtype=np.float64)
+        theta = np.ascontiguousarray(np.ravel(theta), dtype=np.float64)
+        Tx = np.ascontiguousarray(Tx, dtype=np.float64)
+        Rx = np.ascontiguousarray(Rx, dtype=np.float64)
+        t0 = np.ascontiguousarray(np.ravel(t0), dtype=np.float64)
+
+        # one solve is done for each unique source point (y is ignored)
+        nTx = Grid2D.countUniquePoints(Tx)
+        nRx = Grid2D.countUniquePoints(Rx)
+        swap = reciprocity and nRx < nTx
+
+        hits = self.cgrid.getTTCacheStats()[2]
+        if swap:
+            # traveltimes & ray paths are the same from Rx to Tx, initial times are added afterwards
+            tt, L, rays = self.cgrid.raytrace(slowness, xi, theta, Rx, Tx, np.zeros(t0.shape),
+                                              compute_L, compute_rays)
+            tt += t0
+        else:
+            tt, L, rays = self.cgrid.raytrace(slowness, xi, theta, Tx, Rx, t0, compute_L, compute_rays)
+        # sources found in the cache of travel-time fields were not solved
+        hits = self.cgrid.getTTCacheStats()[2] - hits
+        if rays is not None:
+            rays = Rays(rays[0], rays[1], Tx.copy())
+            if swap:
+                rays = rays.flip()
+        nsolves = (nRx if swap else nTx) - hits
+        times, counts = self.cgrid.getThreadStats()
+        return RaytraceResult(tt, L, rays, nsolves, nTx - nsolves, times, counts)
+
+    def getCgrid(self, xi=(), theta=()):
+        """
+        C++ grid used for raytracing, for isotropic media if xi is empty, or
+        elliptical (theta empty) or tilted elliptical anisotropy
+
+        The grid currently held in attribute cgrid is kept if it was built
+        with the current parameters (grid planes, anisotropy type, nsnx,
+        nsnz, number of threads, raytracing method, precision and size of the
+        travel-time cache); otherwise it is taken from cgrid_pool, where it is
+        built if needed.
+        """
+        typeG = Grid2D.cgridType(xi, theta)
+        key = self.cgridKey(typeG)
+        if self.cgrid is None or key != self.cgrid_key:
+            self.cgrid = cgrid_pool.get(key, lambda: self.makeCgrid(typeG))
+            self.cgrid_key = key
+        return self.cgrid
+
+    @staticmethod
+    def cgridType(xi=(), theta=()):
+        """
+        Type of C++ grid for anisotropy parameters xi and theta
+        """
+        if len(xi) != 0:
+            if len(theta) != 0:
+                return b'tilted'
+            return b'elliptical'
+        return b'iso'
+
+    def cgridKey(self, typeG=b'iso'):
+        """
+        Key of the C++ grid of type typeG in cgrid_pool
+        """
+        return CgridPool.makeKey((self.grx, self.grz), typeG, self.nsnx, self.nsnz, self.getNthreads(),
+                                 self.rt_method, self.precision, self.tt_cache_mb)
+
+    def makeCgrid(self, typeG=b'iso'):
+        """
+        Instantiate a C++ grid, typeG being b'iso', b'elliptical' or b'tilted'
+        """
+        nx = len(self.grx) - 1
+        nz = len(self.grz) - 1
+        dx = self.grx[1] - self.grx[0]
+        dz = self.grz[1] - self.grz[0]
+        cgrid = cgrid2d.Grid2Dcpp(typeG, nx, nz, dx, dz, self.grx[0], self.grz[0],
+                                  self.nsnx, self.nsnz, self.getNthreads(),
+                                  self.rt_method.encode(), self.precision.encode())
+        cgrid.setTTCacheSize(int(self.tt_cache_mb * 1024 * 1024))
+        return cgrid
+
+    def raytraceIncremental(self, slowness, Tx, Rx, t0=(), xi=(), theta=(), compute_rays=False, rtol=1.e-3):
+        """
+        Raytracing reusing the results of the previous call
+
+        Cells whose slowness (or xi, theta) changed by more than rtol since
+        the rays crossing them were last traced are identified, and the rays
+        crossing these cells are found from the structure of the previous L.
+        Only the source groups (rays sharing a Tx, or a Rx if Tx and Rx are
+        swapped) containing such rays are traced again.  The other rows of L
+        and ray paths are kept, and their traveltimes are updated with the new
+        slowness for isotropic media (using the previous ray paths).  A full
+        raytracing is done on the first call or when Tx, Rx or t0 differ from
+        the previous call.
+
+        The rows of L that are kept are thus stale: they hold the paths traced
+        in a model that differs from the current one by less than rtol along
+        them.  They can differ from the rows of a full raytracing, either
+        because slowness changed slightly, or because another path of the same
+        traveltime is found (e.g. in homogeneous regions).  If slowness only
+        increased, traveltimes are within a relative error rtol of those of a
+        full raytracing; rays which did not cross changed cells before but
+        would now go through them are however not detected, rtol should be
+        kept small.
+
+        Input:
+            same as method raytrace
+            rtol: relative tolerance on model parameters
+        Output:
+            RaytraceResult instance, L is always computed
+        """
+        slowness = np.array(np.ravel(slowness), dtype=np.float64)
+        xi = np.array(np.ravel(xi), dtype=np.float64)
+        theta = np.array(np.ravel(theta), dtype=np.float64)
+        Tx = np.array(Tx, dtype=np.float64)
+        Rx = np.array(Rx, dtype=np.float64)
+        if len(t0) == 0:
+            t0 = np.zeros([Tx.shape[0], ])
+        t0 = np.array(np.ravel(t0), dtype=np.float64)
+
+        prev = self.prev_raytrace
+        if prev is not None:
+            p_s, p_xi, p_theta, p_slowness, p_Tx, p_Rx, p_t0, p_res = prev
+            if (Tx.shape != p_Tx.shape or Rx.shape != p_Rx.shape or xi.shape != p_xi.shape or
+                    theta.shape != p_theta.shape or slowness.shape != p_s.shape or
+                    not np.array_equal(Tx, p_Tx) or not np.array_equal(Rx, p_Rx) or
+                    not np.array_equal(t0, p_t0) or (compute_rays and p_res.rays is None)):
+                prev = None
+
+        if prev is None:
+            res = self.raytrace(slowness, Tx, Rx, t0, xi, theta, compute_rays=compute_rays)
+            self.prev_raytrace = (slowness, xi, theta, slowness, Tx, Rx, t0, res)
+            return res
+
+        changed = np.logical_not(np.isclose(slowness, p_s, rtol=rtol, atol=0.0))
+        if xi.size > 0:
+            changed |= np.logical_not(np.isclose(xi, p_xi, rtol=rtol, atol=0.0))
+        if theta.size > 0:
+            changed |= np.logical_not(np.isclose(theta, p_theta, rtol=rtol, atol=0.0))
+
+        # rays crossing changed cells, columns of L are (ncell) or (2*ncell) for anisotropic media
+        L = p_res.L
+        nrays = L.shape[0]
+        hit = changed[L.indices % slowness.size]
+        rows = np.repeat(np.arange(nrays), np.diff(L.indptr))[hit]
+
+        # whole source groups are traced again, this does not cost more solves
+        nTx = Grid2D.countUniquePoints(Tx)
+        nRx = Grid2D.countUniquePoints(Rx)
+        pts = Rx if nRx < nTx else Tx
+        _, group = np.unique(pts[:, [0, 2]], axis=0, return_inverse=True)
+        group = np.ravel(group)
+        ind = np.nonzero(np.isin(group, group[rows]))[0]
+
+        tt = p_res.tt.copy()
+        if xi.size == 0:
+            tt += L * (slowness - p_slowness)
+
+        if ind.size == 0:
+            res = RaytraceResult(tt, L, p_res.rays, 0, min(nTx, nRx))
+            self.prev_raytrace = (p_s, p_xi, p_theta, slowness, Tx, Rx, t0, res)
+            return res
+
+        sub = self.raytrace(slowness, Tx[ind, :], Rx[ind, :], t0[ind], xi, theta, compute_rays=compute_rays)
+
+        keep = np.setdiff1d(np.arange(nrays), ind)
+        order = np.argsort(np.concatenate((keep, ind)))
+        tt[ind] = sub.tt
+        L = sp.vstack([L[keep, :], sub.L], format='csr')[order, :]
+        rays = None
+        if compute_rays:
+            rays = Rays.concatenate([p_res.rays[keep], sub.rays])[order]
+
+        # reference values are updated for cells that triggered retracing only, so
+        # that small changes accumulating over successive calls are eventually caught
+        p_s = p_s.copy()
+        p_s[changed] = slowness[changed]
+        if xi.size > 0:
+            p_xi = p_xi.copy()
+            p_xi[changed] = xi[changed]
+        if theta.size > 0:
+            p_theta = p_theta.copy()
+            p_theta[changed] = theta[changed]
+
+        res = RaytraceResult(tt, L, rays, sub.nsolves, min(nTx, nRx) - sub.nsolves)
+        self.prev_raytrace = (p_s, p_xi, p_theta, slowness, Tx, Rx, t0, res)
+        return res
+
+    def raytraceParallel(self, slowness, Tx, Rx, t0=(), xi=(), theta=(), compute_L=True, compute_rays=False,
+                         nprocs=None, executor=None):
+        """
+        Raytracing with the sources split across worker processes
+
+        Tx-Rx pairs are grouped by source (or by receiver if there are fewer
+        unique receivers, as in method raytrace), and the groups are
+        distributed among the workers so that each handles about the same
+        number of rays.  The slowness, xi and theta vectors are placed in a
+        shared memory block read by all workers, and each worker returns the
+        traveltimes, rows of L and ray paths of its pairs, which are put back
+        in the order of Tx and Rx.  The threads given by getNthreads() are
+        shared among the workers, each raytracing with at least one thread.
+
+        Input:
+            same as method raytrace
+            nprocs: number of worker processes (default: getNthreads())
+            executor: concurrent.futures.ProcessPoolExecutor to use, e.g. to
+                avoid starting new processes at each call of an inversion loop;
+                nprocs should then be its number of workers
+        Output:
+            RaytraceResult instance
+        """
+        from multiprocessing import shared_memory
+
+        slowness = np.ravel(slowness)
+        xi = np.ravel(xi)
+        theta = np.ravel(theta)
+        if len(t0) == 0:
+            t0 = np.zeros([Tx.shape[0], ])
+        t0 = np.ravel(t0)
+        if nprocs is None:
+            nprocs = self.getNthreads()
+
+        # whole groups are assigned to a worker, largest groups first to the least loaded one
+        pts = Rx if Grid2D.countUniquePoints(Rx) < Grid2D.countUniquePoints(Tx) else Tx
+        _, group, count = np.unique(pts[:, [0, 2]], axis=0, return_inverse=True, return_counts=True)
+        group = np.ravel(group)
+        nchunks = min(nprocs, count.size)
+        if nchunks <= 1:
+            return self.raytrace(slowness, Tx, Rx, t0, xi, theta, compute_L, compute_rays)
+        load = np.zeros((nchunks,))
+        owner = np.zeros((count.size,), dtype=int)
+        for ng in np.argsort(-count, kind='stable'):
+            owner[ng] = np.argmin(load)
+            load[owner[ng]] += count[ng]
+        chunks = [np.nonzero(owner[group] == n)[0] for n in range(nchunks)]
+
+        # the worker grids are light copies without the Tx & Rx of the survey
+        grid = Grid2D(self.grx, self.grz, max(1, self.getNthreads() // nchunks))
+        grid.nsnx = self.nsnx
+        grid.nsnz = self.nsnz
+        grid.rt_method = self.rt_method
+        grid.precision = self.precision
+
+        sizes = (slowness.size, xi.size, theta.size)
+        shm = shared_memory.SharedMemory(create=True, size=8 * max(sum(sizes), 1))
+        own_executor = executor is None
+        if own_executor:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=nchunks)
+        try:
+            model = np.ndarray((sum(sizes),), dtype=np.float64, buffer=shm.buf)
+            model[:] = np.concatenate((slowness, xi, theta))
+            del model
+            futures = [executor.submit(raytraceWorker, grid, shm.name, sizes, Tx[ind, :], Rx[ind, :], t0[ind],
+                                       compute_L, compute_rays) for ind in chunks]
+            results = [f.result() for f in futures]
+        finally:
+            if own_executor:
+                executor.shutdown()
+            shm.close()
+            shm.unlink()
+
+        order = np.argsort(np.concatenate(chunks))
+        tt = np.concatenate([r.tt for r in results])[order]
+        L = None
+        if compute_L:
+            L = sp.vstack([r.L for r in results], format='csr')[order, :]
+        rays = None
+        if compute_rays:
+            rays = Rays.concatenate([r.rays for r in results])[order]
+        nsolves = sum(r.nsolves for r in results)
+        return RaytraceResult(tt, L, rays, nsolves, Grid2D.countUniquePoints(Tx) - nsolves)
+
+    def raytraceBatch(self, slowness, Tx, Rx, t0=(), xi=(), theta=(), compute_L=False, reciprocity=True):
+        """
+        Compute traveltimes for several slowness models in one call
+
+        This is meant for ensembles of models (e.g. geostatistical
+        realizations or perturbed models) sharing the same survey.  Sources
+        are grouped once for all models, and the (model, source group) pairs
+        are distributed over the threads, each thread working on its own
+        copy of the grid so that the graph is not rebuilt for each model.
+
+        Input:
+            slowness: slowness values at grid cells (nmodels x ncell)
+            Tx, Rx, t0, reciprocity: see method raytrace
+            xi, theta (optional): anisotropy parameters (ncell x 1), the same
+                for all models
+            compute_L: build the ray projection matrix of each model
+        Output:
+            RaytraceResult instance with attributes
+                tt: traveltimes, nmodels x ndata
+                L: list of nmodels ray projection matrices, None if not computed
+                nsolves: number of shortest-path solves performed
+                nsolves_saved: number of solves avoided by swapping Tx and Rx
+                thread_times, thread_nsolves: see method raytrace
+        """
+        slowness = np.atleast_2d(slowness)
+        if slowness.ndim != 2:
+            raise ValueError('slowness should be nmodels x ncell')
+        if Tx.ndim != 2 or Rx.ndim != 2 or Tx.shape[1] != 3 or Tx.shape != Rx.shape:
+            raise ValueError('Tx and Rx should be ndata x 3 arrays of equal size')
+        if slowness.shape[1] != self.getNumberOfCells():
+            raise ValueError('Number of columns of slowness should equal number of cells')
+        if len(xi) != 0 and len(xi) != slowness.shape[1]:
+            raise ValueError('Length of xi should equal number of cells')
+        if len(theta) != 0 and len(theta) != slowness.shape[1]:
+            raise ValueError('Length of theta should equal number of cells')
+        if self.rt_method == 'fmm' and len(xi) != 0:
+            raise ValueError('Fast marching is only implemented for isotropic media')
+        if len(t0) == 0:
+            t0 = np.zeros([Tx.shape[0], ])
+        elif len(t0) != Tx.shape[0]:
+            raise ValueError('Length of t0 should equal number of Tx')
+
+        self.getCgrid(xi, theta)
+
+        slowness = np.ascontiguousarray(slowness, dtype=np.float64)
+        xi = np.ascontiguousarray(np.ravel(xi), dtype=np.float64)
+        theta = np.ascontiguousarray(np.ravel(theta), dtype=np.float64)
+        Tx = np.ascontiguousarray(Tx, dtype=np.float64)
+        Rx = np.ascontiguousarray(Rx, dtype=np.float64)
+        t0 = np.ascontiguousarray(np.ravel(t0), dtype=np.float64)
+
+        nTx = Grid2D.countUniquePoints(Tx)
+        nRx = Grid2D.countUniquePoints(Rx)
+        swap = reciprocity and nRx < nTx
+
+        if swap:
+            tt, L = self.cgrid.raytraceBatch(slowness, xi, theta, Rx, Tx, np.zeros(t0.shape), compute_L)
+            tt += t0
+        else:
+            tt, L = self.cgrid.raytraceBatch(slowness, xi, theta, Tx, Rx, t0, compute_L)
+        nmodels = slowness.shape[0]
+        nsolves = nmodels * (nRx if swap else nTx)
+        times, counts = self.cgrid.getThreadStats()
+        return RaytraceResult(tt, L, None, nsolves, nmodels * nTx - nsolves, times, counts)
+
+    def getCoarseGrid(self, factor):
+        """
+        Coarser grid, for multigrid raytracing
+
+        Cells of the coarse grid hold factor x factor cells of the grid.  If
+        the number of cells along X or Z is not a multiple of factor, the
+        coarse grid extends a bit beyond the grid, and the last coarse cells
+        hold fewer cells.
+
+        Input:
+            factor: coarsening factor (integer > 1)
+        Output:
+            grid: coarse Grid2D instance, with the raytracing settings of the
+                grid; it is kept so that its C++ grid is reused by later calls
+            R: restriction matrix (ncell_coarse x ncell), coarse slowness is
+                R * slowness (average of the cells of the grid)
+        """
+        factor = int(factor)
+        if factor < 2:
+            raise ValueError('Coarsening factor should be larger than 1')
+        settings = (factor, self.grx[0], self.grx[-1], self.grx.size, self.grz[0], self.grz[-1],
+                    self.grz.size, self.nsnx, self.nsnz, self.nthreads, self.rt_method, self.precision)
+        if self.coarse_grid is not None and self.coarse_grid[0] == settings:
+            return self.coarse_grid[1], self.coarse_grid[2]
 
-            typeG = b'iso'
+        nx = len(self.grx) - 1
+        nz = len(self.grz) - 1
+        ncx = -(-nx // factor)
+        ncz = -(-nz // factor)
+        dx = self.grx[1] - self.grx[0]
+        dz = self.grz[1] - self.grz[0]
+        grid = Grid2D(self.grx[0] + factor * dx * np.arange(ncx + 1),
+                      self.grz[0] + factor * dz * np.arange(ncz + 1), self.nthreads)
+        grid.nsnx = self.nsnx
+        grid.nsnz = self.nsnz
+        grid.rt_method = self.rt_method
+        grid.precision = self.precision
+
+        # cell ix*nz + iz is in coarse cell (ix//factor)*ncz + iz//factor
+        ix, iz = np.meshgrid(np.arange(nx), np.arange(nz), indexing='ij')
+        parent = ((ix // factor) * ncz + iz // factor).ravel()
+        count = np.bincount(parent, minlength=ncx * ncz)
+        R = csr_matrix((1.0 / count[parent], (parent, np.arange(nx * nz))), shape=(ncx * ncz, nx * nz))
+
+        self.coarse_grid = (settings, grid, R)
+        return grid, R
+
+    def raytraceMultigrid(self, slowness, Tx, Rx, t0=(), xi=(), theta=(), factor=2, compute_L=True,
+                          compute_rays=False):
+        """
+        Raytracing on a coarser grid
+
+        Slowness (and xi, theta) are restricted to the coarse grid of method
+        getCoarseGrid by cell averaging, rays are traced on the coarse grid,
+        and L is mapped back to the cells of the grid by prolongation: the
+        length of a ray in a coarse cell is shared equally among the cells it
+        holds, so that L * slowness equals the traveltime on the coarse
+        model.  This is much faster than raytracing on the grid, and is
+        meant for the first iterations of inversions.
+
+        Input:
+            same as method raytrace
+            factor: coarsening factor (integer > 1)
+        Output:
+            RaytraceResult instance, L is ndata by ncell (ndata x 2*ncell for
+            anisotropic media) of the grid, rays are traced on the coarse grid
+        """
+        grid, R = self.getCoarseGrid(factor)
+        slowness = R * np.ravel(slowness)
+        if len(xi) != 0:
+            xi = R * np.ravel(xi)
+        if len(theta) != 0:
+            theta = R * np.ravel(theta)
+        res = grid.raytrace(slowness, Tx, Rx, t0, xi, theta, compute_L, compute_rays)
+        if res.L is not None:
             if len(xi) != 0:
-                if len(theta) != 0:
-                    typeG = b'tilted'
-                else:
-                    typeG = b'elliptical'
-            self.cgrid = cgrid2d.Grid2Dcpp(typeG, nx, nz, dx, dz, self.grx[0], self.grz[0],
-                                           self.nsnx, self.nsnz, self.nthreads)
-
-        if nout == 2:
-            tt, L = self.cgrid.raytrace(slowness, xi, theta, Tx, Rx, t0)
-            return tt, L
-        elif nout == 3:
-            tt, L, rays = self.cgrid.raytrace(slowness, xi, theta, Tx, Rx, t0)
-            return tt, L, rays
+                res.L = (res.L * sp.block_diag((R, R), format='csr')).tocsr()
+            else:
+                res.L = (res.L * R).tocsr()
+        return res
+
+    def setRaytracingMethod(self, method):
+        """
+        Select the raytracing engine
+
+        Input:
+            method: 'spm' for the shortest path method, where nsnx and nsnz
+                        are the numbers of secondary nodes on cell edges
+                    'fmm' for the fast marching method (isotropic media only),
+                        cells are divided in (nsnx+1) by (nsnz+1) sub-cells
+                        and rays are traced back along the traveltime gradient
+        """
+        if method not in ('spm', 'fmm'):
+            raise ValueError('Raytracing method should be spm or fmm')
+        if method != self.rt_method:
+            self.rt_method = method
+            self.cgrid = None
+            self.prev_raytrace = None
+
+    def setPrecision(self, precision):
+        """
+        Select the floating point type used for raytracing
+
+        Input:
+            precision: 'double', or 'single' to hold slowness, travel times at
+                the nodes, ray paths and L in float32.  Memory use and bandwidth
+                are roughly halved.  Traveltimes are still returned as float64;
+                they differ from double precision by about 1e-6 relative, up
+                to 1e-4 for rays grazing sharp interfaces and 1e-3 for fast
+                marching (see testPrecision in __main__).  The data of L are
+                float32
+        """
+        if precision not in ('double', 'single'):
+            raise ValueError('Precision should be double or single')
+        if precision != self.precision:
+            self.precision = precision
+            self.cgrid = None
+            self.prev_raytrace = None
+
+    def setTTCache(self, max_mb):
+        """
+        Set the maximum size of the cache of travel-time fields
+
+        When the cache is active, the travel-time field computed for each
+        source is kept.  Subsequent calls to raytrace with the same slowness
+        model that only need traveltimes (compute_L=False) obtain them by
+        interpolation for sources in the cache, e.g. to add receivers or test
+        new Rx geometries.  Least recently used fields are discarded first.
+        The size of the cache is a parameter of the C++ grid: instances with
+        different sizes do not share their C++ grid, and would otherwise keep
+        resizing (and emptying) the cache of one another.
+
+        Input:
+            max_mb: size in MB, 0 disables the cache
+        """
+        self.tt_cache_mb = max_mb
+
+    def tuneSecondaryNodes(self, slowness, Tx, Rx, tol, xi=(), theta=(), nsn=(2, 3, 4, 6, 8, 10, 12, 16),
+                           nsources=4, max_time=None, nsn_ref=None):
+        """
+        Select the number of secondary nodes from the convergence of traveltimes
+
+        The rays of a few sources (nsources, evenly spaced among the distinct
+        Tx) are traced with nsnx = nsnz = n for increasing values of n.
+        Values of n are not tried further once a trace takes more than
+        max_time seconds.  Traveltimes obtained with nsn_ref, larger than the
+        values tried, are taken as the reference, and the smallest n giving
+        traveltimes within tol of the reference is selected (the largest n
+        tried if none is).  nsnx and nsnz are set to the selected value, and
+        the results are kept in attribute nsn_tuning.  The C++ grids of the
+        trials are not put in cgrid_pool, where they would replace grids in
+        use.
+
+        Input:
+            slowness, Tx, Rx, xi, theta: as in method raytrace
+            tol: tolerance on traveltimes, in the units of traveltimes; it
+                should be about the accuracy of the picks
+            nsn: values of n to try, in increasing order
+            nsources: number of sources traced
+            max_time: time budget of a trace, in s (None: no limit)
+            nsn_ref: value of n of the reference (None: twice the largest
+                value tried)
+        Output:
+            n: selected number of secondary nodes
+            nsn_tuning is a dict with keys
+                nsn: values of n traced
+                error: max abs difference of traveltimes with the reference
+                time: time of each trace (s)
+                tol, nsources, nsn_ref: input values (nsn_ref as used)
+                selected: selected value of n
+        """
+        # Tx & Rx of the selected sources
+        src = np.unique(Tx[:, [0, 2]], axis=0)
+        src = src[np.unique(np.linspace(0, src.shape[0] - 1, min(nsources, src.shape[0])).round().astype(int))]
+        ind = np.zeros((Tx.shape[0],), dtype=bool)
+        for pt in src:
+            ind |= np.all(Tx[:, [0, 2]] == pt, axis=1)
+        Tx = Tx[ind, :]
+        Rx = Rx[ind, :]
+
+        typeG = Grid2D.cgridType(xi, theta)
+
+        def trace(n):
+            grid = Grid2D(self.grx, self.grz, self.nthreads)
+            grid.nsnx = n
+            grid.nsnz = n
+            grid.rt_method = self.rt_method
+            grid.precision = self.precision
+            grid.cgrid = grid.makeCgrid(typeG)
+            grid.cgrid_key = grid.cgridKey(typeG)
+            return grid.raytrace(slowness, Tx, Rx, xi=xi, theta=theta, compute_L=False).tt
+
+        tried = []
+        tt = []
+        times = []
+        for n in nsn:
+            t = time.perf_counter()
+            tt.append(trace(n))
+            times.append(time.perf_counter() - t)
+            tried.append(n)
+            if max_time is not None and times[-1] > max_time:
+                break
+
+        if nsn_ref is None:
+            nsn_ref = 2 * tried[-1]
+        if nsn_ref <= tried[-1]:
+            raise ValueError('nsn_ref should be larger than the values of n tried')
+        tt_ref = trace(nsn_ref)
+
+        error = [float(np.max(np.abs(tn - tt_ref))) for tn in tt]
+        selected = tried[-1]
+        for n, e in zip(tried, error):
+            if e <= tol:
+                selected = n
+                break
+
+        self.nsn_tuning = {'nsn': tried, 'error': error, 'time': times, 'tol': tol,
+                           'nsources': src.shape[0], 'nsn_ref': nsn_ref, 'selected': selected}
+        if selected != self.nsnx or selected != self.nsnz:
+            self.nsnx = selected
+            self.nsnz = selected
+            self.cgrid = None
+            self.prev_raytrace = None
+        return selected
+
+    @staticmethod
+    def countUniquePoints(pts):
+        """
+        Number of distinct (x, z) points in an (n x 3) array
+        """
+        if pts.shape[0] == 0:
+            return 0
+        return np.unique(pts[:, [0, 2]], axis=0).shape[0]
 
     def getForwardStraightRays(self, ind=None, dx=None, dy=None, dz=None, aniso=False):
         """
@@ -406,7 +1267,10 @@ class Grid2D(Grid):
             aniso: if true build matrix for anisotropic slowness
 
         Output:
-            L: ray projection matrix, ndata by ncell (ndata x 2*ncell for anisotropic media)
+            L: ray projection matrix, ndata by ncell (ndata x 2*ncell for anisotropic media,
+               see straightrays.Lsr2d)
+
+        Matrices are kept in cache, see straightrays.LCache
         """
         if ind is None:
             ind = np.ones((self.Tx.shape[0],), dtype=bool)
@@ -422,10 +1286,7 @@ class Grid2D(Grid):
         else:
             grz = np.arange(self.grz[0], self.grz[-1] + small, dz)
 
-        if not aniso:
-            return cgrid2d.Grid2Dcpp.Lsr2d(self.Tx[np.ix_(ind, [0, 2])], self.Rx[np.ix_(ind, [0, 2])], grx, grz)
-        else:
-            return cgrid2d.Grid2Dcpp.Lsr2da(self.Tx[np.ix_(ind, [0, 2])], self.Rx[np.ix_(ind, [0, 2])], grx, grz)
+        return straightrays.cache.get(self.Tx[np.ix_(ind, [0, 2])], self.Rx[np.ix_(ind, [0, 2])], (grx, grz), aniso)
 
     def getCellCenter(self, dx=None, dz=None):
         """
@@ -587,61 +1448,79 @@ class Grid2D(Grid):
 
         return Dx, Dy, Dz
 
-    def preFFTMA(self, cm):
+    def covarianceEmbedding(self, cm, Nx, Nz, grow=False):
         """
-        Compute matrix G for FFT-MA simulations
+        Covariance at the lags of a circulant embedding of the grid
 
         INPUT
             cm: list of covariance models
+            Nx, Nz: size of the embedding grid
+            grow: if True, Nx and Nz are doubled until the covariance falls
+                  to zero on the borders of the embedding grid
 
         OUTPUT
-            G: covariance matrix in spectral domain
+            K: Nx x Nz array, K[i, k] is the covariance at lag (i*dx, k*dz),
+               indices above Nx/2 (Nz/2) holding negative lags (i-Nx)*dx
+               ((k-Nz)*dz)
         """
         small = 1.0e-6
-        Nx = 2 * self.grx.size
-        Nz = 2 * self.grz.size
-
-        Nx2 = Nx / 2
-        Nz2 = Nz / 2
+        while True:
+            x = self.dx * np.hstack((np.arange(Nx // 2 + 1), np.arange(Nx // 2 + 1 - Nx, 0)))
+            z = self.dz * np.hstack((np.arange(Nz // 2 + 1), np.arange(Nz // 2 + 1 - Nz, 0)))
 
-        x = self.dx * np.hstack((np.arange(Nx2), np.arange(-Nx2 + 1, 1)))
-        z = self.dz * np.hstack((np.arange(Nz2), np.arange(-Nz2 + 1, 1)))
+            x = np.kron(x, np.ones((Nz, )))
+            z = np.tile(z, Nx)
 
-        x = np.kron(x, np.ones((Nz, )))
-        z = np.kron(z, np.ones((1, Nx)).T).flatten()
+            d = 0
+            for c in cm:
+                d = d + c.compute(np.vstack((x, z)).T, np.zeros((1, 2)))
+            K = d.reshape(Nx, Nz)
 
-        d = 0
-        for c in cm:
-            d = d + c.compute(np.vstack((x, z)).T, np.zeros((1, 2)))
-        K = d.reshape(Nx, Nz)
-
-        mk = True
-        while mk:
+            if not grow:
+                return K
             mk = False
             if np.min(K[0, :]) > small:
                 # Enlarge grid to make sure that covariance falls to zero
                 Nz = 2 * Nz
                 mk = True
-
             if np.min(K[:, 0]) > small:
                 Nx = 2 * Nx
                 mk = True
+            if not mk:
+                return K
 
-            if mk:
-                Nx2 = Nx / 2
-                Nz2 = Nz / 2
+    def covarianceOperator(self, cm):
+        """
+        Covariance matrix of the slowness at the cells, applied by FFT
 
-                x = self.dx * np.hstack((np.arange(Nx2), np.arange(-Nx2 + 1, 1)))
-                z = self.dz * np.hstack((np.arange(Nz2), np.arange(-Nz2 + 1, 1)))
+        INPUT
+            cm: CovarianceModel instance, without xi and tilt
 
-                x = np.kron(x, np.ones((Nz,)))
-                z = np.kron(z, np.ones((1, Nx)).T).flatten()
+        OUTPUT
+            Cm: covar.CovarianceOperator instance, equivalent to
+                cm.compute(xc, xc) with xc the cell centers
+        """
+        if cm.use_xi or cm.use_tilt:
+            raise ValueError('Covariance operator not implemented for anisotropic models')
+        if not (np.allclose(np.diff(self.grx), self.dx) and np.allclose(np.diff(self.grz), self.dz)):
+            raise ValueError('Covariance operator needs a regular grid')
+        nx = self.grx.size - 1
+        nz = self.grz.size - 1
+        # lags up to (nx-1)*dx and (nz-1)*dz are needed
+        K = self.covarianceEmbedding(cm.covar, 2 * nx, 2 * nz)
+        return covar.CovarianceOperator(K, nx, nz, cm.nugget_model)
 
-                d = 0
-                for c in cm:
-                    d = d + c.compute(np.vstack((x, z)).T, np.zeros((1, 2)))
-                K = d.reshape(Nx, Nz)
+    def preFFTMA(self, cm):
+        """
+        Compute matrix G for FFT-MA simulations
 
+        INPUT
+            cm: list of covariance models
+
+        OUTPUT
+            G: covariance matrix in spectral domain
+        """
+        K = self.covarianceEmbedding(cm, 2 * self.grx.size, 2 * self.grz.size, grow=True)
         return np.sqrt(np.fft.fft2(K))
 
     def FFTMA(self, G):
@@ -709,9 +1588,19 @@ class Grid2D(Grid):
 
 class Grid3D(Grid):
     """
-    Class for 3D grids -> TO COMPLETE!!!
+    Class for 3D grids
+
+
+    Important: as for Grid2D, the slowness vector is in column-major order,
+            Z being the "fast" axis followed by Y, i.e. cell (ix, iy, iz) has
+            index (ix*ny + iy)*nz + iz.  The vector can be reshaped as
+            slowness.reshape(nx,ny,nz)
+
+    Traveltimes are computed with the fast marching method (isotropic media
+    only), cells being divided in (nsnx+1) x (nsny+1) x (nsnz+1) sub-cells.
+    Ray projection matrices have 32 bit column indices to reduce their size.
     """
-    def __init__(self, grx=None, gry=None, grz=None, nthreads=1):
+    def __init__(self, grx=None, gry=None, grz=None, nthreads=None):
         Grid.__init__(self)
         if grx is not None:
             self.grx = grx
@@ -719,17 +1608,250 @@ class Grid3D(Grid):
             self.gry = gry
         if grz is not None:
             self.grz = grz
-        self.nthreads = nthreads
-        self.nsnx = 10
-        self.nsny = 10
-        self.nsnz = 10
+        self.nthreads = nthreads  # None: number of processors available, see getNthreads
+        # number of nodes grows as the cube of nsn, see Grid2D for 2D values
+        self.nsnx = 2
+        self.nsny = 2
+        self.nsnz = 2
         self.cgrid = None
+        self.cgrid_key = None  # key of cgrid in cgrid_pool
         self.border = np.array([1, 1, 1, 1])
         self.flip = 0
         self.borehole_x0 = 1
         self.x0 = np.array([])
         self.type = None
 
+    def __reduce__(self):
+        # cgrid excluded volontarily, see Grid2D.__reduce__
+        return (Grid3D.rebuild, (self.grx, self.gry, self.grz, self.cont, self.Tx, self.Rx,
+                                 self.TxCosDir, self.RxCosDir, self.border,
+                                 self.Tx_Z_water, self.Rx_Z_water, self.in_vect,
+                                 self.nthreads, self.nsnx, self.nsny, self.nsnz, self.flip,
+                                 self.borehole_x0, self.x0, self.type))
+
+    @staticmethod
+    def rebuild(grx, gry, grz, cont, Tx, Rx, TxCosDir, RxCosDir, border, Tx_Z_water,
+                Rx_Z_water, in_vect, nthreads, nsnx, nsny, nsnz, flip, borehole_x0, x0, _type):
+
+        g = Grid3D(grx, gry, grz, nthreads)
+
+        g.cont = cont
+        g.Tx = Tx
+        g.Rx = Rx
+        g.TxCosDir = TxCosDir
+        g.RxCosDir = RxCosDir
+        g.border = border
+        g.Tx_Z_water = Tx_Z_water
+        g.Rx_Z_water = Rx_Z_water
+        g.in_vect = in_vect
+        g.nsnx = nsnx
+        g.nsny = nsny
+        g.nsnz = nsnz
+        g.flip = flip
+        g.borehole_x0 = borehole_x0
+        g.x0 = x0
+        g.type = _type
+
+        return g
+
+    def raytrace(self, slowness, Tx, Rx, t0=(), compute_L=True, compute_rays=False, reciprocity=True):
+        """
+        Compute traveltimes, raypaths and build ray projection matrix
+
+        Usages:
+            res = grid.raytrace(slowness,Tx,Rx,t0)  {res.tt and res.L are computed}
+            res = grid.raytrace(slowness,Tx,Rx,compute_rays=True)  {res.rays is also computed}
+            res = grid.raytrace(slowness,Tx,Rx,compute_L=False)  {only res.tt is computed}
+
+        Input:
+            slowness: vector of slowness values at grid cells (ncell x 1)
+            Tx: coordinates of sources points (ndata x 3)
+            Rx: coordinates of receivers      (ndata x 3)
+            t0 (optional): initial time at sources points (ndata x 1)
+            compute_L: build ray projection matrix
+            compute_rays: extract ray paths
+            reciprocity: if there are fewer unique Rx than unique Tx, swap
+                the role of Tx and Rx so that fewer solves are needed
+        Output:
+            RaytraceResult instance with attributes
+                tt: vector of traveltimes, ndata by 1
+                L: ray projection matrix, ndata by ncell, with int32 indices
+                rays: Rays instance, ndata ray paths of nPts x 3 coordinates
+                nsolves: number of fast marching solves performed
+                nsolves_saved: number of solves avoided by swapping Tx and Rx
+                thread_times, thread_nsolves: time spent and number of source
+                    groups solved by each thread
+        """
+
+        # check input data consistency
+
+        if Tx.ndim != 2 or Rx.ndim != 2:
+            raise ValueError('Tx and Rx should be 2D arrays')
+
+        if Tx.shape[1] != 3 or Rx.shape[1] != 3:
+            raise ValueError('Tx and Rx should be ndata x 3')
+
+        if Tx.shape != Rx.shape:
+            raise ValueError('Tx and Rx should be of equal size')
+
+        if len(slowness) != self.getNumberOfCells():
+            raise ValueError('Length of slowness vector should equal number of cells')
+
+        if len(t0) == 0:
+            t0 = np.zeros([Tx.shape[0], ])
+        elif len(t0) != Tx.shape[0]:
+            raise ValueError('Length of t0 should equal number of Tx')
+
+        key = CgridPool.makeKey((self.grx, self.gry, self.grz), b'iso', self.nsnx, self.nsny, self.nsnz,
+                                self.getNthreads())
+        if self.cgrid is None or key != self.cgrid_key:
+            nx, ny, nz = self.getNcell()
+            self.cgrid = cgrid_pool.get(key, lambda: cgrid3d.Grid3Dcpp(b'iso', nx, ny, nz, self.dx, self.dy, self.dz,
+                                                                       self.grx[0], self.gry[0], self.grz[0],
+                                                                       self.nsnx, self.nsny, self.nsnz,
+                                                                       self.getNthreads()))
+            self.cgrid_key = key
+
+        # the C++ grid reads directly from contiguous float64 buffers
+        slowness = np.ascontiguousarray(np.ravel(slowness), dtype=np.float64)
+        Tx = np.ascontiguousarray(Tx, dtype=np.float64)
+        Rx = np.ascontiguousarray(Rx, dtype=np.float64)
+        t0 = np.ascontiguousarray(np.ravel(t0), dtype=np.float64)
+
+        # one solve is done for each unique source point
+        nTx = Grid3D.countUniquePoints(Tx)
+        nRx = Grid3D.countUniquePoints(Rx)
+        swap = reciprocity and nRx < nTx
+
+        if swap:
+            tt, L, rays = self.cgrid.raytrace(slowness, Rx, Tx, np.zeros(t0.shape), compute_L, compute_rays)
+            tt += t0
+        else:
+            tt, L, rays = self.cgrid.raytrace(slowness, Tx, Rx, t0, compute_L, compute_rays)
+        if rays is not None:
+            rays = Rays(rays[0], rays[1], Tx.copy())
+            if swap:
+                rays = rays.flip()
+        nsolves = nRx if swap else nTx
+        times, counts = self.cgrid.getThreadStats()
+        return RaytraceResult(tt, L, rays, nsolves, nTx - nsolves, times, counts)
+
+    @staticmethod
+    def countUniquePoints(pts):
+        """
+        Number of distinct points in an (n x 3) array
+        """
+        if pts.shape[0] == 0:
+            return 0
+        return np.unique(pts, axis=0).shape[0]
+
+    def getForwardStraightRays(self, ind=None, dx=None, dy=None, dz=None, aniso=False):
+        """
+        Build ray projection matrix for straight rays
+
+        Input:
+            ind: indices of Tx-Rx pairs for which matrix is built
+            dx: grid cell size along X (default is size of grid instance)
+            dy: grid cell size along Y (default is size of grid instance)
+            dz: grid cell size along Z (default is size of grid instance)
+            aniso: if true build matrix for anisotropic slowness
+
+        Output:
+            L: ray projection matrix, ndata by ncell (ndata x 2*ncell for anisotropic media,
+               lengths projected on the horizontal plane followed by vertical projections,
+               see straightrays.Lsr3d)
+
+        Matrices are kept in cache, see straightrays.LCache
+        """
+        if ind is None:
+            ind = np.ones((self.Tx.shape[0],), dtype=bool)
+
+        small = 0.00001
+        if dx is None or dx == 0:
+            grx = self.grx
+        else:
+            grx = np.arange(self.grx[0], self.grx[-1] + small, dx)
+
+        if dy is None or dy == 0:
+            gry = self.gry
+        else:
+            gry = np.arange(self.gry[0], self.gry[-1] + small, dy)
+
+        if dz is None or dz == 0:
+            grz = self.grz
+        else:
+            grz = np.arange(self.grz[0], self.grz[-1] + small, dz)
+
+        return straightrays.cache.get(self.Tx[ind, :], self.Rx[ind, :], (grx, gry, grz), aniso)
+
+    def getCellCenter(self, dx=None, dy=None, dz=None):
+        """
+        Returns a nCell x 3 array containing the coordinates of the center of the cells
+        """
+        if dx is None:
+            dx = self.dx
+        if dy is None:
+            dy = self.dy
+        if dz is None:
+            dz = self.dz
+
+        x = np.arange(self.grx[0] + dx / 2.0, self.grx[-1] - dx / 3.0, dx)  # divide by 3 to avoid truncation error
+        y = np.arange(self.gry[0] + dy / 2.0, self.gry[-1] - dy / 3.0, dy)
+        z = np.arange(self.grz[0] + dz / 2.0, self.grz[-1] - dz / 3.0, dz)
+
+        x, y, z = np.meshgrid(x, y, z, indexing='ij')
+        return np.vstack((x.ravel(), y.ravel(), z.ravel())).T
+
+    def derivative(self, order, normalize=False):
+        """
+        Compute spatial derivative operators for grid _cells_
+
+        The operators are the same as those of Grid2D.derivative, applied
+        along each axis.  Derivatives along an axis with too few cells for
+        the operator are null.
+
+        Output:
+            Dx, Dy, Dz: sparse matrices, ncell x ncell
+        """
+        dx = 1
+        dy = 1
+        dz = 1
+        if normalize:
+            dx = self.dx
+            dy = self.dy
+            dz = self.dz
+
+        nx, ny, nz = self.getNcell()
+
+        def deriv1D(n, h):
+            # operator along one axis, for n cells of size h
+            if order == 1:
+                if n < 2:
+                    return sp.csr_matrix((n, n))
+                i = np.repeat(np.arange(n), 2)
+                j = np.vstack((np.arange(-1, n - 1), np.arange(1, n + 1))).T.flatten()
+                v = np.tile(np.array([-0.5, 0.5]), n)
+                # forward and backward operators at the ends
+                j[:2] = [0, 1]
+                j[-2:] = [n - 2, n - 1]
+                v[:2] = [-1.0, 1.0]
+                v[-2:] = [-1.0, 1.0]
+                return sp.csr_matrix((v / h, (i, j)), shape=(n, n))
+            else:
+                if n < 3:
+                    return sp.csr_matrix((n, n))
+                i = np.repeat(np.arange(n), 3)
+                c = np.clip(np.arange(n), 1, n - 2)  # center of the stencil
+                j = np.vstack((c - 1, c, c + 1)).T.flatten()
+                v = np.tile(np.array([1.0, -2.0, 1.0]), n)
+                return sp.csr_matrix((v / (h * h), (i, j)), shape=(n, n))
+
+        Dx = sp.kron(deriv1D(nx, dx), sp.identity(ny * nz), format='csr')
+        Dy = sp.kron(sp.kron(sp.identity(nx), deriv1D(ny, dy)), sp.identity(nz), format='csr')
+        Dz = sp.kron(sp.identity(nx * ny), deriv1D(nz, dz), format='csr')
+
+        return Dx, Dy, Dz
+
 
 if __name__ == '__main__':
 
@@ -742,6 +1864,8 @@ if __name__ == '__main__':
     testDeriv = False
     testFFTMA = True
     testPickle = False
+    testRaytrace3D = False
+    testPrecision = False
 
     if testRaytrace:
         grx = np.linspace(0, 10, num=21)
@@ -768,9 +1892,12 @@ if __name__ == '__main__':
                        [9.8, 0.0, 6.2]])
         t0 = np.zeros([6, ])
 
-        tt1, L1, rays1 = grid.raytrace(slowness, Tx, Rx, t0)
-        tt1b, L1b = grid.raytrace(slowness, Tx, Rx, t0)
-        tt2, L2, rays2 = grid.raytrace(slowness, Tx, Rx)
+        res1 = grid.raytrace(slowness, Tx, Rx, t0, compute_rays=True)
+        tt1, L1, rays1 = res1.tt, res1.L, res1.rays
+        res1b = grid.raytrace(slowness, Tx, Rx, t0)
+        tt1b, L1b = res1b.tt, res1b.L
+        res2 = grid.raytrace(slowness, Tx, Rx, compute_rays=True)
+        tt2, L2, rays2 = res2.tt, res2.L, res2.rays
 
         d = np.sqrt(np.sum((Tx - Rx)**2, axis=1))
 
@@ -836,7 +1963,8 @@ if __name__ == '__main__':
 
         print(ttsr)
 
-        tt1, L1, rays1 = grid.raytrace(s, Tx, Rx)
+        res1 = grid.raytrace(s, Tx, Rx)
+        tt1, L1 = res1.tt, res1.L
 
     if testStatic:
 
@@ -1049,7 +2177,7 @@ if __name__ == '__main__':
         Lsr1 = grid.getForwardStraightRays()
         ttsr1 = Lsr1 * s
 
-        tt1, L1, rays1 = grid.raytrace(s, Tx, Rx)
+        tt1 = grid.raytrace(s, Tx, Rx, compute_L=False).tt
 
         with open('/tmp/data.pickle', 'wb') as f:
             # Pickle the 'data' dictionary using the highest protocol available.
@@ -1065,10 +2193,106 @@ if __name__ == '__main__':
         Lsr2 = grid.getForwardStraightRays()
         ttsr2 = Lsr2 * s
 
-        tt2, L2, rays2 = grid.raytrace(s, Tx, Rx)
+        tt2 = grid.raytrace(s, Tx, Rx, compute_L=False).tt
 
         print(ttsr)
         print(ttsr1)
         print(ttsr2)
         print(tt1)
         print(tt2)
+
+    if testRaytrace3D:
+        grx = np.linspace(0, 10, num=21)
+        gry = np.linspace(0, 4, num=9)
+        grz = np.linspace(0, 15, num=31)
+
+        grid = Grid3D(grx, gry, grz, nthreads=2)
+
+        z = np.arange(1, 15)
+
+        Tx = np.vstack((np.ones(z.size), np.ones(z.size), z)).T
+        Rx = np.vstack((9 + np.ones(z.size), 3 * np.ones(z.size), z[::-1])).T
+
+        grid.Tx = Tx
+        grid.Rx = Rx
+
+        nc = grid.getNumberOfCells()
+        s = np.ones((nc,))
+
+        d = np.sqrt(np.sum((Tx - Rx)**2, axis=1))
+
+        res = grid.raytrace(s, Tx, Rx, compute_rays=True)
+        print(d - res.tt)
+        print(d - res.L * s)
+
+        Lsr = grid.getForwardStraightRays()
+        print(d - Lsr * s)
+
+        fig = plt.figure()
+        ax = fig.add_subplot(111, projection='3d')
+        for r in res.rays:
+            ax.plot(r[:, 0], r[:, 1], r[:, 2])
+        ax.invert_zaxis()
+        plt.show()
+
+    if testPrecision:
+        # single vs double precision, on the geometries of testRaytrace
+        # (homogeneous) and testRaytrace2 (two layers), isotropic and
+        # anisotropic, for both raytracing methods.  Max relative differences
+        # observed with the default nsnx = nsnz = 10:
+        #
+        #                  tt       L*s      ray length
+        #   spm homogeneous  1.4e-07  4.2e-08  9.7e-08
+        #   spm layers       1.2e-06  5.4e-09  0
+        #   spm elliptical   3.9e-04  -        4.1e-04
+        #   spm tilted       8.4e-07  -        1.9e-07
+        #   fmm homogeneous  8.8e-05  1.0e-05  1.0e-05
+        #   fmm layers       4.7e-05  5.5e-03  6.5e-03
+        #
+        # Differences are at the float32 rounding level except for rays
+        # grazing the interface of the layered models, where paths of nearly
+        # equal traveltime compete (2.5e-3 in 6.4 for spm elliptical), and for
+        # fmm, where the error of float32 node times accumulates along the
+        # marching front.  Single precision is thus appropriate when picks
+        # are not more accurate than about 1e-4 relative.
+        grx = np.linspace(0, 10, num=21)
+        grz = np.linspace(0, 15, num=31)
+        nc = 20 * 30
+
+        z = np.arange(1, 15)
+        Tx1 = np.array([[0.2, 0.0, 0.2], [0.2, 0.0, 0.2], [0.2, 0.0, 0.2],
+                        [0.2, 0.0, 1.2], [0.2, 0.0, 1.2], [0.2, 0.0, 1.2]])
+        Rx1 = np.array([[9.8, 0.0, 0.2], [9.8, 0.0, 3.2], [9.8, 0.0, 6.2],
+                        [9.8, 0.0, 0.2], [9.8, 0.0, 3.2], [9.8, 0.0, 6.2]])
+        Tx2 = np.vstack((np.ones(z.size), np.zeros(z.size), z)).T
+        Rx2 = np.vstack((9 + np.ones(z.size), np.zeros(z.size), z)).T
+        s2 = np.ones((20, 30))
+        s2[:, :10] = 0.5
+        xi = 1.0 + 0.1 * np.ones((nc,))
+        theta = 0.2 * np.ones((nc,))
+
+        cases = (('homogeneous', np.ones((nc,)), Tx1, Rx1, (), ()),
+                 ('layers', s2.flatten(), Tx2, Rx2, (), ()),
+                 ('elliptical', s2.flatten(), Tx2, Rx2, xi, ()),
+                 ('tilted', s2.flatten(), Tx2, Rx2, xi, theta))
+        for method in ('spm', 'fmm'):
+            for name, s, Tx, Rx, xi_, theta_ in cases:
+                if method == 'fmm' and len(xi_) != 0:
+                    continue
+                res = []
+                for precision in ('double', 'single'):
+                    grid = Grid2D(grx, grz)
+                    grid.setRaytracingMethod(method)
+                    grid.setPrecision(precision)
+                    res.append(grid.raytrace(s, Tx, Rx, xi=xi_, theta=theta_, compute_rays=True))
+                dtt = np.max(np.abs(res[1].tt - res[0].tt) / res[0].tt)
+                # L*s is the traveltime in isotropic media only
+                dL = np.nan
+                if len(xi_) == 0:
+                    dL = np.max(np.abs(res[1].L * s - res[0].L * s) / (res[0].L * s))
+                # paths of equal traveltime may differ, lengths are compared
+                lr = [np.array([np.sum(np.sqrt(np.sum(np.diff(r, axis=0)**2, axis=1))) for r in rr.rays])
+                      for rr in res]
+                dr = np.max(np.abs(lr[1] - lr[0]) / lr[0])
+                print('{0:s} {1:s}: tt {2:.1e}, L*s {3:.1e}, ray length {4:.1e}, L data {5}'.format(
+                    method, name, dtt, dL, dr, res[1].L.dtype))
@@ -19,10 +19,18 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import time
+import warnings
+
 import numpy as np
 import scipy as spy
+import scipy.linalg
 from scipy.sparse import linalg
 
+import covar
+from grid import Rays
+import fresnel
+
 
 class InvLSQRParams(object):
     def __init__(self):
@@ -40,6 +48,30 @@ class InvLSQRParams(object):
         self.order          = 1
         self.nbreiter       = 0
         self.dv_max         = 0
+        self.incRaytrace    = 0      # retrace only rays crossing cells that changed
+        self.rtolRaytrace   = 1.e-3  # relative change of slowness triggering retracing
+        self.mgFactor       = 1      # coarsening factor of the grid for the first iterations (1: full grid)
+        self.numItFine      = 1      # number of final solves with L raytraced on the full grid
+        self.fresnel        = 0      # use Fresnel-volume kernels instead of ray projection matrices
+        self.fresnelFreq    = 0      # dominant frequency of the kernels (see fresnel.nominalFrequency)
+        self.fresnelMaxNnz  = 256    # max number of nonzeros per row of the kernels
+        self.fftCovar       = 0      # apply Cm by FFT without storing it (regular 2D grids)
+        self.dataCG         = 0      # solve the data-space system of invGeostat by conjugate gradients
+        self.cgPrecond      = 'ilu'  # preconditioner of the conjugate gradients: 'none', 'diag' or 'ilu'
+        self.cgSupport      = 0.5    # support of the approximation of Cm of the preconditioner (fraction of max range)
+        self.cgTol          = 1.e-6  # relative tolerance on the residual of the conjugate gradients
+        self.cgMaxIter      = 500    # max number of iterations of the conjugate gradients
+        self.lsqrSolver     = 'lsqr' # solver of invLSQR: 'lsqr' or 'lsmr'
+        self.colScaling     = 0      # scale the columns of the system of invLSQR to unit norm (Jacobi preconditioning)
+        self.warmStart      = 0      # start the solver of invLSQR from the model of the previous iteration
+        self.nbreiterWarm   = 0      # max number of solver iterations when warm started (0: nbreiter)
+        self.historyKeep    = 0      # number of last iterations whose residuals and models are saved (0: all)
+        self.historyFloat32 = 0      # save residuals and models of the iterations in single precision
+
+    def __setstate__(self, state):
+        # parameters added since the state was saved take their default value
+        InvLSQRParams.__init__(self)
+        self.__dict__.update(state)
 
 def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
     """
@@ -95,10 +127,17 @@ def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
     if data.shape[1] >= 9:
         tomo.no_trace = data[:, 8]
 
-    if np.all(L == 0):
+    if (L != 0).sum() == 0:
         # We get the straights rays for the first iteration
         L = grid.getForwardStraightRays(idata)
 
+    useFresnel = params.fresnel == 1
+    if useFresnel:
+        if cm.use_xi or cm.use_tilt:
+            raise ValueError('Fresnel-volume kernels are only available for isotropic media')
+        # kernels in the homogeneous model replace the straight rays
+        L = homogeneousFresnelKernel(params, data, grid, L)
+
     tomo.x = 0.5 * (grid.grx[0:-1] + grid.grx[1:])
     tomo.z = 0.5 * (grid.grz[0:-1] + grid.grz[1:])
 
@@ -110,7 +149,12 @@ def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
     cont = np.array([])
 
     xc = grid.getCellCenter()
-    Cm = cm.compute(xc,xc)
+    if params.fftCovar == 1 and not (cm.use_xi or cm.use_tilt) and \
+            not (cont.size > 0 and params.useCont == 1):
+        # Cm is applied by FFT, it is never stored (isotropic models)
+        Cm = grid.covarianceOperator(cm)
+    else:
+        Cm = cm.compute(xc,xc)
 
     # TODO : Test, indices may not work
     if cont.size > 0 and params.useCont == 1:
@@ -124,12 +168,31 @@ def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
         if (data[:,7] != 0).all():
             c0=data[:,7]**2
     
+    # Gamma is obtained by conjugate gradients, L*Cm*L' + C0 being applied
+    # without being formed; the posterior variance is then not computed
+    useCG = params.dataCG == 1 and not (cont.size > 0 and params.useCont == 1)
+    if useCG:
+        # Cs does not depend on L, and the preconditioner is only rebuilt
+        # when L changes (after raytracing)
+        Cs = None
+        if params.cgPrecond != 'none':
+            Cs = covar.compactCovariance(cm, xc, params.cgSupport)
+        M = None
+        L_M = None
+
+    tomo.invData = iterationHistory(params, data.shape[0], L.shape[1])
+
     for noIter in range(params.numItCurved + params.numItStraight + 1):
+        t0 = time.perf_counter()
+        stats = None
+        # L is kept sparse: row sums and products with the (dense) covariance
+        # matrix of the model are computed without converting it
+        lsum = np.asarray(L.sum(axis=1)).ravel()
         if noIter == 1:
-            l_moy = np.mean(data[:,6]/np.sum(L.A,axis = 1))
+            l_moy = np.mean(data[:,6]/lsum)
         else:
             l_moy = np.mean(tomo.s)
-        mta = np.sum(L.A*l_moy,axis =1) 
+        mta = lsum*l_moy
         dt = data[:,6] - mta
 
         #TODO: Add Simulation param
@@ -138,11 +201,20 @@ def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
         #    doSim = 1
 
         if np.size(c0) == 0:
-            Cd = L*Cm*L.T + cm.nugget_data*np.eye(np.size(L.A[:,0]))
+            cd0 = cm.nugget_data * np.ones((L.shape[0],))
         else:
-            Cd = L*Cm*L.T + cm.nugget_data*np.diag(c0)
-        
-        Cdm = L*Cm
+            cd0 = cm.nugget_data*c0
+
+        if not useCG:
+            if isinstance(Cm, covar.CovarianceOperator):
+                Cd, Cdm = Cm.LCmLt(L, return_CmLt=True)
+                Cdm = Cdm.T
+            else:
+                Cdm = L @ Cm
+                # L and Cm are both sparse with xi (see covar.CovarianceModel.compute)
+                Cdm = Cdm.toarray() if spy.sparse.issparse(Cdm) else np.asarray(Cdm)
+                Cd = np.asarray(L @ Cdm.T)
+            Cd[np.diag_indices(Cd.shape[0])] += cd0
 
         if doSim == 0:
 
@@ -154,9 +226,20 @@ def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
                 # dual cokriging (see Gloaguen et al 2005)
                 Gamma = np.linalg(C,np.concatenate((scont,dt))).reshape(-1, 1).T
                 m = Gamma.dot(np.concatenate((Cm0,Cdm))).T
+            elif useCG:
+                if L is not L_M:
+                    M = dataSpacePreconditioner(L, cm, xc, cd0, params.cgPrecond, params.cgSupport, Cs)
+                    L_M = L
+                Gamma, niter, relres = dataSpaceCG(L, Cm, cd0, dt, M, params.cgTol, params.cgMaxIter)
+                stats = {'solver': 'cg', 'niter': niter, 'relres': relres}
+                m = Cm.dot(L.T.dot(Gamma))
             else:
-                Gamma = np.linalg.solve(Cd,dt).reshape(-1, 1).T
-                m = Gamma.dot(Cdm).T
+                # Cd is symmetric positive definite, its Cholesky factor is
+                # also used for the posterior variance; Cd.T (Fortran-ordered
+                # view of the symmetric Cd) is factorized in place
+                Cd = spy.linalg.cho_factor(Cd.T, lower=True, overwrite_a=True, check_finite=False)
+                Gamma = spy.linalg.cho_solve(Cd, dt, check_finite=False)
+                m = Cdm.T.dot(Gamma)
             
             if params.tomoAtt == 1:
                 #neative attenuation set to zero
@@ -171,12 +254,40 @@ def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
             if np.any(tomo.s<0):
                 print("Negative Slownesses: Change Inversion Parameters")
                 #tomo = np.array([])
-            _,L,tomo.rays = grid.raytrace(tomo.s,data[:,0:3],data[:,3:6])
+            # ray paths are only needed for the final model
+            last = noIter == params.numItCurved + params.numItStraight
+            if useFresnel:
+                # the kernels replace L, rays are traced for the final model only
+                L = fresnel.fresnelKernel(grid, tomo.s, data[:, 0:3], data[:, 3:6],
+                                          params.fresnelFreq, params.fresnelMaxNnz)
+                if last:
+                    res = grid.raytrace(tomo.s, data[:, 0:3], data[:, 3:6], compute_L=False, compute_rays=True)
+            elif params.incRaytrace == 1:
+                # ray paths are kept to be updated incrementally
+                res = grid.raytraceIncremental(tomo.s, data[:, 0:3], data[:, 3:6], compute_rays=True,
+                                               rtol=params.rtolRaytrace)
+                L = res.L
+            else:
+                res = grid.raytrace(tomo.s, data[:, 0:3], data[:, 3:6], compute_rays=last)
+                L = res.L
+            if last:
+                tomo.rays = res.rays
+                if tomo.no_trace.size == data.shape[0]:
+                    tomo.rays.no_trace = tomo.no_trace
+
+        if noIter == params.numItCurved + params.numItStraight and doSim == 0 and not useCG and \
+                not (np.size(cont) > 0 and params.useCont == 1):
+            # posterior variance diag(Cm - Cdm' Cd^-1 Cdm), with Cd = C C',
+            # W = C^-1 Cdm overwrites Cdm
+            W = spy.linalg.solve_triangular(Cd[0], Cdm, lower=True, overwrite_b=True, check_finite=False)
+            tomo.var_s = Cm.diagonal() - np.einsum('ij,ij->j', W, W)
+            del W
 
         if params.saveInvData == 1:
             tt = L.dot(tomo.s)
-            tomo.invData.res = data[:,6]-tt
-            tomo.invData.s = tomo.s
+            tomo.invData.add(noIter, data[:,6]-tt, tomo.s, stats, time.perf_counter() - t0)
+        else:
+            tomo.invData.add(noIter, stats=stats, time=time.perf_counter() - t0)
 
         if ui is not None:
             ui.InvIterationDone.emit(noIter + 1,tomo.s, "Geostatistic")
@@ -189,7 +300,166 @@ def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None):
         print('Geostatistic Inversion - Finished, {} Iterations Done'.format(noIter))
 
     return tomo
-  
+
+
+def dataSpaceCG(L, Cm, cd, dt, M=None, tol=1.e-6, maxiter=500):
+    """
+    Solve (L*Cm*L' + diag(cd)) Gamma = dt by preconditioned conjugate
+    gradients
+
+    The matrix is never formed: an iteration costs a product with L, one
+    with L' and one with Cm, the cost of which is linear in the number of
+    data (and in the number of cells if Cm is a covar.CovarianceOperator).
+
+    Input:
+        L: ray projection matrix (ndata x ncell), sparse
+        Cm: covariance matrix of the model, array or covar.CovarianceOperator
+        cd: variance of the data errors (ndata,)
+        dt: right-hand side (ndata,)
+        M: function applying the inverse of the preconditioner to a vector
+           (None: no preconditioning), see dataSpacePreconditioner
+        tol: relative tolerance on the norm of the residual
+        maxiter: max number of iterations, a warning is issued if reached
+            before tol
+    Output:
+        Gamma: solution (ndata,)
+        niter: number of iterations done
+        relres: norm of the residual relative to the norm of dt
+    """
+    Lt = L.T.tocsr()
+    dt = np.ravel(dt)
+    x = np.zeros(dt.shape)
+    bnorm = np.linalg.norm(dt)
+    if bnorm == 0.0:
+        return x, 0, 0.0
+
+    r = dt.copy()
+    z = r if M is None else M(r)
+    p = z.copy()
+    rz = r.dot(z)
+    niter = 0
+    relres = 1.0
+    while niter < maxiter and relres > tol:
+        q = L.dot(Cm.dot(Lt.dot(p))) + cd * p
+        alpha = rz / p.dot(q)
+        x += alpha * p
+        r -= alpha * q
+        niter += 1
+        relres = np.linalg.norm(r) / bnorm
+        z = r if M is None else M(r)
+        rz_new = r.dot(z)
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+    if relres > tol:
+        warnings.warn('Conjugate gradients stopped after {0} iterations, relative residual '
+                      '{1:.2e} > {2:.2e}'.format(niter, relres, tol))
+    return x, niter, relres
+
+
+def dataSpacePreconditioner(L, cm, xc, cd, kind='ilu', support=0.5, Cs=None):
+    """
+    Preconditioner of dataSpaceCG, built from a compact-support
+    approximation Cs of the covariance of the model (covar.compactCovariance)
+
+    Input:
+        L: ray projection matrix (ndata x ncell), sparse
+        cm: CovarianceModel instance
+        xc: coordinates of the cell centers
+        cd: variance of the data errors (ndata,)
+        kind: 'none', 'diag' (inverse of the diagonal of L*Cs*L' + diag(cd))
+              or 'ilu' (incomplete LU factorization of L*Cs*L' + diag(cd),
+              the density of which grows with support)
+        support: radius of Cs, in units of the largest range of cm
+        Cs (optional): Cs already built with covar.compactCovariance(cm, xc,
+            support), e.g. by a previous call with another L
+    Output:
+        M: function applying the preconditioner to a vector, None for 'none'
+    """
+    if kind == 'none':
+        return None
+    if kind not in ('diag', 'ilu'):
+        raise ValueError('Unknown preconditioner: ' + str(kind))
+
+    if Cs is None:
+        Cs = covar.compactCovariance(cm, xc, support)
+    LCs = L @ Cs
+    d = np.asarray(LCs.multiply(L).sum(axis=1)).ravel() + cd
+    if kind == 'ilu':
+        A = (LCs @ L.T + spy.sparse.diags(cd)).tocsc()
+        try:
+            return linalg.spilu(A, drop_tol=1.e-4, fill_factor=10).solve
+        except RuntimeError:
+            warnings.warn('Incomplete factorization failed, diagonal preconditioner used')
+    return lambda r: r / d
+
+
+def solveLSQR(A, b, x0=None, solver='lsqr', colScaling=False, tol=0, iter_lim=None):
+    """
+    Least-squares solution of A x = b by LSQR or LSMR
+
+    Input:
+        A: sparse matrix
+        b: right-hand side
+        x0: initial solution (warm start), A dx = b - A x0 is then solved
+        solver: 'lsqr' or 'lsmr'
+        colScaling: if True, the columns of A are scaled to unit norm
+            (Jacobi preconditioning)
+        tol: atol and btol of the solver
+        iter_lim: max number of iterations (None: default of the solver)
+    Output:
+        x: solution
+        info: dict holding the name of the solver (solver), the reason for
+            stopping (istop, see the documentation of scipy), the number of
+            iterations (niter) and of products with A or A' (nmatvec), and
+            the norm of the residual (rnorm)
+    """
+    A = spy.sparse.csr_matrix(A)
+    nmatvec = 0
+    btol = tol
+    if x0 is not None:
+        bnorm = np.linalg.norm(b)
+        b = b - A.dot(x0)
+        nmatvec += 1
+        # the stopping criterion on the residual stays relative to the
+        # norm of the initial right-hand side
+        if np.linalg.norm(b) > 0.0:
+            btol = min(tol * bnorm / np.linalg.norm(b), 0.1)
+    if colScaling:
+        d = np.sqrt(np.asarray(A.multiply(A).sum(axis=0)).ravel())
+        d = np.divide(1.0, d, out=np.ones(d.shape), where=d > 0.0)
+        A = A @ spy.sparse.diags(d)
+
+    if solver == 'lsqr':
+        ans = linalg.lsqr(A, b, atol=tol, btol=btol, iter_lim=iter_lim)
+    elif solver == 'lsmr':
+        ans = linalg.lsmr(A, b, atol=tol, btol=btol, maxiter=iter_lim)
+    else:
+        raise ValueError('Unknown solver: ' + str(solver))
+    # x, istop, itn and the norm of the residual come first for both solvers
+    x = ans[0]
+    if colScaling:
+        x = d * x
+    if x0 is not None:
+        x = x + x0
+    nmatvec += 2 * ans[2]
+    return x, {'solver': solver, 'istop': ans[1], 'niter': ans[2], 'nmatvec': nmatvec, 'rnorm': ans[3]}
+
+
+def homogeneousFresnelKernel(params, data, grid, L):
+    """
+    Fresnel-volume kernels in the homogeneous model of mean slowness
+    data[:, 6] / sum(L), replacing the straight-ray matrix L
+
+    Kernels are only available for isotropic media: a ValueError is raised if
+    L has a column per cell and per slowness component (anisotropic media).
+    """
+    ncell = grid.getNumberOfCells()
+    if L.shape[1] != ncell:
+        raise ValueError('Fresnel-volume kernels are only available for isotropic media')
+    s0 = np.mean(data[:, 6] / np.asarray(L.sum(axis=1)).ravel())
+    return fresnel.fresnelKernel(grid, s0 * np.ones(ncell), data[:, 0:3], data[:, 3:6],
+                                 params.fresnelFreq, params.fresnelMaxNnz)
+
 
 def invLSQR(params, data, idata, grid, L, app=None, ui=None):
     """
@@ -247,6 +517,11 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
         # We get the straights rays for the first iteration
         L = grid.getForwardStraightRays(idata)
 
+    useFresnel = params.fresnel == 1
+    if useFresnel:
+        # kernels in the homogeneous model replace the straight rays
+        L = homogeneousFresnelKernel(params, data, grid, L)
+
     tomo.x = 0.5 * (grid.grx[0:-2] + grid.grx[1:-1])
     tomo.z = 0.5 * (grid.grz[0:-2] + grid.grz[1:-1])
 
@@ -262,7 +537,12 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
     # These will smoothen the subsequent slowness/velocity model
     Dx, Dy, Dz = grid.derivative(params.order)
 
+    tomo.invData = iterationHistory(params, data.shape[0], L.shape[1])
+    # norm of the residual of the solver, at each iteration
+    tomo.res = np.zeros((params.numItCurved + params.numItStraight + 1,))
+
     for noIter in range(params.numItCurved + params.numItStraight + 1):
+        t0 = time.perf_counter()
         if ui is not None and app is not None:
             ui.gv.noIter = noIter
             app.processEvents()
@@ -296,14 +576,16 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
             # TODO: faire les modifications aux matrices A et b avec les contraintes
             pass
 
-        ans = linalg.lsqr(A, b, atol=params.tol, btol=params.tol, iter_lim=params.nbreiter)
-        # See http://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.sparse.linalg.lsqr.html for documentation
-        x = ans[0]
-
-        if noIter == 0:
-            tomo.res[0] = ans[3]
-        else:
-            np.append(tomo.res, ans[3])
+        # the model of the previous iteration is the initial solution of the
+        # solver if warm started
+        x0 = None
+        iter_lim = params.nbreiter
+        if noIter > 0 and params.warmStart == 1:
+            x0 = tomo.s - mean_s
+            if params.nbreiterWarm > 0:
+                iter_lim = params.nbreiterWarm
+        x, info = solveLSQR(A, b, x0, params.lsqrSolver, params.colScaling == 1, params.tol, iter_lim)
+        tomo.res[noIter] = info['rnorm']
 
         if max(abs(s_o / (x + mean_s) - 1)) > params.dv_max:
             fac = min(abs((s_o / (params.dv_max + 1) - mean_s) / x))
@@ -313,7 +595,33 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
         tomo.s = x + mean_s
 
         # Applying the resulting model to Tx and Rx to get new tt and L and the trajectory of curved rays
-        tt, L, tomo.rays = grid.raytrace(tomo.s, data[:, 0:3], data[:, 3:6])
+        # ray paths are only needed for the final model
+        last = noIter == params.numItCurved + params.numItStraight
+        # with multigrid, rays are traced on a coarser grid except for the L
+        # of the last numItFine solves (the final raytracing is always on the
+        # full grid)
+        coarse = (params.mgFactor > 1 and
+                  noIter < params.numItCurved + params.numItStraight - params.numItFine)
+        if useFresnel:
+            # the kernels replace L, rays are traced for the final model only
+            L = fresnel.fresnelKernel(grid, tomo.s, data[:, 0:3], data[:, 3:6],
+                                      params.fresnelFreq, params.fresnelMaxNnz)
+            if last:
+                res = grid.raytrace(tomo.s, data[:, 0:3], data[:, 3:6], compute_L=False, compute_rays=True)
+        else:
+            if coarse:
+                res = grid.raytraceMultigrid(tomo.s, data[:, 0:3], data[:, 3:6], factor=params.mgFactor)
+            elif params.incRaytrace == 1:
+                # ray paths are kept to be updated incrementally
+                res = grid.raytraceIncremental(tomo.s, data[:, 0:3], data[:, 3:6], compute_rays=True,
+                                               rtol=params.rtolRaytrace)
+            else:
+                res = grid.raytrace(tomo.s, data[:, 0:3], data[:, 3:6], compute_rays=last)
+            L = res.L
+        if last:
+            tomo.rays = res.rays
+            if tomo.no_trace.size == data.shape[0]:
+                tomo.rays.no_trace = tomo.no_trace
 
         if ui is not None:
             ui.InvIterationDone.emit(noIter,tomo.s, "LSQR")
@@ -322,37 +630,49 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
 
         if params.saveInvData == 1:
             tt = L * tomo.s
-            if noIter == 0:
-                tomo.invData.res = np.array([data[:, 6] - tt]).T
-                tomo.invData.s = np.array([tomo.s]).T
-
-            else:
-                tomo.invData.res = np.concatenate((tomo.invData.res, np.array([data[:, 6] - tt]).T), axis=1)
-                tomo.invData.s = np.concatenate((tomo.invData.s, np.array([tomo.s]).T), axis=1)
+            tomo.invData.add(noIter, data[:, 6] - tt, tomo.s, info, time.perf_counter() - t0)
+        else:
+            tomo.invData.add(noIter, stats=info, time=time.perf_counter() - t0)
 
         tomo.L = L
 
 #                 Results:
 #                       tomo.invData.res:
-#                                       - shape: (m, noIter+1)
+#                                       - shape: (m, noIter+1), or (m, params.historyKeep)
 #                                       - values: residuals from comparison between original tt (i.e. data[:, 6])
 #                                                 and tt calculated from the slowness model and the L sparse matrix
 #
-#                       tomo.invData.res:
-#                                       - shape: (n, noIter+1)
+#                       tomo.invData.s:
+#                                       - shape: (n, noIter+1), or (n, params.historyKeep)
 #                                       - values: slowness models from ech iterations
 
     if ui is not None:
         ui.InvDone.emit(noIter, "LSQR")
     else:
-        print('LSQR Inversion - Finished, {} Iterations Done'.format(noIter))
+        print('LSQR Inversion - Finished, {} Iterations Done, {} products with A or A\''.format(
+            noIter, sum([i['nmatvec'] for i in tomo.invData.stats])))
 
     return tomo
 
 
+def iterationHistory(params, ndata, ncell):
+    """
+    invData instance sized for the iterations of an inversion, following
+    parameters saveInvData, historyKeep and historyFloat32
+    """
+    nit = params.numItCurved + params.numItStraight + 1
+    nkeep = None
+    if params.saveInvData != 1:
+        nkeep = 0
+    elif params.historyKeep > 0:
+        nkeep = params.historyKeep
+    dtype = np.float32 if params.historyFloat32 == 1 else np.float64
+    return invData(nit, ndata, ncell, nkeep, dtype)
+
+
 class Tomo(object):
     def __init__(self):
-        self.rays   = np.array([])
+        self.rays   = Rays()
         self.L      = np.array([])
         self.invData = invData()
         self.no_trace = np.array([])
@@ -362,9 +682,92 @@ class Tomo(object):
         self.s = 0
         self.res = np.array([0])
         self.var_res = np.array([])
+        self.var_s = np.array([])  # posterior variance of slowness (geostatistical inversion)
 
 
 class invData(object):
-    def __init__(self):
-        self.res = np.array([0])
-        self.s = np.array([0])
+    """
+    History of the iterations of an inversion
+
+    Arrays are allocated once for the whole inversion, and the residuals and
+    models of the last nkeep iterations only can be retained (the oldest
+    ones being overwritten), possibly in single precision.  Solver
+    statistics and timings are kept for all iterations.
+
+    Attributes:
+        res: residuals of the kept iterations (ndata x nkept), oldest first
+        s: models of the kept iterations (ncell x nkept), oldest first
+        iterations: numbers of the kept iterations
+        stats: solver statistics of all iterations (dicts, or None)
+        times: duration of all iterations (s)
+    """
+    def __init__(self, nit=0, ndata=0, ncell=0, nkeep=None, dtype=np.float64):
+        """
+        Input:
+            nit: number of iterations of the inversion
+            ndata, ncell: number of data and of cells
+            nkeep: number of iterations whose residuals and models are
+                retained (None: all, 0: none)
+            dtype: type of the stored residuals and models
+        """
+        self.nkeep = nit if nkeep is None else min(nkeep, nit)
+        self._res = np.zeros((ndata, self.nkeep), dtype=dtype)
+        self._s = np.zeros((ncell, self.nkeep), dtype=dtype)
+        self._it = np.zeros((self.nkeep,), dtype=np.int64)
+        self.nstored = 0  # number of residuals and models stored so far
+        self.stats = [None] * nit
+        self.times = np.zeros((nit,))
+
+    def __setstate__(self, state):
+        if '_res' in state:
+            self.__dict__.update(state)
+            return
+        # saved before the history was preallocated (res and s arrays)
+        res = np.asarray(state.get('res', np.zeros((0, 0))))
+        s = np.asarray(state.get('s', np.zeros((0, 0))))
+        res = res.reshape(res.shape[0], -1) if res.ndim < 2 else res
+        s = s.reshape(s.shape[0], -1) if s.ndim < 2 else s
+        invData.__init__(self, res.shape[1], res.shape[0], s.shape[0], dtype=res.dtype)
+        self._res[:, :] = res
+        self._s[:, :s.shape[1]] = s
+        self._it[:] = np.arange(res.shape[1])
+        self.nstored = res.shape[1]
+
+    def add(self, noIter, res=None, s=None, stats=None, time=0.0):
+        """
+        Store the results of an iteration
+
+        Input:
+            noIter: number of the iteration (0 for the first one)
+            res: residuals (ndata,), not stored if None
+            s: model (ncell,)
+            stats: solver statistics
+            time: duration of the iteration (s)
+        """
+        if noIter < len(self.stats):
+            self.stats[noIter] = stats
+            self.times[noIter] = time
+        if res is None or self.nkeep == 0:
+            return
+        n = self.nstored % self.nkeep
+        self._res[:, n] = res
+        self._s[:, n] = s
+        self._it[n] = noIter
+        self.nstored += 1
+
+    def _order(self):
+        if self.nstored <= self.nkeep:
+            return slice(0, self.nstored)
+        return (self.nstored + np.arange(self.nkeep)) % self.nkeep
+
+    @property
+    def res(self):
+        return self._res[:, self._order()]
+
+    @property
+    def s(self):
+        return self._s[:, self._order()]
+
+    @property
+    def iterations(self):
+        return self._it[self._order()]
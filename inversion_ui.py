@@ -29,7 +29,10 @@ import scipy as spy
 from scipy.sparse import linalg
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from scipy import interpolate
+from matplotlib.collections import LineCollection
 from inversion import invLSQR, InvLSQRParams, invGeostat
+from grid import Rays
+import fresnel
 from utils import set_tick_arrangement, ComputeThread
 import utils_ui
 from mog import Mog, AirShots
@@ -275,6 +278,10 @@ class InversionUI(QtWidgets.QFrame):
             pass
 
         self.update_params()
+        if self.lsqrParams.fresnel == 1 and self.lsqrParams.fresnelFreq <= 0:
+            # width of the kernels set by the nominal frequency of the antennas
+            self.lsqrParams.fresnelFreq = np.mean([fresnel.nominalFrequency(self.model.mogs[i])
+                                                   for i in self.lsqrParams.selectedMogs])
         if self.algo_combo.currentText() == 'LSQR Solver':
             self.compute_thread = ComputeThread(self.doInvLSQR_inThread,data,idata,L)
         elif self.algo_combo.currentText() == 'Geostatistic':
@@ -1138,17 +1145,7 @@ class RaysFig(FigureCanvasQTAgg):
         self.ax.cla()
         grid = self.ui.models[self.ui.model_ind].grid
         res = self.ui.tomo.invData.res[:, -1]
-        mog = self.ui.mogs[self.ui.mog_list.selectedIndexes()[0].row()]
-
-        n = int(self.ui.trace_num_edit.text()) - 1
-
-        Tx = np.unique(mog.data.Tx_z)
-        print(Tx)
-
-        ind1 = np.where(mog.tt != -1.0)[0]
-        ind2 = np.where(mog.data.Tx_z[ind1] == Tx[n])[0]
-        print(ind1)
-        print(ind2)
+        rays = Rays.fromList(self.ui.tomo.rays)
 
         rmax = 1.001 * max(np.abs(res.flatten()))
         rmin = -rmax
@@ -1159,17 +1156,16 @@ class RaysFig(FigureCanvasQTAgg):
 
         c = interpolate.interp1d(np.arange(-100, 101, 100).T, c.T)(np.arange(-100, 101, 2).T)
         m = 200 / (rmax - rmin)
-        if not self.ui.entire_coverage_check.isChecked():
-            for n in ind2:
-                p = m * res[n]
-                color = interpolate.interp1d(np.arange(-100, 101, 2), c)(p)
-                self.ax.plot(self.ui.tomo.rays[n][:, 0], self.ui.tomo.rays[n][:, -1], c=color)
-
-        elif self.ui.entire_coverage_check.isChecked():
-            for n in range(len(self.ui.tomo.rays)):
-                p = m * res[n]
-                color = interpolate.interp1d(np.arange(-100, 101, 2), c)(p)
-                self.ax.plot(self.ui.tomo.rays[n][:, 0], self.ui.tomo.rays[n][:, -1], c=color)
+        if not self.ui.entire_coverage_check.isChecked() and rays.Tx is not None:
+            n = int(self.ui.trace_num_edit.text()) - 1
+            Tx = np.unique(rays.Tx[:, 2])
+            ind = rays.selectTx(Tx[n])
+        else:
+            ind = np.arange(len(rays))
+
+        colors = interpolate.interp1d(np.arange(-100, 101, 2), c)(m * res[ind]).T
+        self.ax.add_collection(LineCollection(rays[ind].segments(), colors=colors))
+        self.ax.autoscale_view()
 
         for tick in self.ax.xaxis.get_major_ticks():
             tick.label.set_fontsize(8)
@@ -1275,7 +1271,7 @@ class ResidualsFig(FigureCanvasQTAgg):
         rms = np.zeros(nIt)
 
         for n in range(nIt):
-            rms[n] = self.rmsv(self.ui.tomo.invData.res[n])
+            rms[n] = self.rmsv(self.ui.tomo.invData.res[:, n])
 
         res = self.ui.tomo.invData.res[:, nIt - 1]
         vres = np.var(res)
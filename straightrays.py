@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Ray projection matrices for straight rays, computed with NumPy
+
+Copyright 2017 Bernard Giroux
+email: Bernard.Giroux@ete.inrs.ca
+
+This file is part of BhTomoPy.
+
+BhTomoPy is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+The lengths of the ray segments in each cell are obtained as in the method
+of Siddon (1985, Med. Phys. 12(2), 252-255): the parameters u (0 at Tx, 1 at
+Rx) of the intersections of each ray with the grid planes are sorted, and the
+cell holding a segment is found from the coordinates of its midpoint.  This
+is done for a chunk of rays at once with array operations, the matrix being
+built directly in CSR format.  Segments outside the grid are assigned to the
+cells on its border.
+
+Matrices are kept in cache (see class LCache), the module-level instance
+cache being used by Grid2D.getForwardStraightRays and
+Grid3D.getForwardStraightRays.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class LCache(object):
+    """
+    Cache of straight-ray projection matrices
+
+    Matrices are identified by a hash of their content: coordinates of the
+    grid planes (which reflect the cell size), coordinates of Tx and Rx and
+    the aniso flag.  The matrices most recently used are held in memory up to
+    max_mb MB, and they are also written to directory if it is set, so that
+    they can be reused in later sessions.  Copies of the cached matrices are
+    returned, callers may thus modify them.
+
+    Attributes:
+        max_mb: max size of the matrices held in memory, in MB (0: no memory cache)
+        directory: where matrices are stored on disk (None: not stored)
+        hits: number of matrices found in memory or on disk
+        misses: number of matrices computed
+    """
+    def __init__(self, max_mb=256, directory=None):
+        self.max_mb = max_mb
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()  # most recently used last
+        self.nbytes = 0
+
+    @staticmethod
+    def makeKey(Tx, Rx, grids, aniso):
+        """
+        Hash identifying the matrix of rays from Tx to Rx on grid planes grids
+        """
+        h = hashlib.sha1()
+        h.update(('%d %d' % (len(grids), int(bool(aniso)))).encode())
+        for a in (Tx, Rx) + tuple(grids):
+            a = np.ascontiguousarray(a, dtype=np.float64)
+            h.update(str(a.shape).encode())
+            h.update(a.tobytes())
+        return h.hexdigest()
+
+    def get(self, Tx, Rx, grids, aniso=False):
+        """
+        Ray projection matrix for straight rays, computed only if not in cache
+
+        Input:
+            same as function siddon
+        Output:
+            L: CSR matrix
+        """
+        key = LCache.makeKey(Tx, Rx, grids, aniso)
+        L = self.entries.get(key)
+        if L is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return L.copy()
+
+        L = self.load(key)
+        if L is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            L = siddon(Tx, Rx, grids, aniso)
+            self.save(key, L)
+        self.store(key, L)
+        return L.copy()
+
+    def store(self, key, L):
+        size = L.data.nbytes + L.indices.nbytes + L.indptr.nbytes
+        if size > self.max_mb * 1024 * 1024:
+            return
+        self.entries[key] = L
+        self.nbytes += size
+        while self.nbytes > self.max_mb * 1024 * 1024:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.data.nbytes + old.indices.nbytes + old.indptr.nbytes
+
+    def load(self, key):
+        if self.directory is None:
+            return None
+        fname = os.path.join(self.directory, key + '.npz')
+        if not os.path.isfile(fname):
+            return None
+        with np.load(fname) as f:
+            return csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']), copy=False)
+
+    def save(self, key, L):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # written to a temporary file first, so that other processes never
+        # read a partial file
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, data=L.data, indices=L.indices, indptr=L.indptr, shape=np.array(L.shape))
+        os.replace(tmp, os.path.join(self.directory, key + '.npz'))
+
+    def clear(self):
+        """
+        Empty memory cache (files on disk are kept)
+        """
+        self.entries.clear()
+        self.nbytes = 0
+
+
+cache = LCache()
+
+
+def Lsr2d(Tx, Rx, grx, grz, aniso=False, chunk_size=2**22):
+    """
+    Ray projection matrix for straight rays in 2D
+
+    Input:
+        Tx: coordinates of sources (ndata x 2), x and z
+        Rx: coordinates of receivers (ndata x 2)
+        grx, grz: coordinates of the grid planes (cell index is ix*ncz + iz)
+        aniso: if true, L is ndata x 2*ncell; lengths projected along X are
+            followed by projections along Z.  As with Grid2Dcpp.Lsr2da, rays
+            are oriented so that x increases, projections along Z are thus
+            negative for rays going downward
+        chunk_size: max number of ray-plane intersections held in memory
+    Output:
+        L: ndata x ncell CSR matrix (ndata x 2*ncell if aniso is true)
+    """
+    return siddon(Tx, Rx, (grx, grz), aniso, chunk_size)
+
+
+def Lsr3d(Tx, Rx, grx, gry, grz, aniso=False, chunk_size=2**22):
+    """
+    Ray projection matrix for straight rays in 3D
+
+    Input:
+        Tx: coordinates of sources (ndata x 3)
+        Rx: coordinates of receivers (ndata x 3)
+        grx, gry, grz: coordinates of the grid planes (cell index is
+            (ix*ncy + iy)*ncz + iz)
+        aniso: if true, L is ndata x 2*ncell; lengths projected on the
+            horizontal plane are followed by (positive) vertical projections,
+            as with Grid3Dcpp.Lsr3d
+        chunk_size: max number of ray-plane intersections held in memory
+    Output:
+        L: ndata x ncell CSR matrix (ndata x 2*ncell if aniso is true)
+    """
+    return siddon(Tx, Rx, (grx, gry, grz), aniso, chunk_size)
+
+
+def siddon(Tx, Rx, grids, aniso=False, chunk_size=2**22):
+    """
+    Ray projection matrix for straight rays, in 2D or 3D
+
+    Input:
+        Tx, Rx: coordinates of the end points (ndata x ndim)
+        grids: tuple of ndim vectors holding the coordinates of the grid planes
+        aniso: build matrix for anisotropic slowness, see Lsr2d and Lsr3d
+        chunk_size: max number of ray-plane intersections held in memory
+    Output:
+        L: CSR matrix
+    """
+    grids = [np.asarray(g, dtype=np.float64) for g in grids]
+    Tx = np.asarray(Tx, dtype=np.float64).reshape(-1, len(grids))
+    Rx = np.asarray(Rx, dtype=np.float64).reshape(-1, len(grids))
+    ndata = Tx.shape[0]
+    ncells = [g.size - 1 for g in grids]
+    ncell = int(np.prod(ncells))
+    ncol = 2 * ncell if aniso else ncell
+    itype = np.int32 if ncol < np.iinfo(np.int32).max else np.int64
+
+    # number of planes + the 2 end points of each ray
+    nu = sum(g.size for g in grids) + 2
+    nrays = max(1, chunk_size // nu)
+
+    data = []
+    indices = []
+    nnz = np.zeros((ndata,), dtype=np.int64)
+    for n0 in range(0, ndata, nrays):
+        n1 = min(n0 + nrays, ndata)
+        rows, cols, vals = _chunk(Tx[n0:n1], Rx[n0:n1], grids, ncells, aniso)
+        nnz[n0:n1] = np.bincount(rows, minlength=n1 - n0)
+        data.append(vals)
+        indices.append(cols.astype(itype))
+
+    indptr = np.zeros((ndata + 1,), dtype=np.int64)
+    np.cumsum(nnz, out=indptr[1:])
+    if ndata > 0:
+        data = np.concatenate(data)
+        indices = np.concatenate(indices)
+    else:
+        data = np.zeros((0,))
+        indices = np.zeros((0,), dtype=itype)
+    return csr_matrix((data, indices, indptr), shape=(ndata, ncol), copy=False)
+
+
+def _chunk(a, b, grids, ncells, aniso):
+    """
+    Rows (local to the chunk), columns and values of the elements of L for
+    rays going from a to b, sorted by row and column
+    """
+    ndim = len(grids)
+    d = b - a
+    if aniso and ndim == 2:
+        # orient the rays so that x increases, as in Grid2Dcpp.Lsr2da
+        flip = d[:, 0] < 0
+        a = np.where(flip[:, None], b, a)
+        d = np.where(flip[:, None], -d, d)
+
+    # parameters of the intersections with the planes, 1 (end point) where
+    # the ray does not cross the plane
+    u = [np.zeros((a.shape[0], 1))]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for m in range(ndim):
+            um = (grids[m][None, :] - a[:, m, None]) / d[:, m, None]
+            um[~((um > 0.0) & (um < 1.0))] = 1.0
+            u.append(um)
+    u.append(np.ones((a.shape[0], 1)))
+    u = np.sort(np.hstack(u), axis=1)
+
+    du = np.diff(u, axis=1)
+    r, s = np.nonzero(du > 1.e-12)
+    du = du[r, s]
+    um = u[r, s] + 0.5 * du
+
+    # cell holding each segment, from the coordinates of its midpoint
+    icell = np.zeros(r.shape, dtype=np.int64)
+    for m in range(ndim):
+        v = a[r, m] + um * d[r, m]
+        i = np.searchsorted(grids[m], v, side='right') - 1
+        icell = icell * ncells[m] + np.clip(i, 0, ncells[m] - 1)
+
+    if not aniso:
+        vals = du * np.sqrt(np.sum(d * d, axis=1))[r]
+    else:
+        if ndim == 2:
+            h = np.abs(d[:, 0])
+            v = np.where(d[:, 0] == 0.0, np.abs(d[:, 1]), d[:, 1])
+        else:
+            h = np.sqrt(d[:, 0] ** 2 + d[:, 1] ** 2)
+            v = np.abs(d[:, 2])
+        ncell = int(np.prod(ncells))
+        r = np.concatenate((r, r))
+        icell = np.concatenate((icell, icell + ncell))
+        vals = np.concatenate((du * h[r[:du.size]], du * v[r[:du.size]]))
+        # horizontal and vertical rays have a single component
+        keep = vals != 0.0
+        r = r[keep]
+        icell = icell[keep]
+        vals = vals[keep]
+
+    order = np.argsort(r * (2 * int(np.prod(ncells))) + icell)
+    return r[order], icell[order], vals[order]
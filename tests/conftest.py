@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+Configuration of the tests
+
+The modules of BhTomoPy are at the top of the repository, and the
+extensions of cutils must be built in place (python setup.py build_ext
+--inplace) before the tests are run.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
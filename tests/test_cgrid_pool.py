@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the sharing of C++ grids through cgrid_pool
+"""
+
+import numpy as np
+
+from grid import Grid2D, cgrid_pool
+
+
+def crosshole(tt_cache_mb):
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 1)
+    g.setTTCache(tt_cache_mb)
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    return g, Tx, Rx
+
+
+def test_shared_with_same_parameters():
+    cgrid_pool.clear()
+    g1, Tx, Rx = crosshole(0)
+    g2, _, _ = crosshole(0)
+    s = np.ones(g1.getNumberOfCells())
+
+    g1.raytrace(s, Tx, Rx)
+    g2.raytrace(s, Tx, Rx)
+
+    assert g1.cgrid is g2.cgrid
+    assert len(cgrid_pool.grids) == 1
+
+
+def test_cache_sizes_not_reset_by_other_instance():
+    cgrid_pool.clear()
+    g1, Tx, Rx = crosshole(10)
+    g2, _, _ = crosshole(20)
+    s = np.ones(g1.getNumberOfCells())
+
+    for g in (g1, g2):
+        g.raytrace(s, Tx, Rx, compute_L=False)
+    assert g1.cgrid is not g2.cgrid
+
+    # travel-time fields stay cached for both instances used in turn
+    for g in (g1, g2, g1, g2):
+        assert g.raytrace(s, Tx, Rx, compute_L=False).nsolves == 0
+    assert g1.cgrid.getTTCacheStats()[2] == 2 * 8
+    assert g2.cgrid.getTTCacheStats()[2] == 2 * 8
+
+    # a new size selects another grid
+    g1.setTTCache(20)
+    g1.raytrace(s, Tx, Rx, compute_L=False)
+    assert g1.cgrid is g2.cgrid
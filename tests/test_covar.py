@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the covariance operator applied by FFT against the dense covariance
+matrix
+"""
+
+import numpy as np
+import pytest
+
+import covar
+from grid import Grid2D
+
+
+def covarianceModel():
+    cm = covar.CovarianceModel('2D')
+    cm.covar = [covar.CovarianceSpherical(np.array([4.0, 2.0]), np.array([30.0]), 0.01),
+                covar.CovarianceExponential(np.array([1.5, 3.0]), np.array([0.0]), 0.005)]
+    cm.nugget_model = 0.001
+    return cm
+
+
+def test_operator_equals_dense_matrix():
+    g = Grid2D(np.linspace(0, 6, 13), np.linspace(0, 10, 21))
+    cm = covarianceModel()
+    Cm = cm.compute(g.getCellCenter(), g.getCellCenter())
+
+    C = g.covarianceOperator(cm)
+    X = np.random.RandomState(0).standard_normal((Cm.shape[0], 5))
+
+    assert C.shape == Cm.shape
+    assert np.allclose(C.dot(X[:, 0]), Cm @ X[:, 0], rtol=0.0, atol=1.e-12)
+    assert np.allclose(C.matmat(X), Cm @ X, rtol=0.0, atol=1.e-12)
+    assert np.allclose(C.diagonal(), np.diag(Cm))
+
+
+def test_data_covariance():
+    g = Grid2D(np.linspace(0, 6, 13), np.linspace(0, 10, 21))
+    cm = covarianceModel()
+    Cm = cm.compute(g.getCellCenter(), g.getCellCenter())
+    z = np.linspace(0.5, 9.5, 7)
+    Tx = np.array([[0.2, 0.0, a] for a in z for _ in z])
+    Rx = np.array([[5.8, 0.0, b] for _ in z for b in z])
+    L = g.raytrace(np.ones(g.getNumberOfCells()), Tx, Rx).L
+
+    Cd, CmLt = g.covarianceOperator(cm).LCmLt(L, return_CmLt=True, chunk_size=16)
+
+    assert np.allclose(CmLt, Cm @ L.T.toarray(), rtol=0.0, atol=1.e-12)
+    assert np.allclose(Cd, L @ Cm @ L.T.toarray(), rtol=0.0, atol=1.e-10)
+
+
+def test_anisotropic_model_rejected():
+    g = Grid2D(np.linspace(0, 6, 13), np.linspace(0, 10, 21))
+    cm = covarianceModel()
+    cm.use_xi = True
+    with pytest.raises(ValueError):
+        g.covarianceOperator(cm)
+
+
+@pytest.mark.parametrize('grow', [False, True])
+def test_embedding_is_symmetric(grow):
+    g = Grid2D(np.linspace(0, 6, 13), np.linspace(0, 10, 21))
+    cm = covarianceModel()
+
+    K = g.covarianceEmbedding(cm.covar, 2 * g.grx.size, 2 * g.grz.size, grow)
+
+    # K(-h) = K(h): the spectrum of the embedding is real, and G of FFT-MA too
+    assert np.allclose(K, np.roll(K[::-1, ::-1], 1, axis=(0, 1)), rtol=0.0, atol=1.e-15)
+    assert np.abs(np.fft.fft2(K).imag).max() < 1.e-12
+    if grow:
+        G = g.preFFTMA(cm.covar)
+        assert G.shape == K.shape
+        assert np.allclose(G**2, np.fft.fft2(K), rtol=0.0, atol=1.e-12)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the fast marching raytracing engine of Grid2D
+"""
+
+import numpy as np
+
+from grid import Grid2D
+
+
+def crosshole():
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 1)
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    return g, Tx, Rx
+
+
+def test_homogeneous_model():
+    g, Tx, Rx = crosshole()
+    g.setRaytracingMethod('fmm')
+    s = np.ones(g.getNumberOfCells())
+    res = g.raytrace(s, Tx, Rx)
+
+    d = np.linalg.norm(Tx - Rx, axis=1)
+    assert np.allclose(res.tt, d, rtol=1.e-10)
+    assert np.allclose(np.asarray(res.L.sum(axis=1)).ravel(), d, rtol=1.e-10)
+
+
+def test_close_to_spm():
+    g, Tx, Rx = crosshole()
+    xc = g.getCellCenter()
+    s = 1.0 + 0.3 * np.exp(-((xc[:, 0] - 5.0)**2 + (xc[:, 1] - 7.0)**2) / 4.0)
+    tt_spm = g.raytrace(s, Tx, Rx, compute_L=False).tt
+
+    g.setRaytracingMethod('fmm')
+    res = g.raytrace(s, Tx, Rx)
+    assert np.allclose(res.tt, tt_spm, rtol=5.e-3, atol=0.0)
+    # rays traced back along the gradient are consistent with the traveltimes
+    assert np.allclose(res.L @ s, res.tt, rtol=1.e-2, atol=0.0)
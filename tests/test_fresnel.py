@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the Fresnel-volume kernels and of their use in the inversions
+"""
+
+import numpy as np
+import pytest
+
+import covar
+import fresnel
+from grid import Grid2D
+from inversion import InvLSQRParams, invGeostat, invLSQR
+
+
+def crosshole():
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 1)
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    return g, Tx, Rx
+
+
+def fresnelParams():
+    params = InvLSQRParams()
+    params.fresnel = 1
+    params.fresnelFreq = 0.5
+    return params
+
+
+@pytest.mark.parametrize('max_nnz', [None, 64])
+def test_traveltimes_of_homogeneous_model(max_nnz):
+    g, Tx, Rx = crosshole()
+    s = 10.0 * np.ones(g.getNumberOfCells())
+
+    K = fresnel.fresnelKernel(g, s, Tx, Rx, 0.5, max_nnz)
+    tt = g.raytrace(s, Tx, Rx, compute_L=False).tt
+
+    assert K.shape == (Tx.shape[0], g.getNumberOfCells())
+    assert np.allclose(K @ s, tt, rtol=1.e-10, atol=0.0)
+
+
+def test_anisotropic_slowness_rejected():
+    g, Tx, Rx = crosshole()
+    with pytest.raises(ValueError):
+        fresnel.fresnelKernel(g, np.ones(2 * g.getNumberOfCells()), Tx, Rx, 0.5)
+
+
+def test_inversions_reject_anisotropy():
+    g, Tx, Rx = crosshole()
+    data = np.column_stack((Tx, Rx, 10.0 * np.ones(Tx.shape[0])))
+    idata = np.ones(Tx.shape[0], dtype=bool)
+
+    # straight rays of anisotropic media have a column per cell and per component
+    L = np.ones((Tx.shape[0], 2 * g.getNumberOfCells()))
+    with pytest.raises(ValueError, match='isotropic'):
+        invLSQR(fresnelParams(), data, idata, g, L)
+
+    cm = covar.CovarianceModel('2D')
+    cm.use_xi = True
+    L = np.ones((Tx.shape[0], g.getNumberOfCells()))
+    with pytest.raises(ValueError, match='isotropic'):
+        invGeostat(fresnelParams(), data, idata, g, cm, L)
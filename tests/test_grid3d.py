@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of Grid3D.raytrace
+"""
+
+import numpy as np
+
+from grid import Grid3D
+
+
+def crosshole():
+    g = Grid3D(np.linspace(0, 6, 7), np.linspace(0, 4, 5), np.linspace(0, 8, 9), 1)
+    zt = np.linspace(0.5, 7.5, 4)
+    zr = np.linspace(0.5, 7.5, 6)
+    Tx = np.array([[0.5, 1.5, a] for a in zt for _ in zr])
+    Rx = np.array([[5.5, 2.5, b] for _ in zt for b in zr])
+    return g, Tx, Rx
+
+
+def slowness(g):
+    xc = g.getCellCenter()
+    return 1.0 + 0.3 * np.exp(-((xc[:, 0] - 3.0)**2 + (xc[:, 1] - 2.0)**2 + (xc[:, 2] - 4.0)**2) / 3.0)
+
+
+def test_homogeneous_model():
+    g, Tx, Rx = crosshole()
+    res = g.raytrace(np.ones(g.getNumberOfCells()), Tx, Rx)
+
+    d = np.linalg.norm(Tx - Rx, axis=1)
+    assert np.allclose(res.tt, d, rtol=2.e-3, atol=0.0)
+    assert np.allclose(np.asarray(res.L.sum(axis=1)).ravel(), d, rtol=1.e-4, atol=0.0)
+    assert res.L.shape == (Tx.shape[0], g.getNumberOfCells())
+    assert res.L.indices.dtype == np.int32
+    assert res.nsolves == 4
+
+
+def test_rays_and_reciprocity():
+    g, Tx, Rx = crosshole()
+    s = slowness(g)
+    res = g.raytrace(s, Tx, Rx, compute_rays=True)
+    assert np.allclose(res.L @ s, res.tt, rtol=3.e-2, atol=0.0)
+    for n in range(Tx.shape[0]):
+        assert np.allclose(res.rays[n][0], Tx[n])
+        assert np.allclose(res.rays[n][-1], Rx[n])
+
+    # 6 unique sources and 4 unique receivers: roles are swapped
+    swapped = g.raytrace(s, Rx, Tx, compute_rays=True)
+    assert swapped.nsolves == 4 and swapped.nsolves_saved == 2
+    assert np.array_equal(swapped.tt, res.tt)
+    for n in range(Tx.shape[0]):
+        assert np.allclose(swapped.rays[n][0], Rx[n])
+        assert np.allclose(swapped.rays[n][-1], Tx[n])
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the solvers and of the iteration history of the inversions
+"""
+
+import pickle
+
+import numpy as np
+import pytest
+from scipy.linalg import cho_factor, cho_solve
+from scipy.sparse import diags, vstack
+from scipy.sparse.linalg import lsqr
+
+import covar
+import inversion
+from grid import Grid2D
+from inversion import (InvLSQRParams, dataSpaceCG, dataSpacePreconditioner, invData, invGeostat, iterationHistory,
+                       solveLSQR)
+
+
+def crosshole():
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 1)
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    xc = g.getCellCenter()
+    s = 1.0 + 0.2 * np.exp(-((xc[:, 0] - 5.0)**2 + (xc[:, 1] - 7.0)**2) / 4.0)
+    L = g.raytrace(np.ones(g.getNumberOfCells()), Tx, Rx).L
+    tt = g.raytrace(s, Tx, Rx, compute_L=False).tt
+    return g, L, tt
+
+
+def covarianceModel():
+    cm = covar.CovarianceModel('2D')
+    cm.covar = [covar.CovarianceSpherical(np.array([4.0, 4.0]), np.array([0.0]), 0.01)]
+    cm.nugget_data = 1.e-4
+    return cm
+
+
+@pytest.mark.parametrize('kind', ['none', 'diag', 'ilu'])
+@pytest.mark.parametrize('fft', [False, True])
+def test_data_space_cg(kind, fft):
+    g, L, tt = crosshole()
+    cm = covarianceModel()
+    xc = g.getCellCenter()
+    Cm = cm.compute(xc, xc)
+    cd = cm.nugget_data * np.ones(L.shape[0])
+    dt = tt - np.asarray(L.sum(axis=1)).ravel() * np.mean(tt / np.asarray(L.sum(axis=1)).ravel())
+
+    Cd = L @ Cm @ L.T.toarray() + np.diag(cd)
+    Gamma = cho_solve(cho_factor(Cd), dt)
+
+    M = dataSpacePreconditioner(L, cm, xc, cd, kind)
+    x, niter, relres = dataSpaceCG(L, g.covarianceOperator(cm) if fft else Cm, cd, dt, M, 1.e-10, 5000)
+
+    assert relres <= 1.e-10
+    assert niter < 5000
+    assert np.allclose(x, Gamma, rtol=0.0, atol=1.e-6 * np.abs(Gamma).max())
+
+
+def test_data_space_cg_defaults(recwarn):
+    g, L, tt = crosshole()
+    cm = covarianceModel()
+    xc = g.getCellCenter()
+    cd = cm.nugget_data * np.ones(L.shape[0])
+    params = InvLSQRParams()
+
+    M = dataSpacePreconditioner(L, cm, xc, cd, params.cgPrecond, params.cgSupport)
+    x, niter, relres = dataSpaceCG(L, cm.compute(xc, xc), cd, tt, M, params.cgTol, params.cgMaxIter)
+
+    assert relres <= params.cgTol
+    assert len(recwarn) == 0
+
+    # a warning is issued when the max number of iterations is reached first
+    with pytest.warns(UserWarning, match='Conjugate gradients stopped'):
+        x, niter, relres = dataSpaceCG(L, cm.compute(xc, xc), cd, tt, M, params.cgTol, 2)
+    assert niter == 2 and relres > params.cgTol
+
+
+def test_failed_factorization(monkeypatch):
+    g, L, tt = crosshole()
+    cm = covarianceModel()
+    cd = cm.nugget_data * np.ones(L.shape[0])
+
+    def spilu(*args, **kwargs):
+        raise RuntimeError('Factor is exactly singular')
+    monkeypatch.setattr(inversion.linalg, 'spilu', spilu)
+
+    with pytest.warns(UserWarning, match='diagonal preconditioner'):
+        M = dataSpacePreconditioner(L, cm, g.getCellCenter(), cd, 'ilu')
+    d = dataSpacePreconditioner(L, cm, g.getCellCenter(), cd, 'diag')
+    assert np.array_equal(M(tt), d(tt))
+
+
+def smoothedSystem():
+    g, L, tt = crosshole()
+    Dx, Dz = (diags([1.0, -1.0], [0, k], shape=(g.getNumberOfCells() - k, g.getNumberOfCells()))
+              for k in (30, 1))
+    A = vstack([L, 0.5 * Dx, 0.5 * Dz]).tocsr()
+    b = np.concatenate((tt - np.asarray(L.sum(axis=1)).ravel(), np.zeros(A.shape[0] - L.shape[0])))
+    return A, b
+
+
+@pytest.mark.parametrize('solver', ['lsqr', 'lsmr'])
+@pytest.mark.parametrize('colScaling', [False, True])
+def test_solve_lsqr_warm_start(solver, colScaling):
+    A, b = smoothedSystem()
+    ref = lsqr(A, b, atol=1.e-12, btol=1.e-12, iter_lim=10000)[0]
+
+    x, info = solveLSQR(A, b, None, solver, colScaling, 1.e-8, 5000)
+    assert info['solver'] == solver
+    assert np.allclose(x, ref, rtol=0.0, atol=1.e-5)
+
+    # started close to the solution, fewer iterations are needed for the same result
+    x0 = ref + 1.e-3 * np.random.RandomState(0).standard_normal(ref.shape)
+    xw, infow = solveLSQR(A, b, x0, solver, colScaling, 1.e-8, 5000)
+    assert np.allclose(xw, ref, rtol=0.0, atol=1.e-5)
+    assert infow['niter'] < info['niter']
+    assert infow['nmatvec'] == 2 * infow['niter'] + 1
+
+
+def test_history_ring_buffer():
+    h = invData(nit=5, ndata=3, ncell=2, nkeep=2, dtype=np.float32)
+    for n in range(5):
+        h.add(n, n * np.ones(3), -n * np.ones(2), {'niter': n}, 0.1 * n)
+
+    assert np.array_equal(h.iterations, [3, 4])
+    assert h.res.dtype == np.float32
+    assert np.array_equal(h.res, [[3, 4]] * 3)
+    assert np.array_equal(h.s, [[-3, -4]] * 2)
+    # statistics and timings are kept for all iterations
+    assert [st['niter'] for st in h.stats] == list(range(5))
+    assert np.allclose(h.times, 0.1 * np.arange(5))
+
+    h = pickle.loads(pickle.dumps(h))
+    assert np.array_equal(h.iterations, [3, 4])
+
+
+def test_history_parameters():
+    params = InvLSQRParams()
+    params.numItStraight = 2
+    params.numItCurved = 3
+    params.historyKeep = 2
+    params.historyFloat32 = 1
+    h = iterationHistory(params, 10, 20)
+    assert h.nkeep == 2 and h.res.dtype == np.float32
+
+    params.saveInvData = 0
+    h = iterationHistory(params, 10, 20)
+    h.add(0, np.ones(10), np.ones(20))
+    assert h.nkeep == 0 and h.res.shape == (10, 0)
+
+
+def test_history_of_old_files():
+    # before preallocation, residuals and models of all iterations were in res and s
+    state = {'res': np.arange(6.0).reshape(3, 2), 's': np.arange(8.0).reshape(4, 2)}
+    h = invData.__new__(invData)
+    h.__setstate__(state)
+
+    assert np.array_equal(h.res, state['res'])
+    assert np.array_equal(h.s, state['s'])
+    assert np.array_equal(h.iterations, [0, 1])
+    h.add(1, np.zeros(3), np.zeros(4), None, 1.0)
+
+
+def test_geostat_preconditioner_reuse(monkeypatch):
+    # Cs is built once, the preconditioner once for each L
+    g, L, tt = crosshole()
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    data = np.array([[0.5, 0.0, a, 9.5, 0.0, b] for a in zt for b in zr])
+    data = np.column_stack((data, tt))
+    idata = np.ones(tt.shape, dtype=bool)
+    params = InvLSQRParams()
+    params.dataCG = 1
+    params.numItStraight = 2
+    params.numItCurved = 1
+
+    calls = {'compactCovariance': 0, 'spilu': 0}
+
+    def count(module, name):
+        f = getattr(module, name)
+
+        def counted(*args, **kwargs):
+            calls[name] += 1
+            return f(*args, **kwargs)
+        monkeypatch.setattr(module, name, counted)
+    count(covar, 'compactCovariance')
+    count(inversion.linalg, 'spilu')
+
+    tomo = invGeostat(params, data, idata, g, covarianceModel(), L)
+    # 3 solves with the straight rays, 1 with the curved rays
+    assert len(tomo.invData.stats) == 4
+    assert calls == {'compactCovariance': 1, 'spilu': 2}
+
+
+def test_geostat_tilt_without_xi():
+    # tilt is ignored without xi, Cm is then that of the slowness only
+    g, L, tt = crosshole()
+    L = L.toarray()
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    data = np.array([[0.5, 0.0, a, 9.5, 0.0, b] for a in zt for b in zr])
+    data = np.column_stack((data, tt))
+    idata = np.ones(tt.shape, dtype=bool)
+    params = InvLSQRParams()
+    params.fftCovar = 1
+
+    cm = covarianceModel()
+    ref = invGeostat(params, data, idata, g, cm, L)
+    cm.use_tilt = True
+    tomo = invGeostat(params, data, idata, g, cm, L)
+
+    assert np.allclose(tomo.s, ref.s, rtol=0.0, atol=1.e-12)
+
+
+def test_geostat_with_xi():
+    # Cm and L are sparse, L has columns for slowness and xi
+    g, L, tt = crosshole()
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    data = np.array([[0.5, 0.0, a, 9.5, 0.0, b] for a in zt for b in zr])
+    data = np.column_stack((data, tt))
+    idata = np.ones(tt.shape, dtype=bool)
+    nc = g.getNumberOfCells()
+    L = g.raytrace(np.ones(nc), data[:, 0:3], data[:, 3:6], xi=np.ones(nc)).L
+    assert L.shape == (tt.size, 2 * nc)
+    params = InvLSQRParams()
+
+    cm = covarianceModel()
+    cm.use_xi = True
+    cm.covar_xi = [covar.CovarianceSpherical(np.array([4.0, 4.0]), np.array([0.0]), 1.e-3)]
+    tomo = invGeostat(params, data, idata, g, cm, L)
+
+    # same solution and posterior variance with a dense L
+    ref = invGeostat(params, data, idata, g, cm, L.toarray())
+    assert tomo.s.shape == (2 * nc,)
+    # the history holds slowness and xi
+    assert np.array_equal(tomo.invData.s[:, -1], tomo.s)
+    assert np.allclose(tomo.invData.res[:, -1], tt - L @ tomo.s)
+    assert np.allclose(tomo.s, ref.s, rtol=1.e-10, atol=0.0)
+    assert np.allclose(tomo.var_s, ref.var_s, rtol=1.e-8, atol=1.e-14)
+
+
+def test_parameters_of_old_files():
+    # parameters saved before the options of the solvers were added
+    params = InvLSQRParams()
+    state = {k: v for k, v in params.__dict__.items() if k not in ('dataCG', 'cgPrecond', 'warmStart', 'historyKeep')}
+    state['numItCurved'] = 3
+    old = InvLSQRParams.__new__(InvLSQRParams)
+    old.__dict__.update(state)
+
+    params = pickle.loads(pickle.dumps(old))
+    assert params.numItCurved == 3
+    assert params.dataCG == 0 and params.cgPrecond == 'ilu'
+    assert params.warmStart == 0 and params.historyKeep == 0
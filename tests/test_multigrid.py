@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of multigrid raytracing and of its use in invLSQR
+"""
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+import inversion
+from grid import Grid2D
+from inversion import InvLSQRParams, invLSQR
+
+
+def crosshole():
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 1)
+    xc = g.getCellCenter()
+    s = 1.0 + 0.3 * np.exp(-((xc[:, 0] - 5.0)**2 + (xc[:, 1] - 7.0)**2) / 4.0)
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    return g, s, Tx, Rx
+
+
+def test_raytrace_multigrid():
+    g, s, Tx, Rx = crosshole()
+    ref = g.raytrace(s, Tx, Rx)
+    res = g.raytraceMultigrid(s, Tx, Rx, factor=2)
+
+    assert res.L.shape == ref.L.shape
+    # L is prolongated so that L*s is the traveltime in the coarse model
+    assert np.allclose(res.L @ s, res.tt, rtol=1.e-10, atol=0.0)
+    assert np.allclose(res.tt, ref.tt, rtol=2.e-2, atol=0.0)
+    # rays cross the same total length of cells
+    assert np.allclose(np.asarray(res.L.sum(axis=1)).ravel(), np.asarray(ref.L.sum(axis=1)).ravel(),
+                       rtol=2.e-2)
+
+
+@pytest.mark.parametrize('numItFine', [0, 1, 2])
+def test_fine_iterations(monkeypatch, numItFine):
+    g, s, Tx, Rx = crosshole()
+    data = np.zeros((Tx.shape[0], 9))
+    data[:, 0:3] = Tx
+    data[:, 3:6] = Rx
+    data[:, 6] = g.raytrace(s, Tx, Rx, compute_L=False).tt
+    L0 = g.raytrace(np.ones(s.shape), Tx, Rx).L.toarray()
+
+    # the L returned by each raytracing, and the L of each solve
+    traced = []
+    solved = []
+
+    def record(method, coarse):
+        def raytrace(*args, **kwargs):
+            res = method(*args, **kwargs)
+            traced.append((coarse, res.L))
+            return res
+        return raytrace
+
+    def solveLSQR(A, b, *args):
+        solved.append(sp.csr_matrix(A)[:data.shape[0], :].toarray())
+        return solve(A, b, *args)
+
+    solve = inversion.solveLSQR
+    monkeypatch.setattr(inversion, 'solveLSQR', solveLSQR)
+    monkeypatch.setattr(g, 'raytrace', record(g.raytrace, False))
+    monkeypatch.setattr(g, 'raytraceMultigrid', record(g.raytraceMultigrid, True))
+    # the smoothing operators are not the subject of the test
+    monkeypatch.setattr(g, 'derivative', lambda order: (sp.identity(s.size, format='csr'), None,
+                                                        sp.identity(s.size, format='csr')))
+
+    params = InvLSQRParams()
+    params.numItStraight = 0
+    params.numItCurved = 4
+    params.nbreiter = 20
+    params.alphax = 0.1
+    params.alphaz = 0.1
+    params.dv_max = 0.25
+    params.mgFactor = 2
+    params.numItFine = numItFine
+    invLSQR(params, data, None, g, L0)
+
+    # one raytracing per iteration, the last one (for the final model) on the full grid
+    assert [c for c, _ in traced] == [True] * (4 - numItFine) + [False] * (numItFine + 1)
+    assert len(solved) == 5
+    assert np.array_equal(solved[0], L0)
+    for (_, L), A in zip(traced, solved[1:]):
+        assert np.array_equal(A, L.toarray())
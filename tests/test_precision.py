@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of single precision raytracing in Grid2D
+"""
+
+import numpy as np
+import pytest
+
+from grid import Grid2D
+
+
+def crosshole():
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 1)
+    xc = g.getCellCenter()
+    s = 1.0 + 0.3 * np.exp(-((xc[:, 0] - 5.0)**2 + (xc[:, 1] - 7.0)**2) / 4.0)
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    return g, s, Tx, Rx
+
+
+@pytest.mark.parametrize('method, rtol', [('spm', 3.e-6), ('fmm', 2.e-3)])
+def test_single_vs_double(method, rtol):
+    g, s, Tx, Rx = crosshole()
+    g.setRaytracingMethod(method)
+    ref = g.raytrace(s, Tx, Rx, compute_rays=True)
+    g.setPrecision('single')
+    res = g.raytrace(s, Tx, Rx, compute_rays=True)
+
+    assert res.tt.dtype == np.float64
+    assert res.L.dtype == np.float32
+    assert res.rays[0].dtype == np.float32
+    assert np.allclose(res.tt, ref.tt, rtol=rtol, atol=0.0)
+    # paths of equal traveltime may differ, L is compared through L*s
+    assert np.allclose(res.L @ s, ref.L @ s, rtol=5 * rtol, atol=0.0)
+
+    with pytest.raises(ValueError):
+        g.setPrecision('half')
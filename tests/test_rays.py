@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the packed storage of ray paths
+"""
+
+import pickle
+
+import numpy as np
+
+from grid import Rays
+
+
+def rayList(seed=0):
+    rng = np.random.RandomState(seed)
+    rays = [rng.uniform(0, 10, (n, 2)).astype(np.float32) for n in (3, 1, 7, 2, 5)]
+    Tx = np.column_stack((np.zeros(5), np.zeros(5), np.arange(5.0)))
+    return rays, Tx, np.arange(10, 15)
+
+
+def test_packing():
+    rays, Tx, no_trace = rayList()
+    r = Rays.fromList(rays, Tx, no_trace)
+
+    assert len(r) == len(rays)
+    assert r.xz.shape == (sum(len(a) for a in rays), 2)
+    assert np.array_equal(r.getNumberOfPoints(), [len(a) for a in rays])
+    for a, b in zip(r, rays):
+        assert np.array_equal(a, b)
+    assert np.array_equal(r[-1], rays[-1])
+    assert all(np.array_equal(a, b) for a, b in zip(r.segments(), rays))
+
+
+def test_indexing():
+    rays, Tx, no_trace = rayList()
+    r = Rays.fromList(rays, Tx, no_trace)
+
+    for ind in ([4, 0, 2], slice(1, 4), np.array([True, False, True, False, True])):
+        sub = r[ind]
+        expected = np.arange(5)[ind]
+        assert len(sub) == expected.size
+        for a, n in zip(sub, expected):
+            assert np.array_equal(a, rays[n])
+        assert np.array_equal(sub.Tx, Tx[expected])
+        assert np.array_equal(sub.no_trace, no_trace[expected])
+
+    assert np.array_equal(r.selectTx(2.0), [2])
+    assert np.array_equal(r.selectTrace([11, 14]), [1, 4])
+
+
+def test_flip_and_concatenate():
+    rays, Tx, no_trace = rayList()
+    r = Rays.fromList(rays, Tx, no_trace)
+
+    for a, b in zip(r.flip(), rays):
+        assert np.array_equal(a, b[::-1])
+    both = Rays.concatenate([r[:2], r[2:]])
+    assert np.array_equal(both.xz, r.xz)
+    assert np.array_equal(both.offsets, r.offsets)
+    assert np.array_equal(both.Tx, Tx)
+
+
+def test_pickle():
+    rays, Tx, no_trace = rayList()
+    r = pickle.loads(pickle.dumps(Rays.fromList(rays, Tx, no_trace)))
+
+    for a, b in zip(r, rays):
+        assert np.array_equal(a, b)
+    assert np.array_equal(r.no_trace, no_trace)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of Grid2D.raytrace
+"""
+
+import numpy as np
+import pytest
+
+from grid import Grid2D
+
+
+def crosshole(nTx, nRx):
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 1)
+    zt = np.linspace(0.5, 14.5, nTx)
+    zr = np.linspace(0.5, 14.5, nRx)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    xc = g.getCellCenter()
+    s = 1.0 + 0.3 * np.exp(-((xc[:, 0] - 5.0)**2 + (xc[:, 1] - 7.0)**2) / 4.0)
+    return g, s, Tx, Rx
+
+
+@pytest.mark.parametrize('t0', [False, True])
+def test_reciprocity(t0):
+    # more sources than receivers: rays are traced from the receivers
+    g, s, Tx, Rx = crosshole(15, 4)
+    # initial times are the same for the rays of a source
+    t0 = 0.1 * Tx[:, 2] if t0 else np.zeros(Tx.shape[0])
+
+    swap = g.raytrace(s, Tx, Rx, t0, compute_rays=True)
+    ref = g.raytrace(s, Tx, Rx, t0, compute_rays=True, reciprocity=False)
+
+    assert swap.nsolves == 4
+    assert ref.nsolves == 15
+    assert np.allclose(swap.tt, ref.tt, rtol=1.e-10, atol=0.0)
+    # paths of equal traveltimes may differ, but L gives the same traveltimes
+    assert np.allclose(swap.L @ s + t0, ref.tt, rtol=1.e-10, atol=0.0)
+    assert np.allclose(np.asarray(swap.L.sum(axis=1)), np.asarray(ref.L.sum(axis=1)))
+    # ray paths go from Tx to Rx in both cases
+    assert np.array_equal(swap.rays.Tx, Tx)
+    for a, b, tx, rx in zip(swap.rays, ref.rays, Tx, Rx):
+        assert np.allclose(a[0], tx[[0, 2]], atol=1.e-5)
+        assert np.allclose(a[-1], rx[[0, 2]], atol=1.e-5)
+        assert np.allclose(np.sum(np.linalg.norm(np.diff(a, axis=0), axis=1)),
+                           np.sum(np.linalg.norm(np.diff(b, axis=0), axis=1)), rtol=1.e-5)
+
+
+def test_output_flags():
+    g, s, Tx, Rx = crosshole(4, 6)
+
+    tt = g.raytrace(s, Tx, Rx, compute_L=False)
+    rays = g.raytrace(s, Tx, Rx, compute_L=False, compute_rays=True)
+    full = g.raytrace(s, Tx, Rx, compute_rays=True)
+
+    assert tt.L is None and tt.rays is None
+    assert rays.L is None and len(rays.rays) == Tx.shape[0]
+    assert np.array_equal(tt.tt, full.tt)
+    assert full.L.shape == (Tx.shape[0], g.getNumberOfCells())
+    assert np.allclose(full.L @ s, full.tt, rtol=1.e-10, atol=0.0)
+    assert len(full.rays) == Tx.shape[0]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of Grid2D.raytraceBatch
+"""
+
+import numpy as np
+import pytest
+
+from grid import Grid2D
+
+
+def crosshole():
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 2)
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    return g, Tx, Rx
+
+
+def models(g, nmodels=5):
+    xc = g.getCellCenter()
+    rng = np.random.RandomState(0)
+    s = [1.0 + a * np.exp(-((xc[:, 0] - x)**2 + (xc[:, 1] - z)**2) / 4.0)
+         for a, x, z in zip(rng.uniform(-0.3, 0.3, nmodels), rng.uniform(2, 8, nmodels),
+                            rng.uniform(3, 12, nmodels))]
+    return np.array(s)
+
+
+@pytest.mark.parametrize('swap', [False, True])
+def test_same_as_raytrace(swap):
+    g, Tx, Rx = crosshole()
+    if swap:
+        Tx, Rx = Rx, Tx
+    t0 = 0.1 * Tx[:, 2]
+    s = models(g)
+    res = g.raytraceBatch(s, Tx, Rx, t0, compute_L=True)
+
+    assert res.tt.shape == (s.shape[0], Tx.shape[0])
+    assert len(res.L) == s.shape[0]
+    assert res.nsolves == 8 * s.shape[0]
+    for n in range(s.shape[0]):
+        ref = g.raytrace(s[n], Tx, Rx, t0)
+        assert np.array_equal(res.tt[n], ref.tt)
+        assert abs(res.L[n] - ref.L).max() == 0.0
+
+
+def test_anisotropic_models():
+    g, Tx, Rx = crosshole()
+    s = models(g, 3)
+    xi = np.full(g.getNumberOfCells(), 1.1)
+    theta = np.full(g.getNumberOfCells(), 0.2)
+    tt = g.raytraceBatch(s, Tx, Rx, xi=xi, theta=theta).tt
+    for n in range(s.shape[0]):
+        assert np.array_equal(tt[n], g.raytrace(s[n], Tx, Rx, xi=xi, theta=theta, compute_L=False).tt)
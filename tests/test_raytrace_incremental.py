@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of Grid2D.raytraceIncremental against a full raytracing
+"""
+
+import numpy as np
+import pytest
+
+from grid import Grid2D
+
+
+def crosshole():
+    g = Grid2D(np.linspace(0, 10, 41), np.linspace(0, 15, 61), 1)
+    g.nsnx = g.nsnz = 5
+    zt = np.linspace(0.5, 14.5, 15)
+    zr = np.linspace(0.5, 14.5, 29)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    return g, Tx, Rx
+
+
+def anomaly(g, amp, width):
+    # local increase of slowness close to the upper sources
+    xc = g.getCellCenter()
+    return 1.0 + amp * np.exp(-((xc[:, 0] - 1.0)**2 + (xc[:, 1] - 2.0)**2) / width)
+
+
+@pytest.mark.parametrize('rtol', [0.0, 1.e-3, 1.e-2])
+@pytest.mark.parametrize('amp, width', [(0.2, 0.5), (0.01, 1.0)])
+def test_traveltime_error_bounded_by_rtol(rtol, amp, width):
+    g, Tx, Rx = crosshole()
+    s0 = np.ones(g.getNumberOfCells())
+    s1 = anomaly(g, amp, width)
+
+    g.raytraceIncremental(s0, Tx, Rx, rtol=rtol)
+    inc = g.raytraceIncremental(s1, Tx, Rx, rtol=rtol)
+    full = g.raytrace(s1, Tx, Rx)
+
+    # only part of the sources are traced again
+    assert inc.nsolves < 15
+    # slowness increased, so stale paths are not faster than the new ones
+    assert np.all(np.abs(inc.tt - full.tt) <= rtol * full.tt + 1.e-12)
+    # traveltimes of kept rows are updated along their (stale) paths
+    assert np.allclose(inc.L @ s1, inc.tt, rtol=0.0, atol=1.e-12)
+    # kept rows are paths of the previous model: never faster than the optimum
+    assert np.all(inc.L @ s1 >= full.tt - 1.e-12)
+
+
+def test_rows_retraced_or_kept():
+    g, Tx, Rx = crosshole()
+    s0 = np.ones(g.getNumberOfCells())
+    s1 = anomaly(g, 0.2, 0.5)
+
+    L0 = g.raytraceIncremental(s0, Tx, Rx, rtol=0.0).L
+    inc = g.raytraceIncremental(s1, Tx, Rx, rtol=0.0)
+    full = g.raytrace(s1, Tx, Rx)
+
+    # rows crossing changed cells are traced again, as in a full raytracing
+    crossed = np.nonzero(np.asarray(L0 @ (s1 != s0)).ravel() > 0)[0]
+    assert crossed.size > 0
+    assert abs(inc.L[crossed, :] - full.L[crossed, :]).max() < 1.e-12
+    # rays of the other sources are kept (whole source groups are traced)
+    other = np.nonzero(~np.isin(Tx[:, 2], Tx[crossed, 2]))[0]
+    assert other.size > 0
+    assert abs(inc.L[other, :] - L0[other, :]).max() == 0.0
+    # with rtol = 0, stale rows only differ from a full raytracing by paths
+    # of the same traveltime
+    assert np.allclose(inc.tt, full.tt, rtol=1.e-12, atol=0.0)
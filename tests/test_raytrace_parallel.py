@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of Grid2D.raytraceParallel
+"""
+
+import numpy as np
+import pytest
+
+from grid import Grid2D
+
+
+def crosshole():
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 2)
+    xc = g.getCellCenter()
+    s = 1.0 + 0.3 * np.exp(-((xc[:, 0] - 5.0)**2 + (xc[:, 1] - 7.0)**2) / 4.0)
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    return g, s, Tx, Rx
+
+
+@pytest.mark.parametrize('swap', [False, True])
+def test_same_as_raytrace(swap):
+    g, s, Tx, Rx = crosshole()
+    if swap:
+        Tx, Rx = Rx, Tx
+    t0 = 0.1 * Tx[:, 2]
+    ref = g.raytrace(s, Tx, Rx, t0, compute_rays=True)
+    res = g.raytraceParallel(s, Tx, Rx, t0, compute_rays=True, nprocs=2)
+
+    assert np.array_equal(res.tt, ref.tt)
+    assert abs(res.L - ref.L).max() == 0.0
+    assert all(np.array_equal(res.rays[n], ref.rays[n]) for n in range(Tx.shape[0]))
+    assert res.nsolves == 8
+    assert res.nsolves_saved == ref.nsolves_saved
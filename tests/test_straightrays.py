@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the NumPy straight-ray engine against the C++ implementations
+"""
+
+import numpy as np
+import pytest
+
+import straightrays
+from cutils import cgrid2d, cgrid3d
+
+
+def endPoints(ndim, n, seed=0):
+    # random rays, including vertical and horizontal ones and rays going in all directions
+    rng = np.random.RandomState(seed)
+    Tx = rng.uniform(0.1, 9.9, (n, ndim))
+    Rx = rng.uniform(0.1, 9.9, (n, ndim))
+    Rx[:4, 0] = Tx[:4, 0]
+    Rx[4:8, -1] = Tx[4:8, -1]
+    return Tx, Rx
+
+
+@pytest.mark.parametrize('aniso', [False, True])
+def test_siddon_2d(aniso):
+    Tx, Rx = endPoints(2, 200)
+    grx = np.linspace(0, 10, 21)
+    grz = np.linspace(0, 10, 31)
+
+    L = straightrays.Lsr2d(Tx, Rx, grx, grz, aniso)
+    if aniso:
+        Lc = cgrid2d.Grid2Dcpp.Lsr2da(Tx, Rx, grx, grz)
+    else:
+        Lc = cgrid2d.Grid2Dcpp.Lsr2d(Tx, Rx, grx, grz)
+
+    assert L.shape == Lc.shape
+    assert np.allclose(L.toarray(), Lc.toarray(), rtol=0.0, atol=1.e-10)
+    if not aniso:
+        # row sums are the lengths of the rays
+        assert np.allclose(np.asarray(L.sum(axis=1)).ravel(), np.linalg.norm(Rx - Tx, axis=1))
+
+
+@pytest.mark.parametrize('aniso', [False, True])
+def test_siddon_3d(aniso):
+    Tx, Rx = endPoints(3, 100)
+    grx = np.linspace(0, 10, 11)
+    gry = np.linspace(0, 10, 6)
+    grz = np.linspace(0, 10, 13)
+
+    L = straightrays.Lsr3d(Tx, Rx, grx, gry, grz, aniso)
+    Lc = cgrid3d.Grid3Dcpp.Lsr3d(Tx, Rx, grx, gry, grz, aniso)
+
+    assert L.shape == Lc.shape
+    assert np.allclose(L.toarray(), Lc.toarray(), rtol=0.0, atol=1.e-10)
+
+
+def test_chunks():
+    Tx, Rx = endPoints(2, 50)
+    grx = np.linspace(0, 10, 21)
+    grz = np.linspace(0, 10, 31)
+
+    L = straightrays.Lsr2d(Tx, Rx, grx, grz)
+    Lc = straightrays.Lsr2d(Tx, Rx, grx, grz, chunk_size=100)
+
+    assert np.array_equal(L.toarray(), Lc.toarray())
+
+
+def test_cache_hits():
+    Tx, Rx = endPoints(2, 50)
+    grids = (np.linspace(0, 10, 21), np.linspace(0, 10, 31))
+    cache = straightrays.LCache()
+
+    L = cache.get(Tx, Rx, grids)
+    assert cache.misses == 1 and cache.hits == 0
+    L.data[:] = 0.0  # copies are returned
+    L2 = cache.get(Tx, Rx, grids)
+    assert cache.misses == 1 and cache.hits == 1
+    assert np.array_equal(L2.toarray(), straightrays.siddon(Tx, Rx, grids).toarray())
+
+    # any change in the geometry gives another matrix
+    cache.get(Tx, Rx, grids, aniso=True)
+    cache.get(Tx, Rx + 0.01, grids)
+    cache.get(Tx, Rx, (grids[0], np.linspace(0, 10, 21)))
+    assert cache.misses == 4 and len(cache.entries) == 4
+
+    # room for one matrix: least recently used ones are discarded
+    L = straightrays.siddon(Tx, Rx + 0.02, grids)
+    cache.max_mb = 1.01 * (L.data.nbytes + L.indices.nbytes + L.indptr.nbytes) / 1024**2
+    cache.get(Tx, Rx + 0.02, grids)
+    assert cache.misses == 5 and len(cache.entries) == 1
+    cache.get(Tx, Rx + 0.02, grids)
+    assert cache.misses == 5
+
+
+def test_cache_on_disk(tmp_path):
+    Tx, Rx = endPoints(3, 20)
+    grids = (np.linspace(0, 10, 11), np.linspace(0, 10, 6), np.linspace(0, 10, 13))
+    L = straightrays.LCache(directory=str(tmp_path)).get(Tx, Rx, grids)
+    assert len(list(tmp_path.glob('*.npz'))) == 1
+
+    # a new session reads the matrix from disk, also without memory cache
+    cache = straightrays.LCache(max_mb=0, directory=str(tmp_path))
+    for _ in range(2):
+        L2 = cache.get(Tx, Rx, grids)
+        assert L2.shape == L.shape
+        assert np.array_equal(L2.toarray(), L.toarray())
+    assert cache.misses == 0 and cache.hits == 2 and len(cache.entries) == 0
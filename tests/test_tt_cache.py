@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the cache of travel-time fields of Grid2D
+"""
+
+import numpy as np
+
+from grid import Grid2D, cgrid_pool
+
+
+def crosshole(zr, x=9.5):
+    zt = np.linspace(0.5, 14.5, 8)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[x, 0.0, b] for _ in zt for b in zr])
+    return Tx, Rx
+
+
+def grid(tt_cache_mb=0):
+    # C++ grids of previous tests, with their cache and counters, are not reused
+    cgrid_pool.clear()
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 1)
+    g.setTTCache(tt_cache_mb)
+    return g
+
+
+def slowness(g):
+    xc = g.getCellCenter()
+    return 1.0 + 0.3 * np.exp(-((xc[:, 0] - 5.0)**2 + (xc[:, 1] - 7.0)**2) / 4.0)
+
+
+def test_new_receivers_from_cache():
+    g = grid(10)
+    s = slowness(g)
+    Tx, Rx = crosshole(np.linspace(0.5, 14.5, 15))
+    Tx2, Rx2 = crosshole(np.linspace(1.0, 14.0, 20), 7.3)
+
+    assert g.raytrace(s, Tx, Rx, compute_L=False).nsolves == 8
+    assert g.cgrid.getTTCacheStats()[0] == 8
+
+    # fields of the 8 sources are in cache: new receivers are obtained without solving
+    res = g.raytrace(s, Tx2, Rx2, compute_L=False)
+    assert res.nsolves == 0
+    assert g.cgrid.getTTCacheStats()[2] == 8
+    assert np.array_equal(res.tt, grid().raytrace(s, Tx2, Rx2, compute_L=False).tt)
+
+    # L and rays need the fields to be computed again
+    assert g.raytrace(s, Tx2, Rx2).nsolves == 8
+
+
+def test_invalidation():
+    g = grid(10)
+    s = slowness(g)
+    Tx, Rx = crosshole(np.linspace(0.5, 14.5, 15))
+    tt = g.raytrace(s, Tx, Rx, compute_L=False).tt
+
+    # a new model empties the cache
+    res = g.raytrace(1.1 * s, Tx, Rx, compute_L=False)
+    assert res.nsolves == 8
+    assert np.allclose(res.tt, 1.1 * tt, rtol=1.e-12, atol=0.0)
+    nFields, nBytes, nHits, nMisses = g.cgrid.getTTCacheStats()
+    assert nFields == 8 and nHits == 0 and nMisses == 16  # counters are cumulative
+
+
+def test_size_limit():
+    g = grid(10)
+    s = slowness(g)
+    Tx, Rx = crosshole(np.linspace(0.5, 14.5, 15))
+    g.raytrace(s, Tx, Rx, compute_L=False)
+    field_mb = g.cgrid.getTTCacheStats()[1] / 8 / 1024**2
+
+    # room for 3 fields: the least recently used ones are discarded
+    g.setTTCache(3.5 * field_mb)
+    assert g.raytrace(s, Tx, Rx, compute_L=False).nsolves == 8
+    assert g.cgrid.getTTCacheStats()[0] == 3
+    assert g.raytrace(s, Tx[-15:], Rx[-15:], compute_L=False).nsolves == 0
+
+    g.setTTCache(0)
+    assert g.raytrace(s, Tx, Rx, compute_L=False).nsolves == 8
+    assert g.cgrid.getTTCacheStats()[0] == 0
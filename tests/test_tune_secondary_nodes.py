@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of Grid2D.tuneSecondaryNodes
+"""
+
+import numpy as np
+import pytest
+
+from grid import Grid2D, cgrid_pool
+
+
+def crosshole():
+    g = Grid2D(np.linspace(0, 10, 21), np.linspace(0, 15, 31), 1)
+    zt = np.linspace(0.5, 14.5, 8)
+    zr = np.linspace(0.5, 14.5, 15)
+    Tx = np.array([[0.5, 0.0, a] for a in zt for _ in zr])
+    Rx = np.array([[9.5, 0.0, b] for _ in zt for b in zr])
+    xc = g.getCellCenter()
+    s = 1.0 + 0.3 * np.exp(-((xc[:, 0] - 5.0)**2 + (xc[:, 1] - 7.0)**2) / 4.0)
+    return g, s, Tx, Rx
+
+
+def test_pool_untouched():
+    g, s, Tx, Rx = crosshole()
+    cgrid_pool.clear()
+    g.raytrace(s, Tx, Rx)
+    keys = list(cgrid_pool.grids.keys())
+
+    g.tuneSecondaryNodes(s, Tx, Rx, 1.e-4, nsn=(2, 3, 4, 5, 6), nsources=2)
+
+    assert list(cgrid_pool.grids.keys()) == keys
+
+
+def test_reference_beyond_candidates():
+    g, s, Tx, Rx = crosshole()
+    nsn = (2, 3, 4)
+    g.tuneSecondaryNodes(s, Tx, Rx, 0.0, nsn=nsn, nsources=2)
+    tuning = g.nsn_tuning
+
+    assert tuning['nsn_ref'] == 8
+    # no candidate is the reference, so none matches it exactly
+    assert all(e > 0.0 for e in tuning['error'])
+    # errors decrease as n converges to the reference
+    assert tuning['error'][-1] < tuning['error'][0]
+    # none is within tol: the largest n tried is selected
+    assert tuning['selected'] == 4
+
+    # a looser tol selects the first n within tol of the reference
+    tol = tuning['error'][1]
+    assert g.tuneSecondaryNodes(s, Tx, Rx, tol, nsn=nsn, nsources=2) <= 3
+
+    with pytest.raises(ValueError):
+        g.tuneSecondaryNodes(s, Tx, Rx, 0.0, nsn=nsn, nsources=2, nsn_ref=4)
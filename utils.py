@@ -24,8 +24,6 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import sys
-import inspect
-import dis
 import numpy as np
 import scipy.signal
 import sqlalchemy.types as types
@@ -53,27 +51,6 @@ def Hook(Type, value, traceback):  # PyQt5 overrides Eclipse's exception catchin
 sys.excepthook = Hook
 
 
-def nargout():  # TODO FIXME either doesn't work as of 3.6 or doesn't work on windows
-    """
-    Returns how many values the caller is expecting
-
-    taken from
-    http://stackoverflow.com/questions/16488872/python-check-for-the-number-of-output-arguments-a-function-is-called-with
-    """
-    f = inspect.currentframe()
-    f = f.f_back.f_back
-    c = f.f_code
-    i = f.f_lasti
-    bytecode = c.co_code
-    instruction = bytecode[i + 3]
-    if instruction == dis.opmap['UNPACK_SEQUENCE']:
-        howmany = bytecode[i + 4]
-        return howmany
-    elif instruction == dis.opmap['POP_TOP']:
-        return 0
-    return 1
-
-
 def set_tick_arrangement(grid):
     start = min(grid.grx[0],grid.grx[-1])
     end = max(grid.grx[0],grid.grx[-1])
@@ -137,20 +114,3 @@ def data_select(data, freq, dt, L=100, threshold=5, medfilt_len=10):
     ind_data_select[SNR > threshold] = True
 
     return SNR
-
-
-def f():  # test
-
-    nout = nargout()
-    print(nout)
-    if nout == 1:
-        return 1
-    elif nout == 2:
-        return 1, 2
-
-
-if __name__ == "__main__":
-
-    f()
-    a = f()
-    a, b = f()